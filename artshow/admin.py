@@ -4,12 +4,12 @@
 from .models import *
 from django.contrib import admin, messages
 from django.core import urlresolvers
+from django.conf.urls import patterns, url
 from django.contrib.admin import helpers
 from django.shortcuts import render
 from django.utils.html import escape
 from django import forms
 from . import email1
-from . import processbatchscan
 from django.core.mail import send_mail
 import smtplib
 import datetime
@@ -18,9 +18,9 @@ from django.http import HttpResponse
 from ajax_select import make_ajax_form
 from ajax_select.admin import AjaxSelectAdmin, AjaxSelectAdminTabularInline
 from ajax_select.fields import AutoCompleteSelectField
-from django.db.models import Max, Sum
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.utils import timezone
 
 User = get_user_model()
 
@@ -105,11 +105,10 @@ def send_password_reset_email(artist, user, subject, body_template):
 
 class ArtistForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
-        if 'instance' not in kwargs:
-            kwargs.setdefault('initial',{})
-            kwargs['initial']['artistid'] = \
-                (Artist.objects.aggregate(artistid=Max('artistid')).get('artistid', 0) or 0) + 1
         super(ArtistForm, self).__init__(*args, **kwargs)
+        if self.instance.artistid is None:
+            self.fields['artistid'].required = False
+            self.fields['artistid'].help_text = "Leave blank to use the next available artist ID"
 
     class Meta:
         model = Artist
@@ -259,12 +258,9 @@ class ArtistAdmin(AjaxSelectAdmin):
             for piece in a.piece_set.all():
                 if piece.status != Piece.StatusNotInShow:
                     total_pieces += 1
-                try:
-                    top_bid = piece.top_bid()
-                    total_winnings += top_bid.amount
+                if piece.current_bid_amount is not None:
+                    total_winnings += piece.current_bid_amount
                     pieces_with_bids += 1
-                except Bid.DoesNotExist:
-                    pass
             commission = total_winnings * decimal.Decimal(settings.ARTSHOW_COMMISSION)
             if total_pieces > 0:
                 payment = Payment(artist=a, amount=total_winnings, payment_type=pt_winning,
@@ -281,8 +277,8 @@ class ArtistAdmin(AjaxSelectAdmin):
     # noinspection PyUnusedLocal
     def create_cheques(self, request, artists):
         pt_paymentsent = PaymentType.objects.get(pk=settings.ARTSHOW_PAYMENT_SENT_PK)
-        for a in artists:
-            balance = a.payment_set.aggregate(balance=Sum('amount'))['balance']
+        for a in artists.select_related('ledger'):
+            balance = a.balance()
             if balance > 0:
                 chq = ChequePayment(artist=a, payment_type=pt_paymentsent, amount=-balance,
                                     date=datetime.datetime.now())
@@ -293,7 +289,7 @@ class ArtistAdmin(AjaxSelectAdmin):
     def allocate_spaces(self, request, artists):
         artists = artists.order_by('reservationdate', 'artistid')
         spaces_remaining = {}
-        for space in Space.objects.all():
+        for space in Space.objects.with_totals():
             spaces_remaining[space.id] = space.remaining()
         for artist in artists:
             for alloc in artist.allocation_set.all():
@@ -379,6 +375,9 @@ class SpaceAdmin(admin.ModelAdmin):
     list_display = ('name', 'shortname', 'price', 'reservable', 'available', 'allocated', 'remaining', 'waiting')
     list_editable = ('reservable', 'available')
 
+    def get_queryset(self, request):
+        return Space.objects.with_totals(super(SpaceAdmin, self).get_queryset(request))
+
 
 admin.site.register(Space, SpaceAdmin)
 
@@ -404,28 +403,14 @@ class PieceAdmin(admin.ModelAdmin):
 
     def apply_won_status(self, request, pieces):
         # This code is duplicated in the management code
-        for p in pieces.filter(status=Piece.StatusInShow, voice_auction=False):
-            try:
-                # noinspection PyUnusedLocal
-                top_bid = p.top_bid()
-            except Bid.DoesNotExist:
-                pass
-            else:
-                p.status = Piece.StatusWon
-                p.save()
+        pieces.filter(status=Piece.StatusInShow, voice_auction=False, bid_count__gt=0) \
+            .update(status=Piece.StatusWon, updated=timezone.now())
         self.message_user(request,
                           "Pieces marked as 'In Show', not in Voice Auction and has a bid have been marked as 'Won'.")
 
     def apply_won_status_incl_voice_auction(self, request, pieces):
-        for p in pieces.filter(status=Piece.StatusInShow):
-            try:
-                # noinspection PyUnusedLocal
-                top_bid = p.top_bid()
-            except Bid.DoesNotExist:
-                pass
-            else:
-                p.status = Piece.StatusWon
-                p.save()
+        pieces.filter(status=Piece.StatusInShow, bid_count__gt=0).update(status=Piece.StatusWon,
+                                                                          updated=timezone.now())
         self.message_user(request, "Pieces marked as 'In Show' and has a bid have been marked as 'Won'.")
 
     def apply_returned_status(self, request, pieces):
@@ -457,10 +442,10 @@ class PieceAdmin(admin.ModelAdmin):
     clickable_invoice.short_description = "invoice"
 
     def top_bid(self, obj):
-        return obj.bid_set.exclude(invalid=True).order_by('-amount')[0:1].get().amount
+        return obj.current_bid_amount
 
     def top_bid_detail(self, obj):
-        top_bid = obj.bid_set.exclude(invalid=True).order_by('-amount')[0:1].get()
+        top_bid = obj.top_bid()
         return "$%s by %s" % (top_bid.amount, top_bid.bidder)
 
     top_bid_detail.short_description = "Top bid"
@@ -491,6 +476,7 @@ class PieceAdmin(admin.ModelAdmin):
     list_display = (
         'code', 'clickable_artist', 'name', 'adult', 'min_bid_x', 'buy_now_x', 'location', 'voice_auction', 'status',
         'top_bid')
+    list_select_related = ('artist__person',)
     inlines = [PieceBidInline]
     # raw_id_fields = ( 'invoice', )
     # TODO put 'invoiceitem' back into the list. Waiting on bug #16433
@@ -601,10 +587,11 @@ class InvoiceAdmin(admin.ModelAdmin):
         return obj.payer.name()
 
     def num_pieces(self, obj):
-        return obj.invoiceitem_set.count()
+        return obj.item_count
 
     raw_id_fields = ('payer', )
     list_display = ('id', 'bidder_name', 'num_pieces', 'total_paid')
+    list_select_related = ('payer__person', )
     search_fields = ('id', 'payer__person__name')
     inlines = [InvoiceItemInline, InvoicePaymentInline]
 
@@ -627,22 +614,103 @@ admin.site.register(Checkoff, CheckoffAdmin)
 
 
 class BatchScanAdmin(admin.ModelAdmin):
-    list_display = ('id', 'batchtype', 'date_scanned', 'processed')
-    list_filter = ('batchtype', 'processed')
-    fields = ('id', 'batchtype', 'data', 'date_scanned', 'processed', 'processing_log')
-    readonly_fields = ('id',)
-    actions = ('process_batch',)
+    list_display = ('id', 'batchtype', 'date_scanned', 'device', 'dry_run_errors', 'processed', 'status', 'progress',
+                    'throughput')
+    list_filter = ('batchtype', 'processed', 'status', 'device')
+    fields = ('id', 'batchtype', 'data', 'date_scanned', 'device', 'per_block', 'residual_of', 'dry_run_errors',
+              'dry_run_report', 'processed', 'status', 'worker', 'started', 'finished', 'progress', 'bids_created',
+              'pieces_updated', 'query_count', 'timing', 'processing_log')
+    readonly_fields = ('id', 'dry_run_errors', 'dry_run_report', 'status', 'worker', 'started', 'finished',
+                       'progress', 'bids_created', 'pieces_updated', 'query_count', 'timing')
+    raw_id_fields = ('residual_of',)
+    actions = ('queue_batch', 'queue_batch_per_block')
+    change_list_template = "admin/artshow/batchscan/change_list.html"
+
+    def progress(self, obj):
+        if obj.status == BatchScan.StatusNew:
+            return ""
+        return "%d of %d lines, %d blocks" % (obj.lines_processed, obj.lines_total, obj.blocks_processed)
+
+    def throughput(self, obj):
+        lines_per_second = obj.lines_per_second()
+        if lines_per_second is None:
+            return ""
+        return "%.0f lines/s" % lines_per_second
+
+    def timing(self, obj):
+        if obj.wall_time is None:
+            return ""
+        return "%.2fs: parse %.2fs, lookup %.2fs, apply %.2fs, write %.2fs" % (
+            obj.wall_time, obj.parse_time, obj.lookup_time, obj.apply_time, obj.write_time)
+
+    def get_urls(self):
+        urls = patterns('', url(r'^summary/$', self.admin_site.admin_view(self.summary_view),
+                                name='artshow_batchscan_summary'))
+        return urls + super(BatchScanAdmin, self).get_urls()
+
+    def summary_view(self, request):
+        by_type, by_hour = BatchScan.objects.throughput()
+        context = {
+            "title": "Batch Scan Throughput",
+            "opts": self.model._meta,
+            "app_label": self.model._meta.app_label,
+            "by_type": by_type,
+            "by_hour": by_hour,
+        }
+        return render(request, "admin/artshow/batchscan/summary.html", context)
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = extra_context or {}
+        # The list is reloaded every few seconds while the processbatchscans workers have work to do
+        extra_context['batchscans_active'] = BatchScan.objects.filter(
+            status__in=[BatchScan.StatusQueued, BatchScan.StatusRunning]).exists()
+        return super(BatchScanAdmin, self).changelist_view(request, extra_context=extra_context)
+
+    def queue_batch(self, request, queryset):
+        num_queued = BatchScan.objects.enqueue(queryset)
+        self.message_user(request, "Queued %d batches for processing" % num_queued)
 
-    def process_batch(self, request, queryset):
-        for bs in queryset:
-            processbatchscan.process_batchscan(bs.id)
-            self.message_user(request, "Processed batch %d" % bs.id)
+    queue_batch.short_description = "Queue for processing"
 
-    process_batch.short_description = "Process Batch"
+    def queue_batch_per_block(self, request, queryset):
+        num_queued = BatchScan.objects.enqueue(queryset, per_block=True)
+        self.message_user(request, "Queued %d batches for processing, keeping the blocks without errors" % num_queued)
+
+    queue_batch_per_block.short_description = "Queue for processing, keeping the blocks without errors"
 
 
 admin.site.register(BatchScan, BatchScanAdmin)
 
+
+class PrintJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'printer', 'description', 'created', 'created_by', 'status', 'attempts', 'finished',
+                    'error')
+    list_filter = ('printer', 'status')
+    search_fields = ('description',)
+    fields = ('id', 'printer', 'description', 'invoice', 'created', 'created_by', 'status', 'attempts',
+              'not_before', 'worker', 'started', 'finished', 'error')
+    readonly_fields = fields
+    actions = ('print_again', 'cancel')
+
+    def has_add_permission(self, request):
+        # Print jobs are queued by the pages that print
+        return False
+
+    def print_again(self, request, queryset):
+        num_queued = PrintJob.objects.requeue(queryset)
+        self.message_user(request, "Queued %d print jobs to be printed again" % num_queued)
+
+    print_again.short_description = "Print again"
+
+    def cancel(self, request, queryset):
+        num_cancelled = PrintJob.objects.cancel(queryset)
+        self.message_user(request, "Cancelled %d queued print jobs" % num_cancelled)
+
+    cancel.short_description = "Cancel queued print jobs"
+
+
+admin.site.register(PrintJob, PrintJobAdmin)
+
 #admin.site.register(Event)
 
 #class TaskAdmin ( admin.ModelAdmin ):
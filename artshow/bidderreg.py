@@ -1,14 +1,13 @@
 from StringIO import StringIO
-import subprocess
 from django import forms
 from django.contrib.auth.decorators import permission_required
 from django.contrib.formtools.wizard.views import CookieWizardView
 from django.shortcuts import render, redirect
 from .conf import settings
 from .models import Person, Bidder, BidderId
+from .printspooler import spool
 import logging
 logger = logging.getLogger(__name__)
-from .conf import _DISABLED as SETTING_DISABLED
 
 
 preprint = __import__(settings.ARTSHOW_PREPRINT_MODULE, globals(), locals(),
@@ -59,21 +58,11 @@ class BidderRegistrationForm2(forms.Form):
 
 # noinspection PyUnusedLocal
 def do_print_bidder_registration_form(bidder):
+    """Render the bidder's agreement, and queue it for the print spooler."""
 
     sbuf = StringIO()
     preprint.bidder_agreement(bidder, sbuf)
-
-    if settings.ARTSHOW_PRINT_COMMAND is SETTING_DISABLED:
-        logger.error("Cannot print agreement. ARTSHOW_PRINT_COMMAND is DISABLED")
-        raise Exception("Printing is DISABLED in configuration")
-    p = subprocess.Popen(settings.ARTSHOW_PRINT_COMMAND, stderr=subprocess.PIPE, stdout=subprocess.PIPE,
-                         stdin=subprocess.PIPE, shell=True)
-    output, error = p.communicate(sbuf.getvalue())
-    if output:
-        logger.debug("printing command returned: %s", output)
-    if error:
-        logger.error("printing command returned error: %s", error)
-        raise Exception(error)
+    spool(settings.ARTSHOW_BIDDER_AGREEMENT_PRINTER, sbuf.getvalue(), "Bidder agreement for %s" % bidder)
 
 
 class BidderRegistrationWizard(CookieWizardView):
@@ -0,0 +1,64 @@
+# Artshow Jockey
+# Copyright (C) 2009-2014 Chris Cogdon
+# See file COPYING for licence details
+
+from django.core.exceptions import ValidationError
+from .models import Piece, IN_QUERY_CHUNK_SIZE
+
+
+class BidValidator(object):
+    """Validates a batch of proposed Bids using the rules of Bid.validate().
+
+    The pieces involved, and their current top bids, are loaded in one pass (see load_pieces), and are
+    then checked in memory. Each bid that passes becomes the top bid of its piece for the bids that
+    follow it, so the results are the same as calling validate() then save() on each bid in turn.
+    """
+
+    def __init__(self):
+        self.pieces = {}
+        self.top_bids = {}
+
+    def load_pieces(self, piece_ids):
+        """Load any of the given pieces not already loaded, with their current top bids."""
+        piece_ids = [x for x in set(piece_ids) if x not in self.pieces]
+        for i in range(0, len(piece_ids), IN_QUERY_CHUNK_SIZE):
+            for piece in Piece.objects.filter(pk__in=piece_ids[i:i + IN_QUERY_CHUNK_SIZE]) \
+                    .select_related('current_bid'):
+                self.add_piece(piece)
+
+    def add_piece(self, piece):
+        """Use an already loaded piece, replacing any copy held. The piece should have been loaded with
+        select_related('current_bid') to avoid a query."""
+        self.pieces[piece.pk] = piece
+        self.top_bids[piece.pk] = piece.current_bid if piece.current_bid_id else None
+        return piece
+
+    def get_piece(self, piece_id):
+        if piece_id not in self.pieces:
+            self.load_pieces([piece_id])
+        return self.pieces[piece_id]
+
+    def validate(self, bid):
+        """Raise ValidationError if the bid is not valid. The bid's piece is replaced by the loaded copy."""
+        piece = self.get_piece(bid.piece_id)
+        bid.piece = piece
+        bid.validate_against(piece, self.top_bids[piece.pk] if bid.id is None else None)
+
+    def accept(self, bid):
+        """Record a validated bid as the top bid on its piece, for the validation of following bids."""
+        self.top_bids[bid.piece_id] = bid
+
+    def validate_bids(self, bids):
+        """Validate a list of bids, in order. Returns a list, in the same order, of None for each valid
+        bid or the ValidationError for each invalid bid. Valid bids are accepted."""
+        self.load_pieces([bid.piece_id for bid in bids])
+        errors = []
+        for bid in bids:
+            try:
+                self.validate(bid)
+            except ValidationError, x:
+                errors.append(x)
+            else:
+                self.accept(bid)
+                errors.append(None)
+        return errors
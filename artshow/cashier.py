@@ -1,27 +1,24 @@
 # Artshow Jockey
 # Copyright (C) 2009, 2010, 2011 Chris Cogdon
 # See file COPYING for licence details
-from StringIO import StringIO
-import subprocess
 from django.shortcuts import render, get_object_or_404, redirect
-from django.http import HttpResponseBadRequest
-from .models import Bidder, Piece, InvoicePayment, InvoiceItem, Invoice
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.core.urlresolvers import reverse
+from .models import AlreadySoldError, Bidder, BidderSearchToken, Piece, InvoicePayment, Invoice, load_winnings
 from django import forms
-from django.db.models import Q
 from django.forms import ModelForm
 from django.forms.models import modelformset_factory, BaseModelFormSet
 from .conf import settings
 from django.core.exceptions import ValidationError
 from decimal import Decimal
 import logging
-import datetime
-from . import invoicegen
 from . import pdfreports
+from .printspooler import PrintingError, spool
+from .identitymap import IdentityMap
 logger = logging.getLogger(__name__)
 from django.contrib import messages
 from django.contrib.auth.decorators import permission_required
 import json
-from .conf import _DISABLED as SETTING_DISABLED
 
 
 class BidderSearchForm (forms.Form):
@@ -35,8 +32,7 @@ def cashier(request):
         form = BidderSearchForm(request.POST)
         if form.is_valid():
             text = form.cleaned_data['text']
-            # TODO - the following will return multiple entries for name base if bidder has two IDs
-            bidders = Bidder.objects.filter(Q(person__name__icontains=text) | Q(bidderid__id=text))
+            bidders = BidderSearchToken.objects.search(text, limit=100)
             search_executed = True
         else:
             bidders = []
@@ -48,6 +44,21 @@ def cashier(request):
     return render(request, 'artshow/cashier.html', c)
 
 
+# Bidders returned for each typeahead search
+TYPEAHEAD_LIMIT = 20
+
+
+@permission_required('artshow.add_invoice')
+def cashier_search(request):
+    """The bidders matching the q parameter, as JSON, for the typeahead on the cashier page."""
+    bidders = BidderSearchToken.objects.search(request.GET.get('q', ""), limit=TYPEAHEAD_LIMIT)
+    results = [{"id": bidder.pk, "name": bidder.person.name, "bidder_ids": bidder.bidder_ids(),
+                "won": bidder.num_won, "sold": bidder.num_sold,
+                "url": reverse('artshow.cashier.cashier_bidder', kwargs={'bidder_id': bidder.pk})}
+               for bidder in bidders]
+    return HttpResponse(json.dumps({"bidders": results}), content_type="application/json")
+
+
 class ItemsForm (forms.Form):
     tax_paid = forms.DecimalField()
 
@@ -80,23 +91,26 @@ class SelectPieceForm (forms.Form):
     select = forms.BooleanField(required=False)
 
 
-# TODO probably need a @transaction.commit_on_success here
-
-@permission_required('artshow.add_invoice')
-def cashier_bidder(request, bidder_id):
-
-    bidder = get_object_or_404(Bidder, pk=bidder_id)
-
-    all_bids = bidder.top_bids(unsold_only=True)
+def _bidder_winnings(bidder):
+    """Split the bidder's unsold winning bids into those that can be paid for now, and those still pending.
+    They are loaded in a fixed number of queries, however many there are."""
     available_bids = []
     pending_bids = []
-    bid_dict = {}
-    for bid in all_bids:
+    load_winnings([bidder], unsold_only=True)
+    for bid in bidder.top_bids(unsold_only=True):
         if bid.piece.status == Piece.StatusWon:
             available_bids.append(bid)
-            bid_dict[bid.pk] = bid
         else:
             pending_bids.append(bid)
+    return available_bids, pending_bids
+
+
+@permission_required('artshow.add_invoice')
+def cashier_bidder(request, bidder_id):
+
+    bidder = get_object_or_404(Bidder.objects.select_related('person'), pk=bidder_id)
+    available_bids, pending_bids = _bidder_winnings(bidder)
+    status = 200
 
     if request.method == "POST":
         for bid in available_bids:
@@ -122,24 +136,26 @@ def cashier_bidder(request, bidder_id):
 
                     logger.debug("payment formset passed")
 
-                    invoice = Invoice(payer=bidder, tax_paid=tax_paid, paid_date=datetime.datetime.now(),
-                                      created_by=request.user)
-                    invoice.save()
                     payments = payment_formset.save(commit=False)
-                    for payment in payments:
-                        payment.invoice = invoice
-                        payment.save()
-                    for bid in selected_bids:
-                        invoice_item = InvoiceItem(piece=bid.piece, price=bid.amount, invoice=invoice)
-                        invoice_item.save()
-                        bid.piece.status = Piece.StatusSold
-                        bid.piece.save()
-
-                    if settings.ARTSHOW_AUTOPRINT_INVOICE:
-                        do_print_invoices(request, invoice.id, settings.ARTSHOW_AUTOPRINT_INVOICE)
-
-                    return redirect(cashier_invoice, invoice_id=invoice.id)
-    else:
+                    try:
+                        invoice = Invoice.objects.create_for_bids(bidder, selected_bids, payments, tax_paid,
+                                                                  request.user)
+                    except AlreadySoldError, x:
+                        messages.error(request, u"Nothing was sold. %s already sold by another cashier: %s" % (
+                            "This piece was" if len(x.pieces) == 1 else "These pieces were",
+                            ", ".join(u"%s \"%s\"" % (piece.code, piece.name) for piece in x.pieces)))
+                        logger.info("cashier for %s: %s", bidder, x)
+                        status = 409
+                    else:
+                        if settings.ARTSHOW_AUTOPRINT_INVOICE:
+                            do_print_invoices(request, invoice.id, settings.ARTSHOW_AUTOPRINT_INVOICE)
+
+                        return redirect(cashier_invoice, invoice_id=invoice.id)
+
+    if request.method != "POST" or status == 409:
+        if status == 409:
+            # Start again from the bidder's winnings as they are now.
+            available_bids, pending_bids = _bidder_winnings(bidder)
         for bid in available_bids:
             form = SelectPieceForm(prefix="bid-%d" % bid.pk, initial={"select": False})
             bid.form = form
@@ -156,7 +172,7 @@ def cashier_bidder(request, bidder_id):
              payment_formset=payment_formset, payment_types=payment_types, payment_types_json=payment_types_json,
              tax_rate=tax_rate, money_precision=money_precision)
 
-    return render(request, 'artshow/cashier_bidder.html', c)
+    return render(request, 'artshow/cashier_bidder.html', c, status=status)
 
 
 @permission_required('artshow.add_invoice')
@@ -166,7 +182,8 @@ def cashier_invoice(request, invoice_id):
 
     c = dict(invoice=invoice, money_precision=settings.ARTSHOW_MONEY_PRECISION, tax_rate=settings.ARTSHOW_TAX_RATE,
              tax_description=settings.ARTSHOW_TAX_DESCRIPTION,
-             invoice_prefix=settings.ARTSHOW_INVOICE_PREFIX, print_invoice_form=print_invoice_form)
+             invoice_prefix=settings.ARTSHOW_INVOICE_PREFIX, print_invoice_form=print_invoice_form,
+             print_jobs=invoice.print_jobs.defer('document').order_by('id'))
 
     return render(request, 'artshow/cashier_invoice.html', c)
 
@@ -188,50 +205,37 @@ class PrintInvoiceForm (forms.Form):
 #         messages.info(request, "Invoice %s has been sent to the printer" % invoice_id)
 
 
-def do_print_invoices2(invoice, copy_names):
+def do_print_invoices2(invoice, copy_names, user=None):
 
+    # Shared by each copy, so the artists are only loaded once.
+    identity_map = IdentityMap()
     for copy_name in copy_names:
-        do_print_invoices3(invoice, copy_name)
-
+        do_print_invoices3(invoice, copy_name, identity_map, user)
 
-def do_print_invoices3(invoice, copy_name):
 
-    sbuf = StringIO()
+def do_print_invoices3(invoice, copy_name, identity_map=None, user=None):
+    """Render the copy of the invoice, and queue it for the print spooler."""
 
     try:
-        if copy_name == "PICK LIST":
-            pdfreports.picklist_to_pdf(invoice, sbuf)
-        else:
-            pdfreports.invoice_to_pdf(invoice, sbuf)
+        # The customer and merchant copies are the same PDF, so the second comes from the cache
+        pdf = pdfreports.cached_pdf('picklist' if copy_name == "PICK LIST" else 'invoice', invoice, identity_map)
     except Exception, x:
         logger.error("Could not generate invoice: %s", x)
-        raise invoicegen.PrintingError ("Could not generate invoice: %s" % x)
+        raise PrintingError("Could not generate invoice: %s" % x)
 
-    if not sbuf.getvalue():
-        logger.error("nothing to generate")
-    else:
-        if settings.ARTSHOW_PRINT_COMMAND is SETTING_DISABLED:
-            logger.error("Cannot print invoice. ARTSHOW_PRINT_COMMAND is DISABLED")
-            raise invoicegen.PrintingError("Printing is DISABLED in configuration")
-        p = subprocess.Popen(settings.ARTSHOW_PRINT_COMMAND, stderr=subprocess.PIPE, stdout=subprocess.PIPE,
-                             stdin=subprocess.PIPE, shell=True)
-        output, error = p.communicate(sbuf.getvalue())
-        if output:
-            logger.debug("printing command returned: %s", output)
-        if error:
-            logger.error("printing command returned error: %s", error)
-            raise invoicegen.PrintingError(error)
+    spool(settings.ARTSHOW_INVOICE_PRINTER, pdf, "Invoice %s%s, %s" % (
+        settings.ARTSHOW_INVOICE_PREFIX, invoice.id, copy_name.lower() or "single copy"), invoice=invoice, user=user)
 
 
 def do_print_invoices(request, invoice_id, copy_names):
     invoice = Invoice.objects.get(id=invoice_id)
     try:
-        do_print_invoices2(invoice, copy_names)
-    except invoicegen.PrintingError, x:
+        do_print_invoices2(invoice, copy_names, request.user)
+    except PrintingError, x:
         messages.error(request, "Printing failed. Please ask administrator to consult error log")
         logger.error("Printing failed with exception: %s", x)
     else:
-        messages.info(request, "Invoice %s has been sent to the printer" % invoice_id)
+        messages.info(request, "Invoice %s has been queued for printing" % invoice_id)
 
 
 @permission_required('artshow.add_invoice')
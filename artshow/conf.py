@@ -51,9 +51,18 @@ class ArtshowAppConf(AppConf):
     # Specify as a 2-tuple: ( "font name", "font path" )
     BARCODE_FONT = ('Free3of9', 'artshow/files/free3of9/FREE3OF9.TTF')
     
-    # device name of serial-connected scanner reader.
-    # eg: "/dev/ttyUSB0"
+    # device name of serial-connected scanner reader, or a list of them.
+    # eg: "/dev/ttyUSB0" or ["/dev/ttyUSB0", "/dev/ttyUSB1"]
     SCANNER_DEVICE = _DISABLED
+
+    # File that scannerreader journals every scanned line to, so that batches lost in a crash can be
+    # recovered with "manage.py replayscanjournal". Each scannerreader process needs its own.
+    # eg: "/var/lib/artshow/scanner.journal"
+    SCANNER_JOURNAL = _DISABLED
+
+    # Seconds after which a batch scan still being processed is taken to have been left by a processbatchscans
+    # worker that stopped, so that it can be queued again from the admin.
+    BATCHSCAN_STUCK_AFTER = 3600
     
     # Set this to "True" to display allocated spaces to logged-in artists
     SHOW_ALLOCATED_SPACES = False
@@ -65,6 +74,24 @@ class ArtshowAppConf(AppConf):
     # Command to send a text file to the printer.
     # Eg: "enscript -q -P myprinter -DProcessColorModel:/DeviceGray -B -L 66 -f Courier-Bold10"
     PRINT_COMMAND = _DISABLED
+
+    # Printers other than "default", by name, each with its command. Documents are sent to the printers by
+    # "manage.py printspooler", not by the pages that print them.
+    # eg: {"cashier2": "lpr -P cashier2"}
+    PRINTERS = {}
+    INVOICE_PRINTER = "default"
+    BIDDER_AGREEMENT_PRINTER = "default"
+
+    # How many times the spooler tries to print a document before giving up, and the seconds it waits after
+    # each failure. The printer's later documents wait behind a document being retried, so they print in order.
+    PRINT_ATTEMPTS = 3
+    PRINT_RETRY_DELAY = 30
+
+    # Directory to keep the invoice and pick list PDFs in once rendered, so that reprints, downloads and the
+    # merchant copy aren't laid out again. Each is kept until something shown on it changes.
+    # eg: "/var/cache/artshow/pdf"
+    PDF_CACHE_DIR = _DISABLED
+
     AUTOPRINT_INVOICE = ["CUSTOMER COPY", "MERCHANT COPY", "PICK LIST"]
     MONEY_PRECISION = 2
     MONEY_CURRENCY = "USD"
@@ -7,13 +7,15 @@ from artshow.utils import format_money
 from django.http import HttpResponse
 from django.contrib.auth.decorators import permission_required
 from .models import *
+from .identitymap import get_identity_map
 
 
 @permission_required('artshow.view_artist')
 def artists(request):
     ## TODO - This depends on the Person structure, which we want to move out into the model itself.
 
-    artists = Artist.objects.all().order_by('artistid')
+    artists = Artist.objects.select_related('person').prefetch_related('agent_set__person', 'allocation_set__space',
+                                                                       'checkoffs').order_by('artistid')
     spaces = Space.objects.all()
     checkoffs = Checkoff.objects.all()
 
@@ -57,7 +59,7 @@ def artists(request):
 # noinspection PyUnusedLocal
 @permission_required('artshow.view_piece')
 def pieces(request):
-    pieces = Piece.objects.all().order_by('artist__artistid', 'pieceid')
+    pieces = Piece.objects.with_top_bid().order_by('artist__artistid', 'pieceid')
 
     field_names = ['artistid', 'pieceid', 'code', 'artistname', 'title', 'media', 'min_bid', 'buy_now', 'adult',
                    'not_for_sale', 'status', 'top_bid', 'bought_now', 'voice_auction', 'bidder_name', 'bidder_ids']
@@ -72,18 +74,16 @@ def pieces(request):
     c.writerow(field_names_d)
 
     for p in pieces:
-        try:
-            top_bid = p.top_bid()
-        except Bid.DoesNotExist:
-            top_bid = None
+        top_bid = p.current_bid
+        top_bidder = p.current_bidder
         d = dict(artistid=p.artist.artistid, pieceid=p.pieceid, code=p.code, artistname=p.artist.artistname(),
                  title=p.name, media=p.media, min_bid=p.min_bid, buy_now=p.buy_now, adult=p.adult and "Yes" or "No",
                  not_for_sale=p.not_for_sale and "Yes" or "No",
                  status=p.get_status_display(), top_bid=top_bid and top_bid.amount or "",
                  bought_now=top_bid and (top_bid.buy_now_bid and "Yes" or "No") or "",
                  voice_auction=p.voice_auction and "Yes" or "No",
-                 bidder_name=top_bid and top_bid.bidder.name or "",
-                 bidder_ids=top_bid and (", ".join(top_bid.bidder.bidder_ids()) or ""),
+                 bidder_name=top_bidder and top_bidder.name() or "",
+                 bidder_ids=top_bidder and (", ".join(top_bidder.bidder_ids()) or ""),
         )
         c.writerow(d)
 
@@ -95,7 +95,7 @@ def pieces(request):
 def bidders(request):
     ## TODO - This depends on the Person structure, which we want to move out into the model itself.
 
-    bidders = Bidder.objects.all()
+    bidders = Bidder.objects.select_related('person')
 
     field_names = ['primary_bidder_id', 'bidder_ids', 'name', 'address1', 'address2', 'city', 'state', 'postcode',
                    'country', 'phone', 'email', 'regid']
@@ -109,7 +109,7 @@ def bidders(request):
     c = unicodewriter.UnicodeDictWriter(response, field_names)
     c.writerow(field_names_d)
 
-    for b in bidders:
+    for b in get_identity_map(request).attach_bidder_ids(bidders):
         bidder_ids = b.bidder_ids()
         if bidder_ids:
             primary_bidder_id = bidder_ids[0]
@@ -129,7 +129,7 @@ def bidders(request):
 # noinspection PyUnusedLocal
 @permission_required('artshow.view_payment')
 def payments(request):
-    payments = Payment.objects.all().order_by('id')
+    payments = Payment.objects.select_related('payment_type').order_by('id')
 
     field_names = ['paymentid', 'artistid', 'name', 'artistname', 'date', 'type', 'description', 'amount']
 
@@ -142,7 +142,7 @@ def payments(request):
     c = unicodewriter.UnicodeDictWriter(response, field_names)
     c.writerow(field_names_d)
 
-    for p in payments:
+    for p in get_identity_map(request).attach_artists(payments):
         d = dict(
             paymentid=p.id, artistid=p.artist.artistid, name=p.artist.name(), artistname=p.artist.artistname(),
             date=p.date, type=p.payment_type.name, description=p.description, amount=p.amount)
@@ -167,7 +167,7 @@ def cheques(request):
     c = unicodewriter.UnicodeDictWriter(response, field_names)
     c.writerow(field_names_d)
 
-    for q in cheques:
+    for q in get_identity_map(request).attach_artists(cheques):
         d = dict(
             artistid=q.artist.artistid, name=q.artist.name(), artistname=q.artist.artistname(),
             payee=q.payee, date=q.date, number=q.number, amount=format_money(-q.amount))
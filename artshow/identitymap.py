@@ -0,0 +1,91 @@
+# Artshow Jockey
+# Copyright (C) 2009-2014 Chris Cogdon
+# See file COPYING for licence details
+
+from .models import Artist, BidderId, Person, IN_QUERY_CHUNK_SIZE
+
+
+def get_identity_map(request):
+    """The IdentityMap shared by everything rendered for this request."""
+    if not hasattr(request, '_artshow_identity_map'):
+        request._artshow_identity_map = IdentityMap()
+    return request._artshow_identity_map
+
+
+class IdentityMap(object):
+    """Holds the Artists, People and Bidders' BidderIds loaded during one request or job.
+
+    Reports that loop over pieces, bids, payments or cheques use attach_artists() and friends to point every row
+    at the one shared copy of its artist and person, so each of those is loaded at most once per report, in a
+    few IN queries, instead of lazily for every row.
+    """
+
+    def __init__(self):
+        self.artists = {}
+        self.people = {}
+        self.bidder_ids = {}
+
+    def _missing(self, ids, loaded):
+        return [x for x in set(ids) if x is not None and x not in loaded]
+
+    def load_artists(self, artist_ids):
+        missing = self._missing(artist_ids, self.artists)
+        for i in range(0, len(missing), IN_QUERY_CHUNK_SIZE):
+            for artist in Artist.objects.filter(pk__in=missing[i:i + IN_QUERY_CHUNK_SIZE]).select_related('person'):
+                person = self.people.setdefault(artist.person_id, artist.person)
+                artist.person = person
+                self.artists[artist.pk] = artist
+
+    def load_people(self, person_ids):
+        missing = self._missing(person_ids, self.people)
+        for i in range(0, len(missing), IN_QUERY_CHUNK_SIZE):
+            for person in Person.objects.filter(pk__in=missing[i:i + IN_QUERY_CHUNK_SIZE]):
+                self.people[person.pk] = person
+
+    def load_bidder_ids(self, bidder_ids):
+        missing = self._missing(bidder_ids, self.bidder_ids)
+        for bidder_id in missing:
+            self.bidder_ids[bidder_id] = []
+        for i in range(0, len(missing), IN_QUERY_CHUNK_SIZE):
+            for bidder_id, bidderid in BidderId.objects.filter(bidder__in=missing[i:i + IN_QUERY_CHUNK_SIZE]) \
+                    .order_by('id').values_list('bidder', 'id'):
+                self.bidder_ids[bidder_id].append(bidderid)
+
+    def artist(self, artist_id):
+        self.load_artists([artist_id])
+        return self.artists[artist_id]
+
+    def person(self, person_id):
+        self.load_people([person_id])
+        return self.people[person_id]
+
+    def attach_artists(self, objects, field='artist'):
+        """Set the artist (or other Artist foreign key named by field) on each object from the map, loading any
+        artists not seen before. Returns the objects as a list."""
+        objects = list(objects)
+        attname = field + '_id'
+        self.load_artists([getattr(o, attname) for o in objects])
+        for o in objects:
+            artist_id = getattr(o, attname)
+            if artist_id is not None:
+                setattr(o, field, self.artists[artist_id])
+        return objects
+
+    def attach_people(self, objects, field='person'):
+        """As attach_artists(), for a foreign key to Person."""
+        objects = list(objects)
+        attname = field + '_id'
+        self.load_people([getattr(o, attname) for o in objects])
+        for o in objects:
+            person_id = getattr(o, attname)
+            if person_id is not None:
+                setattr(o, field, self.people[person_id])
+        return objects
+
+    def attach_bidder_ids(self, bidders):
+        """Load the BidderIds of each bidder, to be returned by Bidder.bidder_ids(). Returns the bidders as a list."""
+        bidders = list(bidders)
+        self.load_bidder_ids([b.pk for b in bidders])
+        for bidder in bidders:
+            bidder._bidder_ids = self.bidder_ids[bidder.pk]
+        return bidders
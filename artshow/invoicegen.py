@@ -5,9 +5,8 @@
 
 from models import Invoice
 import sys
-import subprocess
 from .conf import settings
-from .conf import _DISABLED as SETTING_DISABLED
+from .printspooler import spool
 from StringIO import StringIO
 import re
 from logging import getLogger
@@ -75,10 +74,10 @@ def print_invoice ( invoice, copy_name="SINGLE COPY", dest=sys.stdout ):
 	bidderidpad = " " * ( 38 - len(bidderidstr) )
 	taxdescstr = settings.ARTSHOW_TAX_DESCRIPTION
 	
-	invoiceitems = invoice.invoiceitem_set.all().order_by ( 'piece__location', 'piece' )
+	invoiceitems = invoice.invoiceitem_set.select_related ( 'piece__artist__person' ).order_by ( 'piece__location', 'piece' )
 	invoicepayments = invoice.invoicepayment_set.all()
 	
-	numitems = len(invoiceitems)
+	numitems = invoice.item_count
 
 	buffer = StringIO()
 
@@ -161,9 +160,6 @@ def print_invoice ( invoice, copy_name="SINGLE COPY", dest=sys.stdout ):
 	dest.write ( s )
 
 
-class PrintingError ( StandardError ):
-	pass
-	
 def print_invoices ( invoices, copy_names, to_printer=False ):
 
 	sbuf = StringIO()
@@ -183,15 +179,6 @@ def print_invoices ( invoices, copy_names, to_printer=False ):
 	if not sbuf.getvalue():
 		logger.error ( "nothing to generate" )
 	elif to_printer:
-		if settings.ARTSHOW_PRINT_COMMAND is SETTING_DISABLED:
-			logger.error ( "Cannot print invoice. ARTSHOW_PRINT_COMMAND is DISABLED" )
-			raise PrintingError ( "Printing is DISABLED in configuration" )
-		p = subprocess.Popen ( settings.ARTSHOW_PRINT_COMMAND, stderr=subprocess.PIPE, stdout=subprocess.PIPE, stdin=subprocess.PIPE, shell=True )
-		output, error = p.communicate ( sbuf.getvalue() )
-		if output:
-			logger.debug ( "printing command returned: %s", output )
-		if error:
-			logger.error ( "printing command returned error: %s", error )
-			raise PrintingError ( error )
+		spool ( settings.ARTSHOW_INVOICE_PRINTER, sbuf.getvalue(), "Invoices %s" % ", ".join ( str(x) for x in invoices ) )
 	else:
 		sys.stdout.write ( sbuf.getvalue() )
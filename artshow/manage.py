@@ -170,7 +170,11 @@ def control_forms(request, artist_id):
 
 
 def requestspaceform_factory(artist):
+    allocations = dict((a.space_id, a) for a in artist.allocation_set.all())
+
     class RequestSpaceForm(forms.Form):
+        artist_allocations = allocations
+
         space = ModelChoiceField(queryset=Space.objects.all(), widget=HiddenInput)
         requested = forms.DecimalField(validators=[validate_space])
 
@@ -178,10 +182,7 @@ def requestspaceform_factory(artist):
             # We're going to use this to force a form to have initial data for this field.
             # so the template can go form.initial.space to get details on the space.
             space = self.cleaned_data['space']
-            try:
-                space.artist_allocation = space.allocation_set.get(artist=artist)
-            except Allocation.DoesNotExist:
-                space.artist_allocation = None
+            space.artist_allocation = allocations.get(space.id)
             self.initial['space'] = space
             return space
 
@@ -207,10 +208,7 @@ def spaces(request, artist_id):
 
     spaces = Space.objects.order_by('id')
     for s in spaces:
-        try:
-            s.artist_allocation = s.allocation_set.get(artist=artist)
-        except Allocation.DoesNotExist:
-            s.artist_allocation = None
+        s.artist_allocation = RequestSpaceForm.artist_allocations.get(s.id)
     spaces = [s for s in spaces if s.reservable == True or s.artist_allocation is not None]
 
     if request.method == "POST":
@@ -219,9 +217,8 @@ def spaces(request, artist_id):
             for form in formset:
                 space = form.cleaned_data['space']
                 requested = form.cleaned_data['requested']
-                try:
-                    allocation = Allocation.objects.get(artist=artist, space=space)
-                except Allocation.DoesNotExist:
+                allocation = RequestSpaceForm.artist_allocations.get(space.id)
+                if allocation is None:
                     # If the Allocation didn't exist and the space is not reservable, then this should
                     # have not been possible. Just raise it as a error message and keep moving.
                     if not space.reservable:
@@ -1,10 +1,12 @@
 from django.core.management.base import BaseCommand
+from django.utils.timezone import now
 from ...models import *
 
 
 class Command(BaseCommand):
     args = 'command [options ...]'
-    help = "Apply a command (applywonstatus)"
+    help = "Apply a command (applywonstatus, rebuildtopbids, verifyledgers, rebuildledgers, " \
+           "rebuildinvoicetotals, rebuildbiddersearch)"
 
     def handle(self, *args, **options):
 
@@ -15,11 +17,43 @@ class Command(BaseCommand):
     # noinspection PyUnusedLocal
     def command_applywonstatus(self, *args, **options):
 
-        for p in Piece.objects.filter(status=Piece.StatusInShow, voice_auction=False):
-            try:
-                top_bid = p.top_bid()
-            except Bid.DoesNotExist:
-                pass
+        Piece.objects.filter(status=Piece.StatusInShow, voice_auction=False, bid_count__gt=0) \
+            .update(status=Piece.StatusWon, updated=now())
+
+    # noinspection PyUnusedLocal
+    def command_rebuildtopbids(self, *args, **options):
+
+        num_changed = Piece.objects.rebuild_top_bids()
+        print "%d pieces had their top bid corrected" % num_changed
+
+    # noinspection PyUnusedLocal
+    def command_verifyledgers(self, *args, **options):
+
+        mismatches = ArtistLedger.objects.verify()
+        for artist_id, ledger, calculated in mismatches:
+            if ledger is None:
+                print "Artist %s: ledger missing" % artist_id
             else:
-                p.status = Piece.StatusWon
-                p.save()
+                stored_totals = ledger.totals()
+                for name, value in sorted(calculated.totals().items()):
+                    if stored_totals[name] != value:
+                        print "Artist %s: %s is %s, should be %s" % (artist_id, name, stored_totals[name], value)
+        print "%d ledgers incorrect" % len(mismatches)
+
+    # noinspection PyUnusedLocal
+    def command_rebuildledgers(self, *args, **options):
+
+        num_changed = ArtistLedger.objects.rebuild()
+        print "%d ledgers corrected" % num_changed
+
+    # noinspection PyUnusedLocal
+    def command_rebuildinvoicetotals(self, *args, **options):
+
+        num_changed = Invoice.objects.rebuild_totals()
+        print "%d invoices had their totals corrected" % num_changed
+
+    # noinspection PyUnusedLocal
+    def command_rebuildbiddersearch(self, *args, **options):
+
+        num_bidders = BidderSearchToken.objects.rebuild()
+        print "%d bidders indexed for searching" % num_bidders
@@ -0,0 +1,146 @@
+from optparse import make_option
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test.client import RequestFactory
+from django.db.models.loading import get_model
+from ...conf import settings
+from ...utils import QueryCounter
+from ...models import *
+from ... import cashier, processbatchscan, reports, workflows
+
+
+Person = get_model(*settings.ARTSHOW_PERSON_CLASS.split('.', 1))
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Time the printing workflow, report and batch scan queries against a large synthetic data set. " \
+           "Everything is done inside a transaction that is rolled back, so the database is left unchanged."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--artists', type="int", default=300, help="number of synthetic artists [%default]"),
+        make_option('--pieces', type="int", default=20, help="pieces per artist [%default]"),
+        make_option('--bidders', type="int", default=1000, help="number of synthetic bidders [%default]"),
+        make_option('--bids', type="int", default=3, help="bids per piece in show [%default]"),
+        make_option('--scanned', type="int", default=500, help="bids in the batch scan [%default]"),
+        make_option('--repeat', type="int", default=3, help="times to run each query, best is shown [%default]"),
+    )
+
+    def handle(self, *args, **options):
+        self.repeat = options['repeat']
+        try:
+            with transaction.atomic():
+                self.create_data(options)
+                self.run_benchmarks(options)
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def create_data(self, options):
+        start = time.time()
+        first_artistid = Artist.objects.allocate_artistids(options['artists'])
+        num_artists = options['artists']
+        num_bidders = options['bidders']
+
+        Person.objects.bulk_create([Person(name="Benchmark Person %d" % i, reg_id="BENCH%d" % i)
+                                    for i in range(num_artists + num_bidders)])
+        people = list(Person.objects.filter(reg_id__startswith="BENCH").order_by('id'))
+        Artist.objects.bulk_create([Artist(artistid=first_artistid + i, person=people[i])
+                                    for i in range(num_artists)])
+        Bidder.objects.bulk_create([Bidder(person=p) for p in people[num_artists:]])
+        bidders = list(Bidder.objects.filter(person__reg_id__startswith="BENCH").order_by('id'))
+        existing_ids = set(BidderId.objects.values_list('id', flat=True))
+        bidder_ids = []
+        next_id = 90000000
+        for bidder in bidders:
+            while str(next_id) in existing_ids:
+                next_id += 1
+            bidder_ids.append(BidderId(id=str(next_id), bidder=bidder))
+            next_id += 1
+        BidderId.objects.bulk_create(bidder_ids)
+        self.bidder_ids = [b.id for b in bidder_ids]
+
+        statuses = [Piece.StatusNotInShow, Piece.StatusNotInShowLocked, Piece.StatusInShow, Piece.StatusInShow,
+                    Piece.StatusInShow, Piece.StatusWon, Piece.StatusSold]
+        pieces = []
+        for a in range(num_artists):
+            for p in range(options['pieces']):
+                n = a * options['pieces'] + p
+                pieces.append(Piece(artist_id=first_artistid + a, pieceid=p + 1, code="%s-%s" % (a, p + 1),
+                                    name="Benchmark Piece", min_bid=10, status=statuses[n % len(statuses)],
+                                    adult=(n % 5 == 0), voice_auction=(n % 11 == 0), order=n % 7,
+                                    location="" if n % 3 else "P%d" % (n % 40),
+                                    bid_sheet_printing=n % 3, control_form_printing=(n + 1) % 3))
+        Piece.objects.bulk_create(pieces)
+
+        in_show = list(Piece.objects.filter(artist__artistid__gte=first_artistid, status=Piece.StatusInShow)
+                       .order_by('id').values_list('id', flat=True))
+        # Keep the last pieces free of bids, for the batch scan
+        self.scan_pieces = list(Piece.objects.filter(id__in=in_show[-options['scanned']:])
+                                .values_list('artist_id', 'pieceid'))
+        bids = []
+        for n, piece_id in enumerate(in_show[:-options['scanned']]):
+            for b in range(options['bids']):
+                bids.append(Bid(piece_id=piece_id, bidder=bidders[(n + b) % len(bidders)], amount=10 + b * 5))
+        Bid.objects.bulk_create(bids)
+        Piece.objects.rebuild_top_bids()
+        ArtistLedger.objects.rebuild()
+        BidderSearchToken.objects.rebuild()
+        self.stdout.write("Created %d artists, %d bidders, %d pieces and %d bids in %.2fs" %
+                          (num_artists, num_bidders, len(pieces), len(bids), time.time() - start))
+
+    def run_benchmarks(self, options):
+        user = get_user_model().objects.create(username="benchmarkqueries", is_superuser=True, is_staff=True)
+        factory = RequestFactory()
+
+        def view(func, path="/"):
+            def run():
+                request = factory.get(path)
+                request.user = user
+                func(request)
+            return run
+
+        scan_data = "\n".join("A%dP%d\nB%s\n10\nNS" % (artistid, pieceid, self.bidder_ids[n % len(self.bidder_ids)])
+                              for n, (artistid, pieceid) in enumerate(self.scan_pieces))
+
+        benchmarks = [
+            ("workflows.printing", view(workflows.printing)),
+            ("reports.artists", view(reports.artists)),
+            ("reports.winning_bidders", view(reports.winning_bidders)),
+            ("reports.panel_artist_report", view(reports.panel_artist_report)),
+            ("reports.artist_payment_report", view(reports.artist_payment_report)),
+            ("reports.show_summary", view(reports.show_summary)),
+            ("reports.voice_auction", view(reports.voice_auction)),
+            ("reports.sales_percentiles", view(reports.sales_percentiles)),
+            ("processbatchscan.process_bids", lambda: processbatchscan.process_bids(scan_data, final_scan=True)),
+            ("processbatchscan.process_bids bulk",
+             lambda: processbatchscan.process_bids(scan_data, final_scan=True, bulk=True)),
+            ("processbatchscan.dry_run", lambda: processbatchscan.dry_run(3, scan_data)),
+            ("cashier.cashier_search", view(cashier.cashier_search, "/?q=benchmark pers")),
+        ]
+        for name, func in benchmarks:
+            best = None
+            for i in range(self.repeat):
+                elapsed, num_queries = self.time_isolated(func)
+                if best is None or elapsed < best:
+                    best = elapsed
+            self.stdout.write("%-35s %8.1fms %6d queries" % (name, best * 1000, num_queries))
+
+    def time_isolated(self, func):
+        """Run func, returning the time taken and number of queries, and roll back any changes it made."""
+        try:
+            with transaction.atomic():
+                with QueryCounter() as queries:
+                    start = time.time()
+                    func()
+                    elapsed = time.time() - start
+                raise Rollback()
+        except Rollback:
+            pass
+        return elapsed, queries.count
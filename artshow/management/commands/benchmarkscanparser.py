@@ -0,0 +1,80 @@
+from optparse import make_option
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from ...models import Piece
+from ... import processbatchscan
+from ...scanemulator import bids_lines, locations_lines
+
+
+class MemoryStore(object):
+    """A store that keeps everything in memory and accepts every bid, so that only the tokenizer and state
+    machine are timed."""
+
+    def __init__(self, tokens=None):
+        self.pieces = {}
+
+    def get_piece(self, artistid, pieceid):
+        try:
+            return self.pieces[(artistid, pieceid)]
+        except KeyError:
+            piece = self.pieces[(artistid, pieceid)] = Piece(artist_id=artistid, pieceid=pieceid)
+            return piece
+
+    def get_bidder_id(self, bidderid):
+        return int(bidderid)
+
+    def count_bids(self, piece):
+        return 0
+
+    def is_top_bid(self, piece, bidder_id, amount):
+        return False
+
+    def validate_bid(self, bid):
+        pass
+
+    def save_bid(self, bid):
+        pass
+
+    def save_piece(self, piece):
+        pass
+
+    def flush(self):
+        pass
+
+
+class Command(BaseCommand):
+    help = "Time the batch scan tokenizer and state machine against a large synthetic scan log. " \
+           "The database is not used."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--lines', type="int", default=100000, help="approximate lines in each scan log [%default]"),
+        make_option('--repeat', type="int", default=3, help="times to run each benchmark, best is shown [%default]"),
+    )
+
+    def handle(self, *args, **options):
+        rnd = random.Random(0)
+        num_lines = options['lines']
+        logs = [
+            ("locations", processbatchscan.locations_batch, "\n".join(locations_lines(rnd, num_lines))),
+            ("bids", processbatchscan.bids_batch, "\n".join(bids_lines(rnd, num_lines))),
+        ]
+        for name, batch_type, data in logs:
+            lines = data.count("\n") + 1
+            tokenize = self.best_of(options['repeat'], lambda: batch_type.tokenizer.tokenize(data))
+            tokens = batch_type.tokenizer.tokenize(data)
+            run = self.best_of(options['repeat'], lambda: batch_type.run(processbatchscan.Scan(MemoryStore()), tokens))
+            self.stdout.write("%-10s %8d lines  tokenize %10.0f lines/s  state machine %10.0f lines/s" %
+                              (name, lines, lines / tokenize, lines / run))
+
+    @staticmethod
+    def best_of(repeat, func):
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            func()
+            elapsed = max(time.time() - start, 1e-6)
+            if best is None or elapsed < best:
+                best = elapsed
+        return best
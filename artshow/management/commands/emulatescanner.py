@@ -0,0 +1,96 @@
+from optparse import make_option
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import now
+from ... import scanemulator
+
+
+class Command(BaseCommand):
+    args = '[recording ...]'
+    help = "Emulate scanners, for scannerreader to read, sending synthetic scans, or the batches in the " \
+           "recordings given, which are files of scan lines with a blank line between batches. Then report the " \
+           "latency from each batch being scanned to its batch scan being saved and processed. The saved " \
+           "latency includes scannerreader's --timeout."
+
+    option_list = BaseCommand.option_list + (
+        make_option("--scanners", type="int", default=1, help="number of scanners to emulate [%default]"),
+        make_option("--batchtype", type="int", default=None,
+                    help="the type of batch: 1 locations, 2 intermediate bids, 3 final bids. Synthetic scans "
+                         "are final bids if not given"),
+        make_option("--batches", type="int", default=10,
+                    help="synthetic batches to send from each scanner [%default]"),
+        make_option("--lines", type="int", default=50, help="approximate lines in each synthetic batch [%default]"),
+        make_option("--rate", type="float", default=10.0, help="lines scanned per second [%default]"),
+        make_option("--burst", type="int", default=0,
+                    help="send the lines this many at a time, as fast as possible, instead of at --rate"),
+        make_option("--burst-pause", type="float", default=1.0, help="seconds between bursts [%default]"),
+        make_option("--gap", type="float", default=7.0,
+                    help="seconds between batches. Must be more than scannerreader's --timeout [%default]"),
+        make_option("--jitter", type="float", default=0.0,
+                    help="vary each wait randomly by up to this fraction of itself [%default]"),
+        make_option("--malformed", type="float", default=0.0,
+                    help="fraction of lines to damage, as if misread [%default]"),
+        make_option("--seed", type="int", default=None, help="random seed, to repeat a run"),
+        make_option("--delay", type="float", default=5.0,
+                    help="seconds to wait before scanning, to start scannerreader on the scanners [%default]"),
+        make_option("--wait", type="float", default=30.0,
+                    help="seconds to wait after scanning for the batch scans to be saved, or processed [%default]"),
+        make_option("--queue", action="store_true", default=False,
+                    help="queue each batch scan for processbatchscans as soon as it is saved, and report the "
+                         "latency to its processing finishing"),
+    )
+
+    def handle(self, *args, **options):
+        batchtype = options['batchtype']
+        if batchtype not in (None, 1, 2, 3):
+            raise CommandError("--batchtype must be 1, 2 or 3")
+        if options['queue'] and args and batchtype is None:
+            raise CommandError("--queue needs a --batchtype for recordings")
+        rnd = random.Random(options['seed'])
+
+        if args:
+            recorded = []
+            for path in args:
+                with open(path) as f:
+                    recorded += scanemulator.recorded_batches(f)
+        else:
+            if batchtype is None:
+                batchtype = 3
+            pieces, bidder_ids = scanemulator.show_codes()
+            recorded = None
+
+        scanners = [scanemulator.EmulatedScanner() for i in range(options['scanners'])]
+        try:
+            scanners_batches = []
+            for n, scanner in enumerate(scanners):
+                if recorded is None:
+                    batches = scanemulator.synthetic_batches(rnd, batchtype, options['batches'], options['lines'],
+                                                             pieces, bidder_ids)
+                else:
+                    # The recorded batches are dealt out to the scanners in turn
+                    batches = recorded[n::len(scanners)]
+                scanners_batches.append((scanner, batches))
+            pacing = scanemulator.Pacing(rate=options['rate'], burst=options['burst'],
+                                         burst_pause=options['burst_pause'], gap=options['gap'],
+                                         jitter=options['jitter'])
+            start = time.time() + options['delay']
+            sent_batches, events = scanemulator.schedule(rnd, scanners_batches, pacing, start, options['malformed'],
+                                                         batchtype)
+
+            self.stdout.write("scanners: %s" % " ".join(scanner.name for scanner in scanners))
+            self.stdout.write("start scannerreader with: %s" % " ".join("--device %s" % scanner.name
+                                                                       for scanner in scanners))
+            self.stdout.write("scanning %d batches in %.0fs" % (len(sent_batches), options['delay']))
+
+            collector = scanemulator.Collector(sent_batches, now(), queue=options['queue'])
+            scanemulator.send(events, poll=collector.poll)
+            self.stdout.write("scanning done, waiting for batch scans")
+            collector.wait(options['wait'])
+        finally:
+            for scanner in scanners:
+                scanner.close()
+
+        for line in scanemulator.report(sent_batches):
+            self.stdout.write(line)
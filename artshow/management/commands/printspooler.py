@@ -0,0 +1,49 @@
+from optparse import make_option
+import os
+import socket
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from ...models import PrintJob
+from ... import printspooler
+
+
+class Command(BaseCommand):
+    args = ''
+    help = "Send the print jobs queued by the cashier and bidder registration to their printers, in the order " \
+           "they were queued, retrying those that fail. Run one of these for each printer, or one for them all."
+
+    option_list = BaseCommand.option_list + (
+        make_option("--printer", action="append", default=[],
+                    help="print the jobs for this printer. May be repeated. All the printers configured if not "
+                         "given"),
+        make_option("--once", action="store_true", default=False,
+                    help="exit when there are no print jobs ready, instead of waiting for more"),
+        make_option("--poll", type="float", default=1.0,
+                    help="seconds between checks for newly queued print jobs [%default]"),
+        make_option("--timeout", type="float", default=120.0,
+                    help="seconds to let the print command run before it is killed, and the job retried. A job "
+                         "left printing for longer by a spooler that stopped is retried too [%default]"),
+    )
+
+    def handle(self, *args, **options):
+        printers = options['printer'] or printspooler.printers()
+        if not printers:
+            raise CommandError("No printers are configured. Set ARTSHOW_PRINT_COMMAND or ARTSHOW_PRINTERS")
+        for printer in printers:
+            if printspooler.print_command(printer) is None:
+                raise CommandError("Printer %s is not configured" % printer)
+        worker = "%s:%d" % (socket.gethostname(), os.getpid())
+        self.stdout.write("printing to: %s" % " ".join(printers))
+        while True:
+            job = PrintJob.objects.claim_next(printers, worker, stale_after=options['timeout'])
+            if job is None:
+                if options['once']:
+                    break
+                time.sleep(options['poll'])
+                continue
+            if printspooler.print_job(job, options['timeout']):
+                self.stdout.write("%s: printed %s on %s" % (job, job.description, job.printer))
+            else:
+                self.stderr.write("%s: %s, attempt %d: %s" % (job, job.get_status_display(), job.attempts,
+                                                               job.error))
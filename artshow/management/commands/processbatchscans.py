@@ -0,0 +1,50 @@
+from optparse import make_option
+import os
+import socket
+import time
+import traceback
+
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+from ...models import BatchScan
+from ...processbatchscan import process_batchscan
+
+
+class Command(BaseCommand):
+    args = ''
+    help = "Process the batch scans queued from the admin. Several of these can run at once."
+
+    option_list = BaseCommand.option_list + (
+        make_option("--once", action="store_true", default=False,
+                    help="exit when there are no more queued batch scans, instead of waiting for more"),
+        make_option("--poll", type="float", default=2.0,
+                    help="seconds between checks for newly queued batch scans [%default]"),
+        make_option("--direct", action="store_true", default=False,
+                    help="save each bid and piece as it is scanned, instead of in bulk"),
+    )
+
+    def handle(self, *args, **options):
+        worker = "%s:%d" % (socket.gethostname(), os.getpid())
+        while True:
+            batchscan = BatchScan.objects.claim_next(worker)
+            if batchscan is None:
+                if options['once']:
+                    break
+                time.sleep(options['poll'])
+                continue
+            self.stdout.write("%s: processing" % batchscan)
+            try:
+                process_batchscan(batchscan.id, bulk=not options['direct'])
+            except Exception:
+                log_str = traceback.format_exc()
+                BatchScan.objects.filter(id=batchscan.id).update(status=BatchScan.StatusFailed, finished=now(),
+                                                                 processing_log=log_str)
+                self.stderr.write("%s: failed\n%s" % (batchscan, log_str))
+            else:
+                batchscan = BatchScan.objects.get(id=batchscan.id)
+                if batchscan.wall_time is None:
+                    self.stdout.write("%s: %s" % (batchscan, batchscan.get_status_display()))
+                else:
+                    self.stdout.write("%s: %s, %d lines in %.2fs, %d queries" % (
+                        batchscan, batchscan.get_status_display(), batchscan.lines_processed, batchscan.wall_time,
+                        batchscan.query_count))
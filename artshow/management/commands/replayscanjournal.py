@@ -0,0 +1,33 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from ...conf import _DISABLED as SETTING_DISABLED
+from ... import scanjournal
+
+
+class Command(BaseCommand):
+    args = '[journal]'
+    help = "Save a batch scan for each batch in the scanner journal that scannerreader didn't get to save"
+
+    option_list = BaseCommand.option_list + (
+        make_option("--dry-run", action="store_true", default=False,
+                    help="list the batches that would be recovered, without saving them"),
+    )
+
+    def handle(self, *args, **options):
+        if args:
+            path = args[0]
+        elif settings.ARTSHOW_SCANNER_JOURNAL is not SETTING_DISABLED:
+            path = settings.ARTSHOW_SCANNER_JOURNAL
+        else:
+            raise CommandError("no journal given, and ARTSHOW_SCANNER_JOURNAL is not set")
+
+        if options['dry_run']:
+            for batch in scanjournal.find_unsaved_batches(path):
+                self.stdout.write("%s: %d lines at offset %d, begun %s" % (batch.device, len(batch.lines),
+                                                                           batch.offset, batch.begun))
+        else:
+            for batchscan in scanjournal.replay(path):
+                self.stdout.write("%s: %s recovered, %d lines" % (batchscan.device, batchscan,
+                                                                 batchscan.data.count("\n")))
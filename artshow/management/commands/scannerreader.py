@@ -1,46 +1,182 @@
 from optparse import make_option
+import errno
+import os
 import select
+import time
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 from django.utils.timezone import now
 
+from ...conf import _DISABLED as SETTING_DISABLED
 from ...models import BatchScan
+from ...processbatchscan import BATCH_TYPES, StreamProcessor
+from ...scanjournal import ScanJournal
+
+
+class ScannerDevice(object):
+    """One connected scanner, with the batch being read from it."""
+
+    def __init__(self, name, batchtype=None, journal=None):
+        self.name = name
+        self.journal = journal
+        # TODO find out why buffering=0 (no buffering) is required.
+        self.f = open(name, buffering=0)
+        # What has been read from the scanner after the last complete line.
+        self.buffer = ""
+        self.batchtype = batchtype
+        self.data = None
+        self.processor = None
+        self.last_read = None
+        self.journal_offset = None
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def read_lines(self):
+        """Read what the scanner has sent, once select() says there is something to read, without waiting for
+        the rest of a line. Returns the complete lines read, or None if the scanner has disconnected, after
+        which the last line, even if incomplete, is returned by the next call."""
+        try:
+            chunk = os.read(self.fileno(), 4096)
+        except OSError, x:
+            # Reading a pseudo-terminal, such as emulatescanner's, fails once its other end is closed.
+            if x.errno != errno.EIO:
+                raise
+            chunk = ""
+        if not chunk:
+            return None
+        lines = (self.buffer + chunk).split("\n")
+        self.buffer = lines.pop()
+        return lines
+
+    def remaining_lines(self):
+        """The incomplete line left once the scanner has disconnected, as a list."""
+        lines = [self.buffer] if self.buffer else []
+        self.buffer = ""
+        return lines
+
+    def start_batch(self):
+        self.data = []
+        if self.journal:
+            self.journal_offset = self.journal.begin(self.name, self.batchtype)
+        if self.batchtype is not None:
+            self.processor = StreamProcessor(self.batchtype)
+
+    def add_line(self, l):
+        if self.journal:
+            self.journal.line(self.name, l)
+        self.data.append(l)
+
+    def end_batch(self):
+        """Save the batch read so far, returning the BatchScan."""
+        if self.processor:
+            batchscan = self.processor.save(date_scanned=now(), device=self.name, journal_offset=self.journal_offset)
+        else:
+            data_str = "\n".join(self.data) + "\n"
+            batchscan = BatchScan(data=data_str, date_scanned=now(), device=self.name,
+                                  journal_offset=self.journal_offset)
+            batchscan.save()
+        if self.journal:
+            self.journal.saved(self.name, batchscan)
+        self.data = None
+        self.processor = None
+        return batchscan
 
 
 class Command(BaseCommand):
     args = ''
-    help = "Monitor connected scanner"
+    help = "Monitor connected scanners"
 
     option_list = BaseCommand.option_list + (
-        make_option("--device", type="string", action="append", default=settings.ARTSHOW_SCANNER_DEVICE,
-                    help="scanner device name [%default]"),
+        make_option("--device", type="string", action="append", default=[],
+                    help="scanner device name. Give more than once to monitor several scanners "
+                         "[ARTSHOW_SCANNER_DEVICE]"),
+        make_option("--stream", action="store_true", default=False,
+                    help="apply each block as soon as it is scanned, instead of saving the batch to be processed "
+                         "later"),
+        make_option("--batchtype", type="int", default=None,
+                    help="with --stream, the type of batch being scanned: 1 locations, 2 intermediate bids, "
+                         "3 final bids, 4 bidder ID allocation"),
+        make_option("--timeout", type="float", default=5.0,
+                    help="seconds a scanner must be quiet to end its batch [%default]"),
+        make_option("--journal", type="string", default=None,
+                    help="file to journal every scanned line to, for replayscanjournal [ARTSHOW_SCANNER_JOURNAL]"),
     )
 
     def handle(self, *args, **options):
-        device = options['device']
-        # TODO find out why buffering=0 (no buffering) is required.
-        f = open(device, buffering=0)
-
-        while True:
-            data = []
-            print "waiting for new data"
-            l = f.readline()
-            print "\a"
-            while True:
-                if not l:
-                    print "oops. no data to read. wtf?"
-                l = l.strip()
-                if l:
-                    data.append(l)
-                print l
-                rlist, wlist, xlist = select.select([f], [], [f], 5.0)
-                if not rlist and not xlist:
-                    break
-                l = f.readline()
-            print "timed out"
-            print "\a"
-            data_str = "\n".join(data) + "\n"
-            batchscan = BatchScan(data=data_str, date_scanned=now())
-            batchscan.save()
-            print str(batchscan), "saved"
+        names = options['device']
+        if not names:
+            names = settings.ARTSHOW_SCANNER_DEVICE
+            if names is SETTING_DISABLED:
+                raise CommandError("no --device given, and ARTSHOW_SCANNER_DEVICE is not set")
+            if isinstance(names, basestring):
+                names = [names]
+        stream = options['stream']
+        if stream and options['batchtype'] not in BATCH_TYPES:
+            raise CommandError("--stream needs a --batchtype of 1, 2, 3 or 4")
+        quiet_time = options['timeout']
+        journal_path = options['journal'] or settings.ARTSHOW_SCANNER_JOURNAL
+        journal = None if journal_path is SETTING_DISABLED else ScanJournal(journal_path)
+
+        devices = [ScannerDevice(name, options['batchtype'] if stream else None, journal) for name in names]
+        print "waiting for new data on %s" % ", ".join(names)
+        while devices:
+            # Wait until a scanner sends a line, or the next batch being read times out.
+            deadlines = [d.last_read + quiet_time for d in devices if d.data is not None]
+            timeout = max(min(deadlines) - time.time(), 0) if deadlines else None
+            rlist, wlist, xlist = select.select(devices, [], devices, timeout)
+
+            for device in set(rlist + xlist):
+                lines = device.read_lines()
+                if lines is None:
+                    for l in device.remaining_lines():
+                        self.add_line(device, l)
+                    print "%s: no data to read, closing" % device.name
+                    if device.data is not None:
+                        self.end_batch(device)
+                    device.f.close()
+                    devices.remove(device)
+                    continue
+                for l in lines:
+                    self.add_line(device, l)
+                if device.data is not None:
+                    # The batch isn't quiet while the rest of a line is arriving.
+                    device.last_read = time.time()
+
+            for device in devices:
+                if device.data is not None and time.time() - device.last_read >= quiet_time:
+                    print "%s: timed out\a" % device.name
+                    self.end_batch(device)
+
+    def add_line(self, device, l):
+        if device.data is None:
+            print "%s: \a" % device.name
+            device.start_batch()
+        device.last_read = time.time()
+        l = l.strip()
+        if l:
+            device.add_line(l)
+        print "%s: %s" % (device.name, l)
+        if device.processor:
+            self.report_blocks(device, device.processor.feed(l))
+
+    def end_batch(self, device):
+        if device.processor:
+            processor = device.processor
+            self.report_blocks(device, processor.finish())
+            batchscan = device.end_batch()
+            print "%s: %s saved, %d blocks applied, %d failed" % (device.name, batchscan, processor.blocks_applied,
+                                                                   len(processor.failed_blocks))
+        else:
+            batchscan = device.end_batch()
+            print "%s: %s saved" % (device.name, batchscan)
+
+    def report_blocks(self, device, results):
+        for errors, lines in results:
+            if errors:
+                print "%s: \aFAILED: %s" % (device.name, " ".join(lines))
+                for error in errors:
+                    print "    %s" % error
+            else:
+                print "%s: OK: %s" % (device.name, " ".join(lines))
@@ -2,17 +2,22 @@
 # Copyright (C) 2009, 2010 Chris Cogdon
 # See file COPYING for licence details
 
-__all__ = ["Allocation", "Artist", "ArtistManager", "BatchScan", "Bid", "Bidder", "BidderId",
-           "Checkoff", "ChequePayment", "EmailSignature", "EmailTemplate", "Event", "Invoice", "InvoiceItem",
-           "InvoicePayment", "Payment", "PaymentType", "Piece", "Person", "Product", "Space", "Task",
-           "Agent", "validate_space", "validate_space_increments"]
-
-from django.db import models
-from django.db.models import Sum, Q
+__all__ = ["Allocation", "Artist", "ArtistLedger", "ArtistManager", "BatchScan", "Bid", "Bidder", "BidderId",
+           "BidderManager", "BidderSearchToken", "Checkoff", "ChequePayment", "EmailSignature", "EmailTemplate", "Event", "IdSequence", "Invoice",
+           "InvoiceItem", "InvoiceManager", "InvoicePayment", "Payment", "PaymentType", "Piece", "PieceManager", "Person", "PrintJob", "Product", "Space", "SpaceManager",
+           "Task", "Agent", "validate_space", "validate_space_increments"]
+
+from django.db import models, transaction
+from django.utils import timezone
+from django.db.models import Sum, Max, Count, Q
 from django.core.exceptions import ValidationError
 from . import mod11codes
 from django.contrib.auth.models import User
 from decimal import Decimal
+import datetime
+import hashlib
+import re
+import unicodedata
 from .conf import settings
 
 from django.db.models.loading import get_model
@@ -34,7 +39,20 @@ def validate_space_increments(value, allow_half_spaces):
             raise ValidationError("Spaces must be in whole increments")
 
 
+class SpaceManager (models.Manager):
+    def with_totals(self, queryset=None):
+        """Spaces annotated with their allocated_total and requested_total, so that allocated(), remaining()
+        and waiting() need no further queries."""
+        if queryset is None:
+            queryset = self.get_query_set()
+        return queryset.annotate(allocated_total=Sum('allocation__allocated'),
+                                 requested_total=Sum('allocation__requested'))
+
+
 class Space(models.Model):
+
+    objects = SpaceManager()
+
     name = models.CharField(max_length=20)
     shortname = models.CharField(max_length=8)
     description = models.TextField(blank=True)
@@ -48,7 +66,10 @@ class Space(models.Model):
 
 
     def allocated(self):
-        allocated = self.allocation_set.aggregate(sum=Sum('allocated'))['sum']
+        if hasattr(self, 'allocated_total'):
+            allocated = self.allocated_total
+        else:
+            allocated = self.allocation_set.aggregate(sum=Sum('allocated'))['sum']
         if allocated is None:
             return 0
         else:
@@ -58,7 +79,10 @@ class Space(models.Model):
         return self.available - self.allocated()
 
     def waiting(self):
-        data = self.allocation_set.aggregate(allocated=Sum('allocated'), requested=Sum('requested'))
+        if hasattr(self, 'allocated_total') and hasattr(self, 'requested_total'):
+            data = {'allocated': self.allocated_total, 'requested': self.requested_total}
+        else:
+            data = self.allocation_set.aggregate(allocated=Sum('allocated'), requested=Sum('requested'))
         if data['allocated'] is None or data['requested'] is None:
             return 0
         else:
@@ -68,6 +92,39 @@ class Space(models.Model):
         return self.name
 
 
+class IdSequenceManager (models.Manager):
+    def allocate(self, name, count=1, start=None):
+        """Reserve count consecutive values from the named sequence, returning the first.
+
+        The sequence is advanced before it is read, which takes the write lock on its row (or on the whole
+        database, with SQLite) until the end of the transaction, so parallel callers are given separate values
+        without having to search the table the values are used in. If the sequence does not exist yet, it is
+        created starting at start(), or 1."""
+        with transaction.atomic():
+            if not self.filter(name=name).update(next_value=models.F('next_value') + count):
+                first = start() if start else 1
+                sequence, created = self.get_or_create(name=name, defaults={'next_value': first + count})
+                if not created:
+                    self.filter(name=name).update(next_value=models.F('next_value') + count)
+            next_value = self.filter(name=name).values_list('next_value', flat=True).get()
+        return next_value - count
+
+    def advance_past(self, name, value):
+        """Make sure the named sequence will not hand out value, which has been used directly."""
+        self.filter(name=name, next_value__lte=value).update(next_value=value + 1)
+
+
+class IdSequence (models.Model):
+    """The next value to hand out for an ID that is not an AutoField, such as Artist.artistid."""
+    objects = IdSequenceManager()
+
+    name = models.CharField(max_length=20, primary_key=True)
+    next_value = models.IntegerField()
+
+    def __unicode__(self):
+        return u"%s: %s" % (self.name, self.next_value)
+
+
 class Checkoff (models.Model):
     name = models.CharField(max_length=100)
     shortname = models.CharField(max_length=100)
@@ -87,6 +144,11 @@ class ArtistManager (models.Manager):
         # TODO. find out if "distinct" is really needed here
         return self.get_query_set().filter(Q(agent__in=accessors) | Q(person__user=user)).distinct()
 
+    def allocate_artistids(self, count=1):
+        """Reserve count consecutive, unused artist IDs, eg, for a bulk import. Returns the first."""
+        return IdSequence.objects.allocate('artist', count,
+                                           start=lambda: (self.aggregate(m=Max('artistid'))['m'] or 0) + 1)
+
 
 class Artist (models.Model):
 
@@ -122,27 +184,28 @@ class Artist (models.Model):
         return [x[0] for x in self.piece_set.exclude(status__in=[Piece.StatusNotInShow, Piece.StatusNotInShowLocked])
         .distinct().values_list("location")]
 
+    def get_ledger(self):
+        """The artist's ArtistLedger. Every artist is given one when created, but if it is missing, as after
+        loading fixtures, it is calculated without being saved. Use "artshowctl rebuildledgers" to save it."""
+        try:
+            return self.ledger
+        except ArtistLedger.DoesNotExist:
+            self.ledger = ArtistLedger.objects.calculate_all([self.artistid])[self.artistid]
+            return self.ledger
+
     def balance(self):
-        return self.payment_set.aggregate(balance=Sum('amount'))['balance'] or 0
+        return self.get_ledger().balance
 
     def deduction_remaining_with_details(self):
         """Calculate space fee reduction remaining. Takes into account spaces reserved, space fees already applied"""
-        total_requested_cost = 0
-        for a in self.allocation_set.all():
-            total_requested_cost += a.space.price * a.requested
-        space_fee = PaymentType(id=settings.ARTSHOW_SPACE_FEE_PK)
-        # Deductions from accounts are always negative, so we re-negate it.
-        deduction_to_date = - (
-            self.payment_set.filter(payment_type=space_fee).aggregate(amount=Sum("amount"))["amount"] or 0)
-        deduction_remaining = max(total_requested_cost - deduction_to_date, 0)
-        return total_requested_cost, deduction_to_date, deduction_remaining
+        ledger = self.get_ledger()
+        return ledger.requested_cost, ledger.deduction_to_date, ledger.deduction_remaining
 
     def payment_remaining_with_details(self):
         """Calculate remaining payment expected, based on negative balance, plus any space reservations as yet
         unaccounted for."""
-        total_requested_cost, deduction_to_date, deduction_remaining = self.deduction_remaining_with_details()
-        payment_remaining = max(deduction_remaining - self.balance(), 0)
-        return total_requested_cost, deduction_to_date, deduction_remaining, payment_remaining
+        ledger = self.get_ledger()
+        return ledger.requested_cost, ledger.deduction_to_date, ledger.deduction_remaining, ledger.payment_remaining
 
     def __unicode__(self):
         return "%s (%s)" % (self.artistname(), self.artistid)
@@ -161,11 +224,9 @@ class Artist (models.Model):
 
     def save(self, **kwargs):
         if self.artistid is None:
-            try:
-                highest_idd_artist = Artist.objects.order_by('-artistid')[0]
-                self.artistid = highest_idd_artist.artistid + 1
-            except IndexError:
-                self.artistid = 1
+            self.artistid = Artist.objects.allocate_artistids()
+        elif self._state.adding:
+            IdSequence.objects.advance_past('artist', self.artistid)
         super(Artist,self).save(**kwargs)
 
     class Meta:
@@ -200,7 +261,57 @@ class Allocation(models.Model):
         unique_together = (('artist', 'space'), )
 
 
+# Keep "IN" lists below the SQLite limit on query parameters.
+IN_QUERY_CHUNK_SIZE = 500
+
+
+def _winning_bids(bidder_pks, unsold_only):
+    """The top bids of the bidders with the given pks, each with its piece, artist and artist's person."""
+    pieces = Piece.objects.filter(current_bidder__in=bidder_pks).select_related('current_bid', 'artist__person')
+    if unsold_only:
+        pieces = pieces.exclude(status=Piece.StatusSold)
+    for piece in pieces.order_by('current_bid'):
+        bid = piece.current_bid
+        bid.piece = piece
+        yield bid
+
+
+def load_winnings(bidders, unsold_only=False):
+    """Attach the winning bids and bidder IDs to each of the given bidders, using a fixed number of queries
+    per IN_QUERY_CHUNK_SIZE bidders. Winning bids come with their piece, artist and artist's person.
+    Returns the bidders as a list."""
+    bidders = list(bidders)
+    bidders_by_id = {}
+    for bidder in bidders:
+        bidder._top_bids = []
+        bidder._top_bids_unsold_only = unsold_only
+        bidder._bidder_ids = []
+        bidders_by_id[bidder.pk] = bidder
+    bidder_pks = bidders_by_id.keys()
+    for i in range(0, len(bidder_pks), IN_QUERY_CHUNK_SIZE):
+        chunk = bidder_pks[i:i + IN_QUERY_CHUNK_SIZE]
+        for bid in _winning_bids(chunk, unsold_only):
+            bidder = bidders_by_id[bid.piece.current_bidder_id]
+            bid.bidder = bidder
+            bidder._top_bids.append(bid)
+        for bidder_id, bidder_pk in BidderId.objects.filter(bidder__in=chunk).order_by('id') \
+                .values_list('id', 'bidder'):
+            bidders_by_id[bidder_pk]._bidder_ids.append(bidder_id)
+    return bidders
+
+
+class BidderManager (models.Manager):
+    def with_winnings(self, queryset=None, unsold_only=False):
+        """Bidders from queryset (or all bidders) as a list, with their top_bids() and bidder_ids() preloaded."""
+        if queryset is None:
+            queryset = self.get_query_set()
+        return load_winnings(queryset.select_related('person'), unsold_only=unsold_only)
+
+
 class Bidder (models.Model):
+
+    objects = BidderManager()
+
     person = models.OneToOneField(settings.ARTSHOW_PERSON_CLASS)
 
     def name(self):
@@ -209,19 +320,23 @@ class Bidder (models.Model):
     notes = models.TextField(blank=True)
 
     def bidder_ids(self):
-        return [b_id.id for b_id in self.bidderid_set.all().order_by('id')]
+        if hasattr(self, '_bidder_ids'):
+            return self._bidder_ids
+        # Sorted here, rather than by the query, so that a prefetched bidderid_set can be used.
+        return sorted(b_id.id for b_id in self.bidderid_set.all())
 
     def top_bids(self, unsold_only=False):
-        results = []
-        bids = self.bid_set.filter(invalid=False)
-        for b in bids:
-            if b.is_top_bid and (not unsold_only or b.piece.status != Piece.StatusSold):
-                results.append(b)
-        return results
+        """The bidder's top bids. Those attached by load_winnings() or with_winnings() are used if loaded with
+        the same unsold_only, otherwise they are queried each time, so are never stale."""
+        if getattr(self, '_top_bids_unsold_only', None) == unsold_only:
+            return self._top_bids
+        bids = list(_winning_bids([self.pk], unsold_only))
+        for bid in bids:
+            bid.bidder = self
+        return bids
 
     def __unicode__(self):
-        ids = [bidderid.id for bidderid in self.bidderid_set.all()]
-        return "%s (%s)" % (self.person.name, ",".join(ids))
+        return "%s (%s)" % (self.person.name, ",".join(self.bidder_ids()))
 
     class Meta:
         permissions = (
@@ -243,8 +358,156 @@ class BidderId (models.Model):
         return "BidderId %s (%s)" % (self.id, self.bidder.person.name)
 
 
+def search_tokens(text):
+    """Split text into words for the bidder search index, in lower case and without accents."""
+    text = unicodedata.normalize('NFKD', unicode(text))
+    text = u"".join(c for c in text if not unicodedata.combining(c)).lower()
+    return re.findall(r'\w+', text, re.UNICODE)
+
+
+class BidderSearchTokenManager (models.Manager):
+    @staticmethod
+    def _tokens(bidders):
+        tokens = []
+        for bidder in bidders:
+            person = bidder.person
+            words = set(word[:BidderSearchToken.MAX_LENGTH] for word in
+                        search_tokens(person.name) + search_tokens(getattr(person, 'reg_id', "")))
+            tokens += [BidderSearchToken(bidder=bidder, token=word) for word in words]
+        return tokens
+
+    def index(self, bidders):
+        """Replace the search tokens of the bidders with ones made from their names and reg IDs."""
+        bidders = list(bidders)
+        bidder_pks = [bidder.pk for bidder in bidders]
+        for i in range(0, len(bidder_pks), IN_QUERY_CHUNK_SIZE):
+            self.filter(bidder__in=bidder_pks[i:i + IN_QUERY_CHUNK_SIZE]).delete()
+        self.bulk_create(self._tokens(bidders))
+
+    def rebuild(self):
+        """Rebuild the search index for every bidder. Returns the number of bidders indexed."""
+        bidders = list(Bidder.objects.select_related('person'))
+        with transaction.atomic():
+            self.all().delete()
+            self.bulk_create(self._tokens(bidders))
+        return len(bidders)
+
+    def search(self, text, limit=20):
+        """Return up to limit bidders, ordered by name, that match every word of text, with their bidder_ids()
+        and num_won and num_sold, the numbers of pieces they have won and not paid for, and have paid for.
+
+        A word matches if it is the start of a word of the bidder's name or reg ID, or the start of one of their
+        bidder IDs. This takes three queries, however many bidders are found. On PostgreSQL, the prefix indexes
+        made by migration 0052 let the start of words be matched with an index whatever the collation."""
+        words = search_tokens(text)
+        if not words:
+            return []
+        bidders = Bidder.objects.select_related('person')
+        for word in words:
+            bidders = bidders.filter(
+                Q(id__in=self.filter(token__startswith=word[:BidderSearchToken.MAX_LENGTH]).values('bidder')) |
+                Q(id__in=BidderId.objects.filter(id__startswith=word.upper()).values('bidder')))
+        bidders = list(bidders.order_by('person__name', 'id')[:limit])
+
+        bidders_by_id = {}
+        for bidder in bidders:
+            bidder._bidder_ids = []
+            bidder.num_won = bidder.num_sold = 0
+            bidders_by_id[bidder.pk] = bidder
+        if bidders:
+            for bidder_id, bidder_pk in BidderId.objects.filter(bidder__in=bidders_by_id.keys()).order_by('id') \
+                    .values_list('id', 'bidder'):
+                bidders_by_id[bidder_pk]._bidder_ids.append(bidder_id)
+            for bidder_pk, status, count in Piece.objects.filter(
+                    current_bidder__in=bidders_by_id.keys(), status__in=[Piece.StatusWon, Piece.StatusSold]) \
+                    .values_list('current_bidder', 'status').annotate(Count('id')).order_by():
+                if status == Piece.StatusWon:
+                    bidders_by_id[bidder_pk].num_won = count
+                else:
+                    bidders_by_id[bidder_pk].num_sold = count
+        return bidders
+
+
+class BidderSearchToken (models.Model):
+    """A word of a bidder's name or reg ID, normalised by search_tokens(), for finding bidders by the start of
+    any of these words. Kept up to date by signals when bidders and people are saved."""
+
+    objects = BidderSearchTokenManager()
+
+    MAX_LENGTH = 40
+
+    bidder = models.ForeignKey(Bidder, related_name='search_tokens')
+    token = models.CharField(max_length=MAX_LENGTH, db_index=True)
+
+    def __unicode__(self):
+        return u"%s: %s" % (self.bidder_id, self.token)
+
+
+# noinspection PyUnusedLocal
+def bidder_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        # Fixture loading. Use "artshowctl rebuildbiddersearch" afterwards.
+        return
+    BidderSearchToken.objects.index([instance])
+
+
+# noinspection PyUnusedLocal
+def bidder_person_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    BidderSearchToken.objects.index(Bidder.objects.filter(person=instance).select_related('person'))
+
+
+models.signals.post_save.connect(bidder_saved, sender=Bidder)
+models.signals.post_save.connect(bidder_person_saved, sender=Person)
+
+
+class PieceManager (models.Manager):
+    def with_top_bid(self):
+        """Pieces with their top bid, top bidder, the bidder's IDs and the artist fetched up-front, so that
+        reports can use current_bid, current_bidder and bidder_ids() without further queries per piece."""
+        return self.get_query_set().select_related('artist__person', 'current_bid', 'current_bidder__person') \
+            .prefetch_related('current_bidder__bidderid_set')
+
+    def rebuild_top_bids(self, piece_ids=None):
+        """Recalculate the stored top bid fields on every piece, or on the pieces with the given ids, from the
+        Bid table. Returns the number of pieces that were found to be out of date. Used after bids are
+        created with bulk_create(), which doesn't send the signals that normally keep them up to date."""
+        if piece_ids is None:
+            chunks = [None]
+        else:
+            piece_ids = list(piece_ids)
+            chunks = [piece_ids[i:i + IN_QUERY_CHUNK_SIZE] for i in range(0, len(piece_ids), IN_QUERY_CHUNK_SIZE)]
+        num_changed = 0
+        for chunk in chunks:
+            bids = Bid.objects.filter(invalid=False)
+            pieces = self.get_query_set()
+            if chunk is not None:
+                bids = bids.filter(piece__in=chunk)
+                pieces = pieces.filter(pk__in=chunk)
+            top_bids = {}
+            for bid_id, piece_id, amount, bidder_id in bids.order_by('piece', '-amount') \
+                    .values_list('id', 'piece_id', 'amount', 'bidder_id'):
+                if piece_id in top_bids:
+                    top_bids[piece_id][3] += 1
+                else:
+                    top_bids[piece_id] = [bid_id, amount, bidder_id, 1]
+            for piece_id, current_bid_id, current_bid_amount, current_bidder_id, bid_count in \
+                    pieces.values_list('id', 'current_bid', 'current_bid_amount', 'current_bidder', 'bid_count'):
+                stored = [current_bid_id, current_bid_amount, current_bidder_id, bid_count]
+                wanted = top_bids.get(piece_id, [None, None, None, 0])
+                if stored != wanted:
+                    self.get_query_set().filter(pk=piece_id).update(
+                        current_bid=wanted[0], current_bid_amount=wanted[1], current_bidder=wanted[2],
+                        bid_count=wanted[3])
+                    num_changed += 1
+        return num_changed
+
+
 class Piece (models.Model):
 
+    objects = PieceManager()
+
     artist = models.ForeignKey(Artist)
     pieceid = models.IntegerField()
     code = models.CharField(max_length=10, editable=False)
@@ -291,17 +554,55 @@ class Piece (models.Model):
     bid_sheet_printing = models.IntegerField(choices=PRINTING_CHOICES, default=PrintingNotPrinted)
     control_form_printing = models.IntegerField(choices=PRINTING_CHOICES, default=PrintingNotPrinted)
 
+    # Copy of the current top bid, so that reports don't need to search the Bid table for every piece.
+    # These are maintained by refresh_top_bid() whenever a Bid is saved or deleted.
+    current_bid = models.ForeignKey('Bid', null=True, blank=True, editable=False, related_name='+',
+                                    on_delete=models.SET_NULL)
+    current_bid_amount = models.DecimalField(max_digits=5, decimal_places=0, blank=True, null=True, editable=False)
+    current_bidder = models.ForeignKey(Bidder, null=True, blank=True, editable=False, related_name='+',
+                                       on_delete=models.SET_NULL)
+    bid_count = models.IntegerField(default=0, editable=False, help_text="number of valid bids")
+
+    TOP_BID_FIELDS = ('current_bid', 'current_bid_amount', 'current_bidder', 'bid_count')
+
     def artistname(self):
         return self.other_artist or self.artist.artistname()
 
     def top_bid(self):
-        return self.bid_set.exclude(invalid=True).order_by('-amount')[0:1].get()
+        if self.current_bid_id is None:
+            raise Bid.DoesNotExist("Piece %s has no valid bids" % self.code)
+        return self.current_bid
+
+    def refresh_top_bid(self):
+        """Recalculate the stored top bid fields from the Bid table, and write them to the database."""
+        bids = self.bid_set.exclude(invalid=True)
+        try:
+            top_bid = bids.order_by('-amount')[0:1].get()
+        except Bid.DoesNotExist:
+            self.current_bid = None
+            self.current_bid_amount = None
+            self.current_bidder = None
+            self.bid_count = 0
+        else:
+            self.current_bid = top_bid
+            self.current_bid_amount = top_bid.amount
+            self.current_bidder_id = top_bid.bidder_id
+            self.bid_count = bids.count()
+        Piece.objects.filter(pk=self.pk).update(current_bid=self.current_bid,
+                                                current_bid_amount=self.current_bid_amount,
+                                                current_bidder=self.current_bidder_id,
+                                                bid_count=self.bid_count)
 
     def is_artist_editable(self):
         return self.status == Piece.StatusNotInShow
 
     def save(self, *args, **kwargs):
         self.code = "%s-%s" % (self.artist.artistid, self.pieceid)
+        if not self._state.adding and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+            # Never write back the top bid fields from a possibly stale instance. They are only ever
+            # updated by refresh_top_bid().
+            kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields
+                                       if not f.primary_key and f.name not in self.TOP_BID_FIELDS]
         super(Piece, self).save(*args, **kwargs)
 
     def __unicode__(self):
@@ -332,6 +633,16 @@ class Piece (models.Model):
         unique_together = (
             ('artist', 'pieceid'),
         )
+        # Matched to the filters used by workflows.printing, the voice auction pages and the reports.
+        index_together = (
+            ('status', 'bid_sheet_printing'),
+            ('status', 'control_form_printing'),
+            ('bid_sheet_printing', 'artist', 'pieceid'),
+            ('control_form_printing', 'artist', 'pieceid'),
+            ('voice_auction', 'adult', 'status', 'order'),
+            ('status', 'adult', 'voice_auction'),
+            ('location', 'artist', 'pieceid'),
+        )
 
 
 class Product (models.Model):
@@ -358,46 +669,76 @@ class Bid (models.Model):
     invalid = models.BooleanField(default=False)
 
     def _is_top_bid(self):
-        return self.piece.top_bid() == self
+        return self.id is not None and self.piece.current_bid_id == self.id
     is_top_bid = property(_is_top_bid)
 
     def __unicode__(self):
-        bidderids = [bidderid.id for bidderid in self.bidder.bidderid_set.all()]
-        return "%s (%s) %s $%s on %s" % (self.bidder.name(), ",".join(bidderids),
+        return "%s (%s) %s $%s on %s" % (self.bidder.name(), ",".join(self.bidder.bidder_ids()),
                                          "INVALID BID" if self.invalid else "bid", self.amount, self.piece)
 
     class Meta:
         unique_together = (('piece', 'amount', 'invalid'), )
+        # For a piece's valid bids, highest first
+        index_together = (('piece', 'invalid', 'amount'), )
 
     def validate(self):
         # super(Bid,self).validate()
-        if self.piece.not_for_sale:
+        piece = self.piece
+        self.validate_against(piece, piece.current_bid if self.id is None and piece.current_bid_id else None)
+
+    def validate_against(self, piece, top_bid):
+        """The rules behind validate(), checked against the given piece and its current top bid (or None),
+        rather than those in the database. Used by BidValidator to check many bids without queries."""
+        if piece.not_for_sale:
             raise ValidationError("Not For Sale piece cannot have bids placed on it")
         if self.id is None:
-            if self.piece.status != Piece.StatusInShow:
+            if piece.status != Piece.StatusInShow:
                 raise ValidationError("New bids cannot be placed on pieces that are not In Show")
-            try:
-                top_bid = self.piece.top_bid()
+            if top_bid is not None:
                 if self.amount <= top_bid.amount:
                     raise ValidationError("New bid must be higher than existing bids")
-                if self.piece.buy_now and top_bid.buy_now_bid:
+                if piece.buy_now and top_bid.buy_now_bid:
                     raise ValidationError("Cannot bid on piece that has had Buy Now option invoked")
                 if self.buy_now_bid:
                     raise ValidationError("Buy Now option not available on piece with bids")
-            except Bid.DoesNotExist:
-                pass
         if self.buy_now_bid:
-            if not self.piece.buy_now:
+            if not piece.buy_now:
                 raise ValidationError("Buy Now option not available on this piece")
-            if self.amount < self.piece.buy_now:
+            if self.amount < piece.buy_now:
                 raise ValidationError("Buy Now bid cannot be less than Buy Now price")
-        if self.amount < self.piece.min_bid:
+        if self.amount < piece.min_bid:
             raise ValidationError("Bid cannot be less than Min Bid")
 #	def save ( self ):
 #		self.validate()
 #		super(Bid,self).save()
 
 
+# noinspection PyUnusedLocal
+def bid_post_init(sender, instance, **kwargs):
+    instance._saved_piece_id = instance.piece_id
+
+
+# noinspection PyUnusedLocal
+def bid_changed(sender, instance, raw=False, **kwargs):
+    """Keep the stored top bid on the piece, and on any piece the bid was moved from, up to date."""
+    if raw:
+        # Fixture loading. Use "artshowctl rebuildtopbids" afterwards.
+        return
+    try:
+        instance.piece.refresh_top_bid()
+    except Piece.DoesNotExist:
+        pass
+    if instance._saved_piece_id is not None and instance._saved_piece_id != instance.piece_id:
+        for piece in Piece.objects.filter(pk=instance._saved_piece_id):
+            piece.refresh_top_bid()
+    instance._saved_piece_id = instance.piece_id
+
+
+models.signals.post_init.connect(bid_post_init, sender=Bid)
+models.signals.post_save.connect(bid_changed, sender=Bid)
+models.signals.post_delete.connect(bid_changed, sender=Bid)
+
+
 class EmailTemplate (models.Model):
     name = models.CharField(max_length=100)
     subject = models.CharField(max_length=100)
@@ -459,23 +800,247 @@ class ChequePayment (Payment):
         )
 
 
+class ArtistLedgerManager (models.Manager):
+    def calculate_all(self, artist_ids=None):
+        """Calculate, but don't save, the ledgers for the given artists (or all artists) from the Payment and
+        Allocation tables. Returns a dictionary of artistid to ArtistLedger."""
+        payments = Payment.objects.all()
+        allocations = Allocation.objects.select_related('space')
+        if artist_ids is None:
+            artist_ids = Artist.objects.values_list('artistid', flat=True)
+        else:
+            payments = payments.filter(artist__in=artist_ids)
+            allocations = allocations.filter(artist__in=artist_ids)
+        ledgers = dict((artist_id, ArtistLedger(artist_id=artist_id)) for artist_id in artist_ids)
+        for row in payments.values('artist').annotate(balance=Sum('amount')):
+            ledgers[row['artist']].balance = row['balance']
+        for row in payments.filter(payment_type=settings.ARTSHOW_SPACE_FEE_PK).values('artist') \
+                .annotate(amount=Sum('amount')):
+            # Deductions from accounts are always negative, so we re-negate it.
+            ledgers[row['artist']].deduction_to_date = - row['amount']
+        for alloc in allocations:
+            ledgers[alloc.artist_id].requested_cost += alloc.space.price * alloc.requested
+        for ledger in ledgers.values():
+            ledger.calculate_remaining()
+        return ledgers
+
+    def refresh(self, artist_id, create=True):
+        """Recalculate and save the ledger for one artist. The ledger is only created if "create" is True."""
+        ledger = self.calculate_all([artist_id])[artist_id]
+        if not self.get_query_set().filter(pk=artist_id).update(**ledger.totals()) and create:
+            ledger.save(force_insert=True)
+        return ledger
+
+    def verify(self):
+        """Returns a list of (artistid, stored ledger, calculated ledger) for every ledger that is missing
+        or does not match the Payment and Allocation tables."""
+        stored = dict((ledger.pk, ledger) for ledger in self.get_query_set())
+        mismatches = []
+        for artist_id, calculated in sorted(self.calculate_all().items()):
+            ledger = stored.get(artist_id)
+            if ledger is None or ledger.totals() != calculated.totals():
+                mismatches.append((artist_id, ledger, calculated))
+        return mismatches
+
+    def rebuild(self):
+        """Correct every ledger that fails verify(). Returns the number of ledgers corrected."""
+        mismatches = self.verify()
+        for artist_id, ledger, calculated in mismatches:
+            if ledger is None:
+                calculated.save(force_insert=True)
+            else:
+                self.get_query_set().filter(pk=artist_id).update(**calculated.totals())
+        return len(mismatches)
+
+
+class ArtistLedger (models.Model):
+    """Running totals of an artist's account, kept up to date as Payments and Allocations change, so that
+    financial reports over all artists don't need to aggregate Payments and Allocations per artist."""
+
+    objects = ArtistLedgerManager()
+
+    artist = models.OneToOneField(Artist, primary_key=True, related_name="ledger")
+    balance = models.DecimalField(max_digits=9, decimal_places=2, default=0)
+    requested_cost = models.DecimalField(max_digits=9, decimal_places=2, default=0,
+                                         help_text="cost of all spaces requested")
+    deduction_to_date = models.DecimalField(max_digits=9, decimal_places=2, default=0,
+                                            help_text="space fees deducted from the account so far")
+    deduction_remaining = models.DecimalField(max_digits=9, decimal_places=2, default=0,
+                                              help_text="space fees requested but not yet deducted")
+    payment_remaining = models.DecimalField(max_digits=9, decimal_places=2, default=0,
+                                            help_text="payment expected from the artist to cover spaces requested")
+
+    TOTAL_FIELDS = ('balance', 'requested_cost', 'deduction_to_date', 'deduction_remaining', 'payment_remaining')
+
+    def calculate_remaining(self):
+        self.deduction_remaining = max(self.requested_cost - self.deduction_to_date, 0)
+        self.payment_remaining = max(self.deduction_remaining - self.balance, 0)
+
+    def totals(self):
+        return dict((name, Decimal(getattr(self, name)).quantize(Decimal("0.01"))) for name in self.TOTAL_FIELDS)
+
+    def __unicode__(self):
+        return u"Ledger for %s" % self.artist_id
+
+
+# noinspection PyUnusedLocal
+def ledger_source_post_init(sender, instance, **kwargs):
+    instance._saved_artist_id = instance.artist_id
+
+
+# noinspection PyUnusedLocal
+def ledger_source_saved(sender, instance, raw=False, **kwargs):
+    """Keep the ledger of the artist, and of any artist the Payment or Allocation was moved from, up to date."""
+    if raw:
+        # Fixture loading. Use "artshowctl rebuildledgers" afterwards.
+        return
+    if isinstance(instance, Space):
+        for artist_id in instance.allocation_set.values_list('artist', flat=True):
+            ArtistLedger.objects.refresh(artist_id)
+    else:
+        ArtistLedger.objects.refresh(instance.artist_id)
+        if instance._saved_artist_id is not None and instance._saved_artist_id != instance.artist_id:
+            ArtistLedger.objects.refresh(instance._saved_artist_id)
+        instance._saved_artist_id = instance.artist_id
+
+
+# noinspection PyUnusedLocal
+def ledger_source_deleted(sender, instance, **kwargs):
+    # Don't create a ledger here, as the artist may be in the process of being deleted.
+    ArtistLedger.objects.refresh(instance.artist_id, create=False)
+
+
+# noinspection PyUnusedLocal
+def artist_created(sender, instance, created, raw=False, **kwargs):
+    """Give every new artist a ledger, so that ledgers never have to be created when they are read."""
+    if created and not raw:
+        ArtistLedger.objects.refresh(instance.artistid)
+
+
+for ledger_source in (Payment, ChequePayment, Allocation):
+    models.signals.post_init.connect(ledger_source_post_init, sender=ledger_source)
+    models.signals.post_save.connect(ledger_source_saved, sender=ledger_source)
+    models.signals.post_delete.connect(ledger_source_deleted, sender=ledger_source)
+models.signals.post_save.connect(ledger_source_saved, sender=Space)
+models.signals.post_save.connect(artist_created, sender=Artist)
+
+
+class AlreadySoldError(Exception):
+    """Raised when an invoice is to be created for pieces that are no longer waiting to be paid for, as when
+    another cashier has just sold them. pieces are the pieces concerned."""
+
+    def __init__(self, pieces):
+        self.pieces = pieces
+
+    def __str__(self):
+        return "already sold: %s" % ", ".join(piece.code for piece in self.pieces)
+
+
+class InvoiceManager (models.Manager):
+    def create_for_bids(self, payer, bids, payments, tax_paid, created_by):
+        """Create an invoice for the winning bids, with the unsaved InvoicePayments, and mark the pieces sold.
+
+        This is done in one transaction, in a fixed number of queries. The pieces are marked sold first, with
+        an update that only changes them if they are still won by the same bid, so that when two cashiers sell
+        the same piece at once, only one of them succeeds, and the other gets AlreadySoldError and creates
+        nothing. Where the database has row locks, the update holds them until the invoice is complete."""
+        piece_ids = [bid.piece_id for bid in bids]
+        bid_ids = [bid.pk for bid in bids]
+        invoice = None
+        with transaction.atomic():
+            num_sold = Piece.objects.filter(pk__in=piece_ids, current_bid__in=bid_ids, status=Piece.StatusWon) \
+                .update(status=Piece.StatusSold, updated=timezone.now())
+            if num_sold == len(bids):
+                invoice = self._create_for_bids(payer, bids, payments, tax_paid, created_by)
+            else:
+                transaction.set_rollback(True)
+        if invoice is None:
+            # Found after the rollback, as the update has changed some of the pieces that weren't sold
+            sold = Piece.objects.filter(pk__in=piece_ids).exclude(current_bid__in=bid_ids, status=Piece.StatusWon)
+            raise AlreadySoldError(list(sold.order_by('code')))
+        for bid in bids:
+            bid.piece.status = Piece.StatusSold
+        return invoice
+
+    @staticmethod
+    def _create_for_bids(payer, bids, payments, tax_paid, created_by):
+        invoice = Invoice(payer=payer, tax_paid=tax_paid, paid_date=datetime.datetime.now(), created_by=created_by,
+                          item_total_amount=sum([bid.amount for bid in bids], Decimal(0)), item_count=len(bids),
+                          total_paid_amount=sum([p.amount for p in payments], Decimal(0)))
+        invoice.save()
+        # The totals are already set above, so create the items and payments in bulk, without each one
+        # refreshing the invoice's totals.
+        for payment in payments:
+            payment.invoice = invoice
+        InvoicePayment.objects.bulk_create(payments)
+        InvoiceItem.objects.bulk_create([InvoiceItem(piece_id=bid.piece_id, price=bid.amount, invoice=invoice)
+                                         for bid in bids])
+        return invoice
+
+    def rebuild_totals(self):
+        """Recompute the stored totals of every invoice. Returns the number of invoices that were corrected."""
+        item_totals = dict((x['invoice'], (x['total'], x['count'])) for x in
+                           InvoiceItem.objects.values('invoice').annotate(total=Sum('price'), count=Count('id')))
+        paid_totals = dict((x['invoice'], x['total']) for x in
+                           InvoicePayment.objects.values('invoice').annotate(total=Sum('amount')))
+        num_changed = 0
+        for invoice in self.get_query_set().only(*(('id',) + Invoice.TOTAL_FIELDS)):
+            item_total, item_count = item_totals.get(invoice.pk, (Decimal('0.0'), 0))
+            total_paid = paid_totals.get(invoice.pk) or Decimal('0.0')
+            if (invoice.item_total_amount, invoice.item_count, invoice.total_paid_amount) != \
+                    (item_total, item_count, total_paid):
+                self.filter(pk=invoice.pk).update(item_total_amount=item_total, item_count=item_count,
+                                                  total_paid_amount=total_paid)
+                num_changed += 1
+        return num_changed
+
+
 class Invoice (models.Model):
+
+    objects = InvoiceManager()
+
     payer = models.ForeignKey(Bidder)
     tax_paid = models.DecimalField(max_digits=7, decimal_places=2, blank=True, null=True)
 
+    # Totals of the invoice's items and payments, so that listings and printouts don't need to aggregate them.
+    # Set by the cashier when the invoice is created, and maintained by refresh_totals() whenever an
+    # InvoiceItem or InvoicePayment is saved or deleted.
+    item_total_amount = models.DecimalField(max_digits=7, decimal_places=2, default=Decimal('0.0'), editable=False)
+    item_count = models.IntegerField(default=0, editable=False)
+    total_paid_amount = models.DecimalField(max_digits=7, decimal_places=2, default=Decimal('0.0'), editable=False)
+
+    TOTAL_FIELDS = ('item_total_amount', 'item_count', 'total_paid_amount')
+
     def total_paid(self):
-        return self.invoicepayment_set.aggregate(sum=Sum('amount'))['sum'] or Decimal('0.0')
+        return self.total_paid_amount
 
     def item_total(self):
-        return self.invoiceitem_set.aggregate(sum=Sum('price'))['sum'] or Decimal('0.0')
+        return self.item_total_amount
 
     def item_and_tax_total(self):
         return self.item_total() + (self.tax_paid or 0)
 
+    def refresh_totals(self):
+        """Recalculate the stored totals from the items and payments, and write them to the database."""
+        items = self.invoiceitem_set.aggregate(total=Sum('price'), count=Count('id'))
+        self.item_total_amount = items['total'] or Decimal('0.0')
+        self.item_count = items['count']
+        self.total_paid_amount = self.invoicepayment_set.aggregate(sum=Sum('amount'))['sum'] or Decimal('0.0')
+        Invoice.objects.filter(pk=self.pk).update(item_total_amount=self.item_total_amount,
+                                                  item_count=self.item_count,
+                                                  total_paid_amount=self.total_paid_amount)
+
     paid_date = models.DateTimeField(blank=True, null=True)
     created_by = models.ForeignKey(User)
     notes = models.TextField(blank=True)
 
+    def save(self, *args, **kwargs):
+        if not self._state.adding and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+            # As for Piece, never write back the stored totals from a possibly stale instance.
+            kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields
+                                       if not f.primary_key and f.name not in self.TOTAL_FIELDS]
+        super(Invoice, self).save(*args, **kwargs)
+
     def __unicode__(self):
         return u"Invoice %d for %s" % (self.id, self.payer)
 
@@ -511,7 +1076,103 @@ class InvoiceItem (models.Model):
         return "%s for $%s" % (self.invoice, self.price)
 
 
+# noinspection PyUnusedLocal
+def invoice_line_post_init(sender, instance, **kwargs):
+    instance._saved_invoice_id = instance.invoice_id
+
+
+# noinspection PyUnusedLocal
+def invoice_line_changed(sender, instance, raw=False, **kwargs):
+    """Keep the stored totals of the invoice, and of any invoice the item or payment was moved from, up to date."""
+    if raw:
+        # Fixture loading. Use "artshowctl rebuildinvoicetotals" afterwards.
+        return
+    try:
+        instance.invoice.refresh_totals()
+    except Invoice.DoesNotExist:
+        pass
+    if instance._saved_invoice_id is not None and instance._saved_invoice_id != instance.invoice_id:
+        for invoice in Invoice.objects.filter(pk=instance._saved_invoice_id):
+            invoice.refresh_totals()
+    instance._saved_invoice_id = instance.invoice_id
+
+
+for invoice_line in (InvoiceItem, InvoicePayment):
+    models.signals.post_init.connect(invoice_line_post_init, sender=invoice_line)
+    models.signals.post_save.connect(invoice_line_changed, sender=invoice_line)
+    models.signals.post_delete.connect(invoice_line_changed, sender=invoice_line)
+
+
+class BatchScanManager (models.Manager):
+    def enqueue(self, queryset=None, per_block=None):
+        """Queue the batch scans for the processbatchscans workers, unless already processed, queued or running.
+        If per_block is given, it replaces the batch scans' per_block setting. Returns the number queued.
+
+        A batch scan that has been running for more than ARTSHOW_BATCHSCAN_STUCK_AFTER seconds is taken to
+        have been left by a worker that stopped, and is queued again. Its changes are only written at the end,
+        in one transaction, so it can't have been partly applied."""
+        if queryset is None:
+            queryset = self.get_query_set()
+        changes = dict(status=BatchScan.StatusQueued, lines_total=0, lines_processed=0, blocks_processed=0,
+                       worker="", started=None, finished=None)
+        changes.update((name, BatchScan._meta.get_field(name).get_default()) for name in BatchScan.METRIC_FIELDS)
+        if per_block is not None:
+            changes['per_block'] = per_block
+        stuck_before = timezone.now() - datetime.timedelta(seconds=settings.ARTSHOW_BATCHSCAN_STUCK_AFTER)
+        return queryset.filter(processed=False).exclude(status=BatchScan.StatusQueued) \
+            .exclude(status=BatchScan.StatusRunning, started__gt=stuck_before).update(**changes)
+
+    def claim_next(self, worker):
+        """Mark the oldest queued batch scan as being run by worker, and return it, or None if none are queued.
+
+        The claim is a conditional update, so when several workers try for the same batch scan, only one of
+        them gets it, and the others move on to the next."""
+        while True:
+            candidate = self.filter(status=BatchScan.StatusQueued).order_by('id').values_list('id', flat=True)[:1]
+            if not candidate:
+                return None
+            claimed = self.filter(id=candidate[0], status=BatchScan.StatusQueued) \
+                .update(status=BatchScan.StatusRunning, worker=worker, started=timezone.now())
+            if claimed:
+                return self.get(id=candidate[0])
+
+    def throughput(self):
+        """Total the metrics of the batch scans processed, by batch type, and by the hour they finished in.
+
+        Returns two lists of dicts, each with the label of the row, the number of batches, and the total of each
+        of the metrics, and lines_per_second, or None if no time was recorded."""
+        names = ('lines_processed', 'blocks_processed') + BatchScan.METRIC_FIELDS
+        batchtypes = dict(BatchScan.BATCHTYPES)
+        by_type = []
+        for row in self.filter(wall_time__isnull=False).values('batchtype') \
+                .annotate(Count('id'), *[Sum(name) for name in names]).order_by('batchtype'):
+            totals = dict((name, row[name + '__sum']) for name in names)
+            by_type.append(self._throughput_row(batchtypes.get(row['batchtype']), row['id__count'], totals))
+
+        hours = {}
+        for values in self.filter(wall_time__isnull=False, finished__isnull=False).values_list('finished', *names):
+            finished = values[0]
+            if timezone.is_aware(finished):
+                finished = timezone.localtime(finished)
+            hour = finished.replace(minute=0, second=0, microsecond=0)
+            num_batches, totals = hours.get(hour, (0, dict((name, 0) for name in names)))
+            for name, value in zip(names, values[1:]):
+                totals[name] += value
+            hours[hour] = (num_batches + 1, totals)
+        by_hour = [self._throughput_row(hour, num_batches, totals)
+                   for hour, (num_batches, totals) in sorted(hours.items())]
+        return by_type, by_hour
+
+    @staticmethod
+    def _throughput_row(label, num_batches, totals):
+        row = dict(totals, label=label, batches=num_batches)
+        row['lines_per_second'] = totals['lines_processed'] / totals['wall_time'] if totals['wall_time'] else None
+        return row
+
+
 class BatchScan (models.Model):
+    objects = BatchScanManager()
+
     BATCHTYPES = [
         (0, u"Unknown"),
         (1, u"Locations"),
@@ -521,14 +1182,230 @@ class BatchScan (models.Model):
     ]
     batchtype = models.IntegerField(choices=BATCHTYPES, default=0)
     data = models.TextField()
+    content_hash = models.CharField(max_length=64, db_index=True, editable=False, default="",
+                                    help_text="SHA-256 of the non-blank lines of data, to find duplicate batches")
     date_scanned = models.DateTimeField()
-    processed = models.BooleanField(default=False)
+    device = models.CharField(max_length=100, blank=True, help_text="The scanner the batch was read from")
+    processed = models.BooleanField(default=False, db_index=True)
     processing_log = models.TextField(blank=True)
+    per_block = models.BooleanField(default=False, help_text="Apply the blocks without errors, and copy the blocks "
+                                                             "with errors to a new batch scan to be corrected")
+    residual_of = models.ForeignKey('self', null=True, blank=True, related_name='residuals',
+                                    help_text="The batch scan that this one has the failed blocks of")
+    journal_offset = models.BigIntegerField(null=True, blank=True, editable=False,
+                                            help_text="Where the batch begins in the scanner journal")
+
+    StatusNew = 0
+    StatusQueued = 1
+    StatusRunning = 2
+    StatusDone = 3
+    StatusFailed = 4
+
+    STATUS_CHOICES = [
+        (StatusNew, u"New"),
+        (StatusQueued, u"Queued"),
+        (StatusRunning, u"Running"),
+        (StatusDone, u"Done"),
+        (StatusFailed, u"Failed"),
+    ]
+
+    status = models.IntegerField(choices=STATUS_CHOICES, default=StatusNew, db_index=True, editable=False)
+    worker = models.CharField(max_length=100, blank=True, editable=False)
+    started = models.DateTimeField(null=True, blank=True, editable=False)
+    finished = models.DateTimeField(null=True, blank=True, editable=False)
+    lines_total = models.IntegerField(default=0, editable=False)
+    lines_processed = models.IntegerField(default=0, editable=False)
+    blocks_processed = models.IntegerField(default=0, editable=False)
+
+    # Metrics of the last time the batch scan was processed. See processbatchscan.ScanMetrics.
+    bids_created = models.IntegerField(default=0, editable=False)
+    pieces_updated = models.IntegerField(default=0, editable=False)
+    query_count = models.IntegerField(default=0, editable=False, help_text="SQL queries made")
+    wall_time = models.FloatField(null=True, blank=True, editable=False, help_text="Seconds taken to process")
+    parse_time = models.FloatField(null=True, blank=True, editable=False,
+                                   help_text="Seconds taken to read the lines into tokens")
+    lookup_time = models.FloatField(null=True, blank=True, editable=False,
+                                    help_text="Seconds taken to fetch the pieces and bidders scanned, when in bulk")
+    apply_time = models.FloatField(null=True, blank=True, editable=False,
+                                   help_text="Seconds taken to apply the blocks")
+    write_time = models.FloatField(null=True, blank=True, editable=False,
+                                   help_text="Seconds taken to write the changes, when in bulk")
+
+    METRIC_FIELDS = ('bids_created', 'pieces_updated', 'query_count', 'wall_time', 'parse_time', 'lookup_time',
+                     'apply_time', 'write_time')
+
+    dry_run_errors = models.IntegerField(null=True, blank=True, editable=False,
+                                         help_text="Errors found when the batch scan was last checked")
+    dry_run_report = models.TextField(blank=True, editable=False)
+
+    @staticmethod
+    def hash_data(data):
+        lines = [l.strip() for l in data.splitlines()]
+        return hashlib.sha256("\n".join(l for l in lines if l).encode('utf-8')).hexdigest()
+
+    def save(self, *args, **kwargs):
+        self.content_hash = self.hash_data(self.data)
+        super(BatchScan, self).save(*args, **kwargs)
+
+    def report_progress(self, lines_total=None, lines_processed=None, blocks_processed=None):
+        """Record how far processing has got, without saving anything else."""
+        changes = {}
+        for name, value in [('lines_total', lines_total), ('lines_processed', lines_processed),
+                            ('blocks_processed', blocks_processed)]:
+            if value is not None:
+                setattr(self, name, value)
+                changes[name] = value
+        BatchScan.objects.filter(id=self.id).update(**changes)
+
+    def record_metrics(self, metrics):
+        """Copy the counts and timings from a processbatchscan.ScanMetrics, without saving."""
+        self.lines_processed = metrics.lines
+        self.blocks_processed = metrics.blocks
+        self.bids_created = metrics.bids_created
+        self.pieces_updated = metrics.pieces_updated
+        self.query_count = metrics.queries
+        self.wall_time = metrics.wall_time
+        for name, seconds in metrics.phase_times.items():
+            setattr(self, name + '_time', seconds)
+
+    def lines_per_second(self):
+        if not self.wall_time:
+            return None
+        return self.lines_processed / self.wall_time
 
     def __unicode__(self):
         return u"BatchScan %s" % self.id
 
 
+# noinspection PyUnusedLocal
+def batchscan_saved(sender, instance, raw=False, **kwargs):
+    """Check each batch scan as it is saved, so that errors can be corrected before it is processed."""
+    if raw or instance.processed or instance.batchtype not in [1, 2, 3, 4]:
+        return
+    from .processbatchscan import dry_run_batchscan
+    dry_run_batchscan(instance)
+
+
+models.signals.post_save.connect(batchscan_saved, sender=BatchScan)
+
+
+class PrintJobManager (models.Manager):
+    def enqueue(self, printer, document, description, invoice=None, created_by=None):
+        """Queue the rendered document for "manage.py printspooler" to send to the printer."""
+        return self.create(printer=printer, document=document, description=description, invoice=invoice,
+                           created_by=created_by)
+
+    def claim_next(self, printers, worker, stale_after=None):
+        """Mark the next print job for one of the printers as being printed by worker, and return it, or None
+        if none of them has a job ready.
+
+        Each printer's jobs are printed in the order they were queued, so a printer has a job ready only if
+        its oldest unfinished job is queued, and isn't waiting to be retried. Of the printers with a job
+        ready, the one whose job was queued first goes next. As in BatchScanManager.claim_next, the claim is
+        a conditional update, so only one worker gets each job.
+
+        If stale_after is given, a job that has been printing for longer than that many seconds is taken to
+        have been left by a spooler that stopped, and is recorded as a failed attempt, so that it is retried
+        rather than holding up the printer's later jobs."""
+        while True:
+            now = timezone.now()
+            candidates = []
+            stale = []
+            for printer in printers:
+                first = self.filter(printer=printer, status__in=[PrintJob.StatusQueued, PrintJob.StatusPrinting]) \
+                    .order_by('id').values_list('id', 'status', 'not_before', 'started')[:1]
+                if not first:
+                    continue
+                job_id, status, not_before, started = first[0]
+                if status == PrintJob.StatusQueued and (not_before is None or not_before <= now):
+                    candidates.append(job_id)
+                elif status == PrintJob.StatusPrinting and stale_after is not None and \
+                        started < now - datetime.timedelta(seconds=stale_after):
+                    stale.append(job_id)
+            for job in self.filter(id__in=stale):
+                job.record_failure("left printing by %s for more than %gs" % (job.worker, stale_after))
+            if stale:
+                continue
+            if not candidates:
+                return None
+            claimed = self.filter(id=min(candidates), status=PrintJob.StatusQueued) \
+                .update(status=PrintJob.StatusPrinting, worker=worker, started=timezone.now(),
+                        attempts=models.F('attempts') + 1)
+            if claimed:
+                return self.get(id=min(candidates))
+
+    def requeue(self, queryset):
+        """Queue the print jobs to be printed again from the start, as when a printer has been fixed, or a job
+        was left printing by a spooler that stopped. Returns the number queued."""
+        return queryset.update(status=PrintJob.StatusQueued, attempts=0, not_before=None, worker="", started=None,
+                               finished=None, error="")
+
+    def cancel(self, queryset):
+        """Stop the queued print jobs from being printed. Returns the number cancelled."""
+        return queryset.filter(status=PrintJob.StatusQueued).update(status=PrintJob.StatusCancelled,
+                                                                    finished=timezone.now())
+
+
+class PrintJob (models.Model):
+    objects = PrintJobManager()
+
+    printer = models.CharField(max_length=40, db_index=True,
+                               help_text="\"default\", or one of the printers named in ARTSHOW_PRINTERS")
+    description = models.CharField(max_length=200)
+    document = models.BinaryField(editable=False)
+    invoice = models.ForeignKey('Invoice', null=True, blank=True, on_delete=models.SET_NULL,
+                                related_name='print_jobs')
+    created_by = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL)
+    created = models.DateTimeField(auto_now_add=True)
+
+    StatusQueued = 1
+    StatusPrinting = 2
+    StatusPrinted = 3
+    StatusFailed = 4
+    StatusCancelled = 5
+
+    STATUS_CHOICES = [
+        (StatusQueued, u"Queued"),
+        (StatusPrinting, u"Printing"),
+        (StatusPrinted, u"Printed"),
+        (StatusFailed, u"Failed"),
+        (StatusCancelled, u"Cancelled"),
+    ]
+
+    status = models.IntegerField(choices=STATUS_CHOICES, default=StatusQueued, db_index=True, editable=False)
+    attempts = models.IntegerField(default=0, editable=False)
+    not_before = models.DateTimeField(null=True, blank=True, editable=False,
+                                      help_text="When a failed job may be tried again")
+    worker = models.CharField(max_length=100, blank=True, editable=False)
+    started = models.DateTimeField(null=True, blank=True, editable=False)
+    finished = models.DateTimeField(null=True, blank=True, editable=False)
+    error = models.TextField(blank=True, editable=False)
+
+    def record_printed(self):
+        self.status = PrintJob.StatusPrinted
+        self.finished = timezone.now()
+        self.error = ""
+        PrintJob.objects.filter(id=self.id).update(status=self.status, finished=self.finished, error=self.error)
+
+    def record_failure(self, error):
+        """Queue the job to be tried again after a delay, or if it has been tried ARTSHOW_PRINT_ATTEMPTS times,
+        give up on it, so that the printer's later jobs are printed. Nothing is recorded if the job has been
+        claimed again since, as when it was taken to have been left by a spooler that stopped."""
+        self.error = error
+        if self.attempts < settings.ARTSHOW_PRINT_ATTEMPTS:
+            self.status = PrintJob.StatusQueued
+            self.not_before = timezone.now() + datetime.timedelta(
+                seconds=settings.ARTSHOW_PRINT_RETRY_DELAY * self.attempts)
+        else:
+            self.status = PrintJob.StatusFailed
+            self.finished = timezone.now()
+        PrintJob.objects.filter(id=self.id, status=PrintJob.StatusPrinting, started=self.started) \
+            .update(status=self.status, not_before=self.not_before, finished=self.finished, error=self.error)
+
+    def __unicode__(self):
+        return u"PrintJob %s" % self.id
+
+
 class Event (models.Model):
     name = models.CharField(max_length=100)
     occurred = models.BooleanField(default=False)
@@ -4,6 +4,11 @@
 
 from cgi import escape
 from decimal import Decimal
+from StringIO import StringIO
+import errno
+import hashlib
+import os
+import tempfile
 
 from django.db.models import Min
 from django.shortcuts import get_object_or_404
@@ -17,7 +22,11 @@ from reportlab.lib.units import inch
 from reportlab.lib import colors
 from .models import *
 from .conf import settings
+from .conf import _DISABLED as SETTING_DISABLED
+from .identitymap import IdentityMap, get_identity_map
 from artshow.utils import format_money
+from logging import getLogger
+logger = getLogger(__name__)
 
 
 MAX_PIECES_PER_PAGE = 30
@@ -25,7 +34,8 @@ MAX_PIECES_PER_PAGE = 30
 
 @permission_required('artshow.is_artshow_staff')
 def winning_bidders(request):
-    bidders = Bidder.objects.all().annotate(first_bidderid=Min('bidderid')).order_by('first_bidderid')
+    bidders = Bidder.objects.with_winnings(
+        Bidder.objects.annotate(first_bidderid=Min('bidderid')).order_by('first_bidderid'))
     response = HttpResponse(mimetype="application/pdf")
 
     styles = getSampleStyleSheet()
@@ -124,7 +134,7 @@ def bid_entry(request, pieces):
     data = [("Loc.", "Artist", "Title", "Code", "Bidder", "Amount", "No\nSale", "Norm.\nSale", "Buy\nNow\nSale",
              "Voice\nAuct.")]
 
-    for piece in pieces:
+    for piece in get_identity_map(request).attach_artists(pieces):
         data.append((
             Paragraph(escape(piece.location), normal_style),
             Paragraph(escape(piece.artist.artistname()), normal_style),
@@ -195,7 +205,97 @@ def draw_invoice_header(canvas, doc, invoice, purpose):
     frame.addFromList(header_story, canvas)
 
 
-def invoice_to_pdf(invoice, outf):
+def load_invoice_items(invoice, identity_map, *order_by):
+    """The invoice's items, in the given order, with their pieces, and the pieces' artists from the identity map.
+    The payer's person and bidder IDs are loaded the same way, for the page headers."""
+    identity_map.attach_people([invoice.payer])
+    identity_map.attach_bidder_ids([invoice.payer])
+    items = list(invoice.invoiceitem_set.select_related("piece").order_by(*order_by))
+    identity_map.attach_artists([item.piece for item in items])
+    return items
+
+
+ITEM_ORDER = {
+    'invoice': ("piece__artist__artistid", "piece__pieceid"),
+    'picklist': ("piece__location", "piece__artist__artistid", "piece__pieceid"),
+}
+
+# Change this whenever the layout of the invoice or pick list changes, so that the cached PDFs are replaced.
+PDF_LAYOUT_VERSION = 1
+
+
+def invoice_pdf_version(invoice, items):
+    """A digest of everything shown on the invoice and its pick list, that changes whenever they would."""
+    payer = invoice.payer
+    shown = [
+        PDF_LAYOUT_VERSION, settings.ARTSHOW_SHOW_NAME, settings.ARTSHOW_SHOW_YEAR, settings.ARTSHOW_INVOICE_PREFIX,
+        settings.ARTSHOW_TAX_DESCRIPTION, settings.ARTSHOW_MONEY_CURRENCY, settings.ARTSHOW_MONEY_PRECISION,
+        invoice.id, invoice.paid_date, invoice.tax_paid, invoice.item_count, invoice.item_total_amount,
+        invoice.total_paid_amount, payer.name(), payer.person.reg_id, payer.bidder_ids(),
+        [(item.price, item.piece.code, item.piece.name, item.piece.media, item.piece.condition,
+          item.piece.other_artist, item.piece.location, item.piece.artist.artistname()) for item in items],
+        [(payment.payment_method, payment.amount) for payment in invoice.invoicepayment_set.all()],
+    ]
+    return hashlib.sha256(repr(shown)).hexdigest()
+
+
+def cached_pdf(kind, invoice, identity_map=None):
+    """The PDF of the invoice, if kind is "invoice", or of its pick list, if "picklist".
+
+    If ARTSHOW_PDF_CACHE_DIR is set, it is rendered only if it isn't already there, under the invoice's ID and
+    invoice_pdf_version. Finding the version needs the same few queries as rendering, but none of the layout."""
+    identity_map = identity_map or IdentityMap()
+    items = load_invoice_items(invoice, identity_map, *ITEM_ORDER[kind])
+    to_pdf = {'invoice': invoice_to_pdf, 'picklist': picklist_to_pdf}[kind]
+    if settings.ARTSHOW_PDF_CACHE_DIR is SETTING_DISABLED:
+        sbuf = StringIO()
+        to_pdf(invoice, sbuf, identity_map, items)
+        return sbuf.getvalue()
+
+    directory = os.path.join(settings.ARTSHOW_PDF_CACHE_DIR, str(invoice.id))
+    filename = "%s-%s.pdf" % (kind, invoice_pdf_version(invoice, items))
+    try:
+        with open(os.path.join(directory, filename), "rb") as f:
+            return f.read()
+    except IOError, x:
+        if x.errno != errno.ENOENT:
+            raise
+
+    sbuf = StringIO()
+    to_pdf(invoice, sbuf, identity_map, items)
+    pdf = sbuf.getvalue()
+    try:
+        _store_pdf(directory, filename, kind, pdf)
+    except (IOError, OSError), x:
+        logger.warning("Could not cache %s for invoice %s: %s", kind, invoice.id, x)
+    return pdf
+
+
+def _store_pdf(directory, filename, kind, pdf):
+    try:
+        os.makedirs(directory)
+    except OSError, x:
+        if x.errno != errno.EEXIST:
+            raise
+    # Renamed into place, so that no one reads it half written
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".pdf")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(pdf)
+        os.rename(temp_path, os.path.join(directory, filename))
+    except:
+        os.remove(temp_path)
+        raise
+    for old_filename in os.listdir(directory):
+        if old_filename.startswith(kind + "-") and old_filename != filename:
+            try:
+                os.remove(os.path.join(directory, old_filename))
+            except OSError:
+                # Already replaced by another process
+                pass
+
+
+def invoice_to_pdf(invoice, outf, identity_map=None, items=None):
     normal_style = ParagraphStyle("normal", fontName="Helvetica")
     piece_condition_style = ParagraphStyle("piececondition", normal_style, fontSize=normal_style.fontSize - 2,
                                            leading=normal_style.leading - 2)
@@ -213,9 +313,9 @@ def invoice_to_pdf(invoice, outf):
 
     body_data = [["Code", "Description", "Amount (" + settings.ARTSHOW_MONEY_CURRENCY + ")"]]
 
-    num_items = 0
-    for item in invoice.invoiceitem_set.order_by("piece__artist__artistid", "piece__pieceid"):
-        num_items += 1
+    if items is None:
+        items = load_invoice_items(invoice, identity_map or IdentityMap(), *ITEM_ORDER['invoice'])
+    for item in items:
         piece = item.piece
         paragraphs = [
             Paragraph("<i>" + escape(piece.name) + u"</i> \u2014 by " + escape(piece.artistname()), normal_style)]
@@ -235,7 +335,8 @@ def invoice_to_pdf(invoice, outf):
         subtotal_row = None
 
     total_row = len(body_data)
-    body_data.append(["", str(num_items) + u" items \u2014 Total Due", format_money(invoice.item_and_tax_total())])
+    body_data.append(["", str(invoice.item_count) + u" items \u2014 Total Due",
+                      format_money(invoice.item_and_tax_total())])
 
     body_data.append(["", "", ""])
 
@@ -276,12 +377,10 @@ def invoice_to_pdf(invoice, outf):
 @permission_required('artshow.is_artshow_staff')
 def pdf_invoice(request, invoice_id):
     invoice = get_object_or_404(Invoice, pk=invoice_id)
-    response = HttpResponse(mimetype="application/pdf")
-    invoice_to_pdf(invoice, response)
-    return response
+    return HttpResponse(cached_pdf('invoice', invoice), mimetype="application/pdf")
 
 
-def picklist_to_pdf(invoice, outf):
+def picklist_to_pdf(invoice, outf, identity_map=None, items=None):
     normal_style = ParagraphStyle("normal", fontName="Helvetica")
     piece_condition_style = ParagraphStyle("piececondition", normal_style, fontSize=normal_style.fontSize - 2,
                                            leading=normal_style.leading - 2)
@@ -303,7 +402,9 @@ def picklist_to_pdf(invoice, outf):
     ]
 
     num_items = 0
-    for item in invoice.invoiceitem_set.order_by("piece__location", "piece__artist__artistid", "piece__pieceid"):
+    if items is None:
+        items = load_invoice_items(invoice, identity_map or IdentityMap(), *ITEM_ORDER['picklist'])
+    for item in items:
         num_items += 1
         piece = item.piece
         paragraphs = [
@@ -362,6 +463,4 @@ def picklist_to_pdf(invoice, outf):
 @permission_required('artshow.is_artshow_staff')
 def pdf_picklist(request, invoice_id):
     invoice = get_object_or_404(Invoice, pk=invoice_id)
-    response = HttpResponse(mimetype="application/pdf")
-    picklist_to_pdf(invoice, response)
-    return response
+    return HttpResponse(cached_pdf('picklist', invoice), mimetype="application/pdf")
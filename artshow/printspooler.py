@@ -0,0 +1,95 @@
+"""Printing through the PrintJob queue.
+
+Pages that print only render the document and queue it with spool(). "manage.py printspooler" then sends each
+job to its printer's command, so a slow or jammed printer holds up its own queue, and not the cashier or
+bidder registration."""
+
+import os
+import signal
+import subprocess
+import threading
+from .conf import settings
+from .conf import _DISABLED as SETTING_DISABLED
+from .models import PrintJob
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+class PrintingError (StandardError):
+    pass
+
+
+def print_command(printer):
+    """The command that prints to the printer, or None if it isn't configured."""
+    if printer == "default":
+        command = settings.ARTSHOW_PRINT_COMMAND
+    else:
+        command = settings.ARTSHOW_PRINTERS.get(printer)
+    if command is None or command is SETTING_DISABLED:
+        return None
+    return command
+
+
+def printers():
+    """The names of the printers that are configured."""
+    return [printer for printer in ["default"] + sorted(settings.ARTSHOW_PRINTERS) if print_command(printer)]
+
+
+def spool(printer, document, description, invoice=None, user=None):
+    """Queue the rendered document to be printed, and return its PrintJob."""
+    if not document:
+        logger.error("nothing to print for %s", description)
+        raise PrintingError("Nothing to print for %s" % description)
+    if print_command(printer) is None:
+        logger.error("Cannot print %s. Printer %s is not configured", description, printer)
+        raise PrintingError("Printer %s is not configured" % printer)
+    return PrintJob.objects.enqueue(printer, document, description, invoice=invoice, created_by=user)
+
+
+def send(printer, document, timeout=None):
+    """Run the printer's command with the document as its input, and wait for it to finish.
+    Raises PrintingError if it fails, or takes more than timeout seconds."""
+    command = print_command(printer)
+    if command is None:
+        raise PrintingError("Printer %s is not configured" % printer)
+    # In its own process group, so that a timeout kills what the shell runs, too
+    p = subprocess.Popen(command, stderr=subprocess.PIPE, stdout=subprocess.PIPE, stdin=subprocess.PIPE, shell=True,
+                         preexec_fn=os.setsid)
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, _kill, [p])
+        timer.start()
+    try:
+        output, error = p.communicate(document)
+    finally:
+        if timer is not None:
+            timer.cancel()
+    if output:
+        logger.debug("printing command returned: %s", output)
+    if p.returncode < 0 and timeout:
+        raise PrintingError("printing command took more than %ss" % timeout)
+    if error:
+        logger.error("printing command returned error: %s", error)
+        raise PrintingError(error)
+    if p.returncode:
+        raise PrintingError("printing command exited with status %d" % p.returncode)
+
+
+def _kill(p):
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except OSError:
+        # It finished just in time
+        pass
+
+
+def print_job(job, timeout=None):
+    """Print a job claimed with PrintJob.objects.claim_next, and record how it went. Returns True if it was
+    printed."""
+    try:
+        send(job.printer, str(job.document), timeout)
+    except (PrintingError, OSError), x:
+        job.record_failure(str(x))
+        return False
+    job.record_printed()
+    return True
@@ -3,11 +3,17 @@
 # Copyright (C) 2009, 2010 Chris Cogdon
 # See file COPYING for licence details
 
-from .models import BatchScan, Piece, Bid, BidderId, Person, Bidder
+from .models import BatchScan, Piece, Bid, BidderId, Person, Bidder, IN_QUERY_CHUNK_SIZE
+from .bidvalidation import BidValidator
+from .utils import QueryCounter
+from contextlib import contextmanager
 import datetime
 import re
+import time
+from django.db.models import Count
 from django.db.models.query import transaction
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 
 
 class BatchProcessingError(Exception):
@@ -19,345 +25,992 @@ class BatchProcessingError(Exception):
         return "%s: %d errors listed" % (self.detail, len(self.errorlist))
 
 
-location_scan_re = re.compile(r'[PL](\w\d+)$')
-piece_scan_re = re.compile(r'A(\d+)P(\d+)$')
-end_location_scan_re = re.compile(r'[PL]END$')
+# Scan codes, and the tokens they are read as. Each batch type recognises some of these, and where a line
+# could be read as more than one, the one listed first by the batch type wins.
+TOKEN_PATTERNS = {
+    'location': r'[PL](?P<location_code>\w\d+)',
+    'location_end': r'[PL]END',
+    'piece': r'A(?P<artistid>\d+)P(?P<pieceid>\d+)',
+    'bidder': r'B(?P<bidderid>\d+)',
+    'price': r'(?P<amount>\d+)',
+    'normal_sale': r'NS',
+    'buy_now': r'NBN',
+    'no_bids': r'NB',
+    'auction_sale': r'NAS',
+    'auction_complete': r'NAC',
+    'not_for_sale': r'NFS',
+    'person': r'P(?P<personid>\d+)',
+}
 
-bidder_scan_re = re.compile(r'B(\d+)$')
-price_scan_re = re.compile(r'(\d+)$')
-normal_sale_scan_re = re.compile(r'NS$')
-buy_now_scan_re = re.compile(r'NBN$')
-no_bids_scan_re = re.compile(r'NB$')
-auction_sale_scan_re = re.compile(r'NAS$')
-auction_complete_scan_re = re.compile(r'NAC$')
-not_for_sale_scan_re = re.compile(r'NFS$')
 
-person_scan_re = re.compile(r'P(\d+)$')
+class Tokenizer(object):
+    """Classifies each line of a scan with a single regular expression combining the given kinds of token."""
 
+    def __init__(self, kinds):
+        self.regex = re.compile("(?:%s)$" % "|".join("(?P<%s>%s)" % (kind, TOKEN_PATTERNS[kind]) for kind in kinds))
 
-class StateL:
-    start = 1
-    read_location = 2
-    error_skipping = 99
-
-
-@transaction.atomic
-def process_locations(data):
-    errors = []
-    state = StateL.start
-    lines = 0
-    current_location = None
-    for l in data.splitlines():
-        lines += 1
-        l = l.strip()
-        if l == "":
-            continue
-        mo = location_scan_re.match(l)
-        if mo:
-            if state not in [StateL.start, StateL.error_skipping]:
-                errors.append("line %d: previous block incomplete" % lines)
-            current_location = mo.group(1)
-            state = StateL.read_location
-        if not mo:
-            if state == StateL.error_skipping:
+    def tokenize(self, data):
+        """Returns a list of (line number, line, kind, match) for each non-blank line. kind and match are None
+        for a line that isn't any of the kinds of token."""
+        tokens = []
+        match = self.regex.match
+        for line_no, line in enumerate(data.splitlines(), 1):
+            line = line.strip()
+            if line == "":
                 continue
-            mo = piece_scan_re.match(l)
-            if mo:
-                if state == StateL.read_location:
-                    try:
-                        piece = Piece.objects.get(artist=int(mo.group(1)), pieceid=int(mo.group(2)))
-                    except Piece.DoesNotExist:
-                        errors.append("line %d: piece %s does not exist" % (lines, l))
-                        state = State.error_skipping
-                        continue
-                    piece.location = current_location
-                    if piece.status in [Piece.StatusNotInShow, Piece.StatusNotInShowLocked]:
-                        piece.status = Piece.StatusInShow
-                    piece.save()
-                else:
-                    errors.append("line %d: piece %s not found immediately after location" % (lines, l))
-        if not mo:
-            mo = end_location_scan_re.match(l)
+            mo = match(line)
             if mo:
-                if state == StateL.read_location:
-                    state = StateL.start
+                tokens.append((line_no, line, mo.lastgroup, mo))
+            else:
+                tokens.append((line_no, line, None, None))
+        return tokens
+
+    def tokenize_line(self, line_no, line):
+        """Returns the token for one line, which should already be stripped, as for tokenize()."""
+        mo = self.regex.match(line)
+        return line_no, line, mo and mo.lastgroup, mo
+
+
+class DirectStore(object):
+    """Looks up each piece and bidder ID as it is scanned, and saves each bid and piece straight away."""
+
+    defers_writes = False
+
+    def __init__(self, tokens=None):
+        self.validator = BidValidator()
+        self.bids_created = 0
+        # The ids of the pieces saved, in the order first saved, so that a failed block can forget its own
+        self.saved_piece_ids = []
+        self._saved_piece_ids = set()
+
+    def get_piece(self, artistid, pieceid):
+        # Always within a transaction, which keeps the piece locked until the scan is done with it
+        piece = Piece.objects.select_related('current_bid').select_for_update().get(artist=artistid, pieceid=pieceid)
+        self.validator.add_piece(piece)
+        return piece
+
+    def get_bidder_id(self, bidderid):
+        return BidderId.objects.get(id=bidderid).bidder_id
+
+    def count_bids(self, piece):
+        return piece.bid_set.count()
+
+    def is_top_bid(self, piece, bidder_id, amount):
+        # The piece is fetched again for each block, so its top bid is up to date
+        return piece.current_bid_id is not None and piece.current_bidder_id == bidder_id and \
+            piece.current_bid_amount == amount
+
+    def validate_bid(self, bid):
+        self.validator.validate(bid)
+
+    def save_bid(self, bid):
+        bid.save()
+        self.bids_created += 1
+
+    def save_piece(self, piece):
+        piece.save()
+        if piece.pk not in self._saved_piece_ids:
+            self._saved_piece_ids.add(piece.pk)
+            self.saved_piece_ids.append(piece.pk)
+
+    def get_person(self, personid):
+        return Person.objects.get(id=personid)
+
+    def bidder_id_exists(self, bidderid):
+        return BidderId.objects.filter(id=bidderid).exists()
+
+    def create_bidder_id(self, person, bidderid):
+        bidder, created = Bidder.objects.get_or_create(person=person)
+        BidderId.objects.create(id=bidderid, bidder=bidder)
+
+    def counts(self):
+        """Return the number of bids created, and of pieces updated."""
+        return self.bids_created, len(self.saved_piece_ids)
+
+    def flush(self):
+        pass
+
+    @contextmanager
+    def block(self):
+        """A savepoint, so that the changes made within the block are undone if it raises an exception."""
+        bids_created = self.bids_created
+        num_saved_pieces = len(self.saved_piece_ids)
+        try:
+            with transaction.atomic():
+                yield
+        except:
+            self.bids_created = bids_created
+            for pk in self.saved_piece_ids[num_saved_pieces:]:
+                self._saved_piece_ids.discard(pk)
+            del self.saved_piece_ids[num_saved_pieces:]
+            raise
+
+
+class BulkStore(object):
+    """Fetches every piece, bidder ID, person and bid count that a scan refers to up-front, in a few IN queries, and
+    keeps the changes in memory until flush() writes them with bulk_create() and grouped updates.
+
+    Pieces scanned more than once share one instance, so each scan sees the changes made by the earlier
+    ones, just as when they are saved and fetched again by DirectStore.
+
+    Nothing is locked while the scan is applied, so the flush only updates the pieces that are still as they
+    were fetched, and raises BatchProcessingError if any have changed since, eg, by being sold at the
+    cashier, or bid on by another batch scan. Within the flush's transaction, that undoes everything."""
+
+    defers_writes = True
+
+    # The fields of a piece that scans change
+    SCANNED_FIELDS = ('location', 'status', 'bidsheet_scanned', 'voice_auction')
+
+    def __init__(self, tokens):
+        self.validator = BidValidator()
+        self.pieces = {}
+        self.bid_counts = {}
+        self.bidder_ids = {}
+        self.new_bids = []
+        self.saved_pieces = {}
+        self.original_values = {}
+        self.original_top_bids = {}
+        self.people = {}
+        self.new_bidder_ids = []
+        self.undo = None
+
+        piece_keys = set()
+        bidderids = set()
+        personids = set()
+        for line_no, line, kind, mo in tokens:
+            if kind == 'piece':
+                piece_keys.add((int(mo.group('artistid')), int(mo.group('pieceid'))))
+            elif kind == 'bidder':
+                bidderids.add(mo.group('bidderid'))
+            elif kind == 'person':
+                personids.add(int(mo.group('personid')))
+
+        artist_ids = sorted(set(artistid for artistid, pieceid in piece_keys))
+        for chunk in self._chunks(artist_ids):
+            for piece in Piece.objects.filter(artist__in=chunk).select_related('current_bid'):
+                if (piece.artist_id, piece.pieceid) in piece_keys:
+                    self.pieces[(piece.artist_id, piece.pieceid)] = piece
+                    self.original_values[piece.pk] = [getattr(piece, name) for name in self.SCANNED_FIELDS]
+                    self.original_top_bids[piece.pk] = (piece.current_bid_id, piece.bid_count)
+                    self.validator.add_piece(piece)
+        for chunk in self._chunks([piece.pk for piece in self.pieces.values()]):
+            for row in Bid.objects.filter(piece__in=chunk).values('piece').annotate(num_bids=Count('id')):
+                self.bid_counts[row['piece']] = row['num_bids']
+        for chunk in self._chunks(sorted(bidderids)):
+            self.bidder_ids.update(BidderId.objects.filter(id__in=chunk).values_list('id', 'bidder'))
+        for chunk in self._chunks(sorted(personids)):
+            self.people.update(Person.objects.in_bulk(chunk))
+
+    @staticmethod
+    def _chunks(ids):
+        return [ids[i:i + IN_QUERY_CHUNK_SIZE] for i in range(0, len(ids), IN_QUERY_CHUNK_SIZE)]
+
+    def get_piece(self, artistid, pieceid):
+        try:
+            piece = self.pieces[(artistid, pieceid)]
+        except KeyError:
+            raise Piece.DoesNotExist()
+        if self.undo is not None and piece.pk not in self.undo:
+            self.undo[piece.pk] = (piece, dict((name, getattr(piece, name)) for name in self.SCANNED_FIELDS),
+                                   self.validator.top_bids[piece.pk], self.bid_counts.get(piece.pk),
+                                   piece.pk in self.saved_pieces)
+        return piece
+
+    def get_bidder_id(self, bidderid):
+        try:
+            return self.bidder_ids[bidderid]
+        except KeyError:
+            raise BidderId.DoesNotExist()
+
+    def count_bids(self, piece):
+        return self.bid_counts.get(piece.pk, 0)
+
+    def is_top_bid(self, piece, bidder_id, amount):
+        top_bid = self.validator.top_bids[piece.pk]
+        return top_bid is not None and top_bid.bidder_id == bidder_id and top_bid.amount == amount
+
+    def validate_bid(self, bid):
+        self.validator.validate(bid)
+
+    def save_bid(self, bid):
+        self.validator.accept(bid)
+        self.bid_counts[bid.piece_id] = self.bid_counts.get(bid.piece_id, 0) + 1
+        self.new_bids.append(bid)
+
+    def save_piece(self, piece):
+        self.saved_pieces[piece.pk] = piece
+
+    def get_person(self, personid):
+        try:
+            return self.people[personid]
+        except KeyError:
+            raise Person.DoesNotExist()
+
+    def bidder_id_exists(self, bidderid):
+        return bidderid in self.bidder_ids
+
+    def create_bidder_id(self, person, bidderid):
+        # The bidder may not exist yet, so is not known until the flush
+        self.bidder_ids[bidderid] = None
+        self.new_bidder_ids.append((person, bidderid))
+
+    def piece_changes(self):
+        """Return a list of (piece, [(field name, old value, new value), ...]) for each piece that has been changed."""
+        changes = []
+        for piece in self.saved_pieces.values():
+            fields = [(name, old, getattr(piece, name))
+                      for name, old in zip(self.SCANNED_FIELDS, self.original_values[piece.pk])
+                      if getattr(piece, name) != old]
+            if fields:
+                changes.append((piece, fields))
+        changes.sort(key=lambda (piece, fields): (piece.artist_id, piece.pieceid))
+        return changes
+
+    def counts(self):
+        """Return the number of bids created, and of pieces updated, once flushed."""
+        return len(self.new_bids), len(self.saved_pieces)
+
+    def flush(self):
+        # The pieces first, so that nothing else is written if any of them have changed
+        self._update_pieces()
+        new_bidder_ids = []
+        bidders = {}
+        for person, bidderid in self.new_bidder_ids:
+            if person.pk not in bidders:
+                bidders[person.pk], created = Bidder.objects.get_or_create(person=person)
+            new_bidder_ids.append(BidderId(id=bidderid, bidder=bidders[person.pk]))
+        BidderId.objects.bulk_create(new_bidder_ids)
+        Bid.objects.bulk_create(self.new_bids)
+        # bulk_create() doesn't send the signals that keep these up to date.
+        Piece.objects.rebuild_top_bids(set(bid.piece_id for bid in self.new_bids))
+
+    def _update_pieces(self):
+        """Write the fields the scans change, to the pieces whose scanned fields and top bid are still as
+        they were fetched. Pieces are saved whole, so they are grouped by the values they had, and have."""
+        groups = {}
+        for piece in self.saved_pieces.values():
+            key = (tuple(getattr(piece, name) for name in self.SCANNED_FIELDS),
+                   tuple(self.original_values[piece.pk]), self.original_top_bids[piece.pk])
+            groups.setdefault(key, []).append(piece.pk)
+        now = timezone.now()
+        changed = []
+        for (values, original_values, (current_bid_id, bid_count)), piece_ids in groups.items():
+            for chunk in self._chunks(piece_ids):
+                unchanged = dict(zip(self.SCANNED_FIELDS, original_values), pk__in=chunk, current_bid=current_bid_id,
+                                 bid_count=bid_count)
+                num_updated = Piece.objects.filter(**unchanged).update(updated=now,
+                                                                        **dict(zip(self.SCANNED_FIELDS, values)))
+                if num_updated != len(chunk):
+                    del unchanged['pk__in']
+                    changed += Piece.objects.filter(pk__in=chunk).exclude(**unchanged).values_list('code', flat=True)
+        if changed:
+            raise BatchProcessingError("pieces were changed while the scan was being processed, so nothing was "
+                                       "changed. Process it again",
+                                       ["%s was changed" % code for code in sorted(changed)])
+
+    @contextmanager
+    def block(self):
+        """Undo the changes made within the block if it raises an exception, as a savepoint would."""
+        self.undo = {}
+        num_bids = len(self.new_bids)
+        num_bidder_ids = len(self.new_bidder_ids)
+        try:
+            yield
+        except:
+            del self.new_bids[num_bids:]
+            for person, bidderid in self.new_bidder_ids[num_bidder_ids:]:
+                del self.bidder_ids[bidderid]
+            del self.new_bidder_ids[num_bidder_ids:]
+            for pk, (piece, fields, top_bid, bid_count, saved) in self.undo.items():
+                for name, value in fields.items():
+                    setattr(piece, name, value)
+                self.validator.top_bids[pk] = top_bid
+                if bid_count is None:
+                    self.bid_counts.pop(pk, None)
                 else:
-                    errors.append("line %d: location block ended without being begun" % lines)
-        if not mo:
-            errors.append("line %d: unknown code %s" % (lines, l))
-            state = StateL.error_skipping
-    if state != StateL.start:
-        errors.append("END: block incomplete")
+                    self.bid_counts[pk] = bid_count
+                if not saved:
+                    self.saved_pieces.pop(pk, None)
+            raise
+        finally:
+            self.undo = None
+
 
-    if errors:
-        raise BatchProcessingError("found errors in processing", errors)
+# The state machine shared by all batch types. Each batch type has a table of handlers, keyed by
+# (state, token kind). ANY matches any state not listed for that kind, and a kind of None is a line that
+# isn't a token of the batch type. Handlers are called as handler(scan, state, line_no, line, match) and
+# return the new state. In the ERROR_SKIPPING state, every line is ignored until a token of one of the
+# batch type's resync_kinds is found.
+
+START = 1
+ERROR_SKIPPING = 99
+ANY = object()
+
+# How many lines are processed between calls to the progress callback
+PROGRESS_INTERVAL = 500
+
+
+class StateL:
+    start = START
+    read_location = 2
+    error_skipping = ERROR_SKIPPING
 
 
 class State:
-    start = 1
+    start = START
     read_piece = 2
     read_bidder = 3
     read_price = 4
-    error_skipping = 99
-
-
-@transaction.atomic
-def process_bids(data, final_scan=False):
-    errors = []
-    state = State.start
-    lines = 0
-    current_piece = None
-    current_bidder = None
-    current_price = None
-    for l in data.splitlines():
-        lines += 1
-        l = l.strip()
-        if l == "":
-            continue
-        mo = piece_scan_re.match(l)
-        if mo:
-            if state not in [State.start, State.error_skipping]:
-                errors.append("line %d: previous block incomplete" % lines)
-            try:
-                current_piece = Piece.objects.get(artist=int(mo.group(1)), pieceid=int(mo.group(2)))
-            except Piece.DoesNotExist:
-                errors.append("line %d: piece %s does not exist" % (lines, l))
-                state = State.error_skipping
-            else:
-                state = State.read_piece
-        if not mo:
-            if state == State.error_skipping:
-                continue
-            mo = bidder_scan_re.match(l)
-            if mo:
-                if state == State.read_piece:
-                    try:
-                        current_bidder = BidderId.objects.get(id=mo.group(1)).bidder
-                    except BidderId.DoesNotExist:
-                        errors.append("line %d: bidder %s does not exist" % (lines, l))
-                        state = State.error_skipping
-                    else:
-                        state = State.read_bidder
-                else:
-                    errors.append("line %d: found bidder scan not immediately after piece" % lines)
-                    state = State.error_skipping
-        if not mo:
-            mo = price_scan_re.match(l)
-            if mo:
-                if state == State.read_bidder:
-                    current_price = int(mo.group(1))
-                    state = State.read_price
-                else:
-                    errors.append("line %d: found price not immediately after bidder" % lines)
-                    state = State.error_skipping
-        if not mo:
-            mo = normal_sale_scan_re.match(l)
-            if mo:
-                if state == State.start:
-                    # Skipping extraneous Normal Sale, a common scanning error
-                    pass
-                elif state == State.read_price:
-                    bid = Bid(bidder=current_bidder, amount=current_price, piece=current_piece)
-                    try:
-                        bid.validate()
-                    except ValidationError, x:
-                        errors.append("line %d: invalid bid: %s" % (lines, x))
-                        continue
-                    bid.save()
-                    if final_scan:
-                        current_piece.bidsheet_scanned = True
-                        current_piece.status = Piece.StatusWon
-                    current_piece.save()
-                    state = State.start
-                else:
-                    errors.append("Line %d: normal sale scan found not immediately after price" % lines)
-                    state = State.error_skipping
-        if not mo:
-            mo = buy_now_scan_re.match(l)
-            if mo:
-                if state == State.read_price:
-                    bid = Bid(bidder=current_bidder, amount=current_price, piece=current_piece, buy_now_bid=True)
-                    try:
-                        bid.validate()
-                    except ValidationError, x:
-                        errors.append("line %d: invalid bid: %s" % (lines, x))
-                        state = State.error_skipping
-                        continue
-                    bid.save()
-                    if final_scan:
-                        current_piece.bidsheet_scanned = True
-                        current_piece.status = Piece.StatusWon
-                    current_piece.save()
-                    state = State.start
-                else:
-                    errors.append("Line %d buy now scan found not immediately after price" % lines)
-                    state = State.error_skipping
-        if not mo:
-            mo = auction_sale_scan_re.match(l)
-            if mo:
-                if state == State.read_price:
-                    bid = Bid(bidder=current_bidder, amount=current_price, piece=current_piece)
-                    try:
-                        bid.validate()
-                    except ValidationError, x:
-                        errors.append("line %d: invalid bid: %s" % (lines, x))
-                        state = State.error_skipping
-                        continue
-                    bid.save()
-                    if final_scan:
-                        current_piece.bidsheet_scanned = True
-                    current_piece.voice_auction = True
-                    current_piece.save()
-                    state = State.start
-                    pass
-                else:
-                    errors.append("Line %d auction sale scan found not immediately after price" % lines)
-                    state = State.error_skipping
-        if not mo:
-            mo = auction_complete_scan_re.match(l)
-            if mo:
-                if state == State.read_price:
-                    bid = Bid(bidder=current_bidder, amount=current_price, piece=current_piece)
-                    try:
-                        bid.validate()
-                    except ValidationError, x:
-                        errors.append("line %d: invalid bid: %s" % ( lines, x ))
-                        state = State.error_skipping
-                        continue
-                    bid.save()
-                    if final_scan:
-                        current_piece.bidsheet_scanned = True
-                        current_piece.status = Piece.StatusWon
-                    current_piece.voice_auction = True
-                    current_piece.save()
-                    state = State.start
-                    pass
-                else:
-                    errors.append("Line %d auction sale scan found not immediately after price" % lines)
-                    state = State.error_skipping
-        if not mo:
-            mo = not_for_sale_scan_re.match(l)
-            if mo:
-                if state == State.read_piece:
-                    if not current_piece.not_for_sale:
-                        errors.append("Line %d Not for sale found on non NFS piece" % lines)
-                        state = State.error_skipping
-                        continue
-                    if final_scan:
-                        current_piece.bidsheet_scanned = True
-                    current_piece.save()
-                    state = State.start
-                    pass
-                else:
-                    errors.append("Line %d: not for sale scan found not immediately after piece" % lines)
-                    state = State.error_skipping
-        if not mo:
-            mo = no_bids_scan_re.match(l)
-            if mo:
-                if state == State.read_piece:
-                    num_bids = current_piece.bid_set.count()
-                    if num_bids > 0:
-                        errors.append("Line %d: No Bid found for pieces with bids" % lines)
-                        state = State.error_skipping
-                        continue
-                    if final_scan:
-                        current_piece.bidsheet_scanned = True
-                    current_piece.save()
-                    state = State.start
-                else:
-                    errors.append("Line %d: no bids scan found not immediately after piece" % lines)
-                    state = State.error_skipping
-
-        if not mo:
-            errors.append("Line %d: found unknown line %s" % (lines, l))
-            state = State.error_skipping
-    if state != StateL.start:
-        errors.append("END: block incomplete")
-
-    if errors:
-        raise BatchProcessingError("found errors in processing", errors)
+    error_skipping = ERROR_SKIPPING
 
 
 class StateCB:
-    start = 1
+    start = START
     read_person = 2
 
-@transaction.atomic
-def process_create_bidderids(data):
-    errors = []
-    state = StateCB.start
-    lines = 0
-    current_person = None
-    for l in data.splitlines():
-        lines += 1
-        l = l.strip()
-        if l == "":
-            continue
-
-        mo = person_scan_re.match(l)
-        if mo:
-            if state != StateCB.start:
-                errors.append("line %d: was expecting bidder ID, found %s" % (lines, l))
+
+class BatchType(object):
+    def __init__(self, kinds, transitions, block_kinds, end_kinds, resync_kinds=()):
+        self.tokenizer = Tokenizer(kinds)
+        self.transitions = transitions
+        self.block_kinds = block_kinds
+        self.end_kinds = end_kinds
+        self.resync_kinds = resync_kinds
+
+    def remove_repeated_blocks(self, tokens):
+        """Remove any complete block that is an exact repeat of an earlier one, as when a scanner sends a block
+        twice. Returns the remaining tokens, and a list of (line number, message) noting each block removed."""
+        seen = {}
+        remaining = []
+        notes = []
+        for block in self.blocks(tokens):
+            if block[-1][2] in self.end_kinds and block[0][2] in self.block_kinds:
+                fingerprint = tuple(line for line_no, line, kind, mo in block)
+                if fingerprint in seen:
+                    notes.append((block[0][0], "line %d: repeat of the block at line %d, skipped" %
+                                  (block[0][0], seen[fingerprint])))
+                    continue
+                seen[fingerprint] = block[0][0]
+            remaining += block
+        return remaining, notes
+
+    def blocks(self, tokens):
+        """Split the tokens into blocks, each starting with a token of one of the block_kinds. Any tokens
+        before the first of those are a block of their own."""
+        blocks = []
+        for token in tokens:
+            if not blocks or token[2] in self.block_kinds:
+                blocks.append([])
+            blocks[-1].append(token)
+        return blocks
+
+    def run(self, scan, tokens):
+        state = START
+        transitions = self.transitions
+        for n, (line_no, line, kind, mo) in enumerate(tokens):
+            if scan.progress and n % PROGRESS_INTERVAL == 0:
+                scan.progress(lines_processed=n, blocks_processed=scan.blocks)
+            if state == ERROR_SKIPPING and kind not in self.resync_kinds:
                 continue
+            handler = transitions.get((state, kind)) or transitions[(ANY, kind)]
+            new_state = handler(scan, state, line_no, line, mo)
+            if new_state == START and state != START:
+                scan.blocks += 1
+            state = new_state
+            if len(scan.errors) > len(scan.error_lines):
+                scan.error_lines += [line_no] * (len(scan.errors) - len(scan.error_lines))
+        if scan.progress:
+            scan.progress(lines_processed=len(tokens), blocks_processed=scan.blocks)
+        if state != START:
+            scan.errors.append("END: block incomplete")
+            scan.error_lines.append(None)
+
+
+class Scan(object):
+    """The working state of one scan being processed."""
+
+    def __init__(self, store, final_scan=False, progress=None):
+        self.store = store
+        self.final_scan = final_scan
+        self.progress = progress
+        self.errors = []
+        # The line number of each error, or None for an error at the end
+        self.error_lines = []
+        # (line number, message) for things that are not errors, but should be reported
+        self.notes = []
+        self.blocks = 0
+        self.location = None
+        self.piece = None
+        self.bidder = None
+        self.price = None
+        self.person = None
+
+
+def error(message, with_line=False, next_state=None):
+    """A handler that records the error message, formatted with the line number (and the line, if with_line),
+    and moves to next_state, or stays in the same state."""
+    def handler(scan, state, line_no, line, mo):
+        scan.errors.append(message % ((line_no, line) if with_line else line_no))
+        return state if next_state is None else next_state
+    return handler
+
+
+# noinspection PyUnusedLocal
+def ignore(scan, state, line_no, line, mo):
+    return state
+
+
+# Locations
+
+# noinspection PyUnusedLocal
+def location_begin(scan, state, line_no, line, mo):
+    if state not in [StateL.start, StateL.error_skipping]:
+        scan.errors.append("line %d: previous block incomplete" % line_no)
+    scan.location = mo.group('location_code')
+    return StateL.read_location
+
+
+# noinspection PyUnusedLocal
+def location_piece(scan, state, line_no, line, mo):
+    try:
+        piece = scan.store.get_piece(int(mo.group('artistid')), int(mo.group('pieceid')))
+    except Piece.DoesNotExist:
+        scan.errors.append("line %d: piece %s does not exist" % (line_no, line))
+        return StateL.error_skipping
+    piece.location = scan.location
+    if piece.status in [Piece.StatusNotInShow, Piece.StatusNotInShowLocked]:
+        piece.status = Piece.StatusInShow
+    scan.store.save_piece(piece)
+    return state
+
+
+locations_batch = BatchType(
+    kinds=('location', 'piece', 'location_end'),
+    block_kinds=('location',),
+    end_kinds=('location_end',),
+    resync_kinds=('location',),
+    transitions={
+        (ANY, 'location'): location_begin,
+        (StateL.read_location, 'piece'): location_piece,
+        (ANY, 'piece'): error("line %d: piece %s not found immediately after location", with_line=True),
+        (StateL.read_location, 'location_end'): lambda scan, state, line_no, line, mo: StateL.start,
+        (ANY, 'location_end'): error("line %d: location block ended without being begun"),
+        (ANY, None): error("line %d: unknown code %s", with_line=True, next_state=StateL.error_skipping),
+    })
+
+
+# Bids
+
+# noinspection PyUnusedLocal
+def bid_piece(scan, state, line_no, line, mo):
+    if state not in [State.start, State.error_skipping]:
+        scan.errors.append("line %d: previous block incomplete" % line_no)
+    try:
+        scan.piece = scan.store.get_piece(int(mo.group('artistid')), int(mo.group('pieceid')))
+    except Piece.DoesNotExist:
+        scan.errors.append("line %d: piece %s does not exist" % (line_no, line))
+        return State.error_skipping
+    return State.read_piece
+
+
+# noinspection PyUnusedLocal
+def bid_bidder(scan, state, line_no, line, mo):
+    try:
+        scan.bidder = scan.store.get_bidder_id(mo.group('bidderid'))
+    except BidderId.DoesNotExist:
+        scan.errors.append("line %d: bidder %s does not exist" % (line_no, line))
+        return State.error_skipping
+    return State.read_bidder
+
+
+# noinspection PyUnusedLocal
+def bid_price(scan, state, line_no, line, mo):
+    scan.price = int(mo.group('amount'))
+    return State.read_price
+
+
+def sale(buy_now_bid=False, won=True, voice_auction=False, state_if_invalid=State.error_skipping):
+    """A handler that places the bid read so far, and then updates the piece as for the kind of sale.
+
+    If the same bid is already the piece's top bid, eg, from an earlier scan of the same bid sheet, it is not
+    placed again, but the piece is still updated. A bid that is recorded, but has been outbid, is placed as
+    usual, and so fails validation."""
+    # noinspection PyUnusedLocal
+    def handler(scan, state, line_no, line, mo):
+        piece = scan.piece
+        if scan.store.is_top_bid(piece, scan.bidder, scan.price):
+            scan.notes.append((line_no, "line %d: bid of %s on A%sP%s is already the top bid, not placed again" %
+                               (line_no, scan.price, piece.artist_id, piece.pieceid)))
+        else:
+            bid = Bid(bidder_id=scan.bidder, amount=scan.price, piece=piece, buy_now_bid=buy_now_bid)
             try:
-                person = Person.objects.get(id=int(mo.group(1)))
-            except Person.DoesNotExist:
-                errors.append("line %d: person %s not found" % (lines, mo.group(1)))
-                continue
-            current_person = person
-            state = StateCB.read_person
-            continue
-
-        mo = bidder_scan_re.match(l)
-        if mo:
-            if state != StateCB.read_person:
-                errors.append("line %d: found bidder id, was not expecting it: %s" % (lines, l))
-                continue
-            bidderid_str = mo.group(1)
+                scan.store.validate_bid(bid)
+            except ValidationError, x:
+                scan.errors.append("line %d: invalid bid: %s" % (line_no, x))
+                return state if state_if_invalid is None else state_if_invalid
+            scan.store.save_bid(bid)
+        if scan.final_scan:
+            piece.bidsheet_scanned = True
+            if won:
+                piece.status = Piece.StatusWon
+        if voice_auction:
+            piece.voice_auction = True
+        scan.store.save_piece(piece)
+        return State.start
+    return handler
+
+
+# noinspection PyUnusedLocal
+def bid_not_for_sale(scan, state, line_no, line, mo):
+    if not scan.piece.not_for_sale:
+        scan.errors.append("Line %d Not for sale found on non NFS piece" % line_no)
+        return State.error_skipping
+    if scan.final_scan:
+        scan.piece.bidsheet_scanned = True
+    scan.store.save_piece(scan.piece)
+    return State.start
+
+
+# noinspection PyUnusedLocal
+def bid_no_bids(scan, state, line_no, line, mo):
+    if scan.store.count_bids(scan.piece) > 0:
+        scan.errors.append("Line %d: No Bid found for pieces with bids" % line_no)
+        return State.error_skipping
+    if scan.final_scan:
+        scan.piece.bidsheet_scanned = True
+    scan.store.save_piece(scan.piece)
+    return State.start
+
+
+bids_batch = BatchType(
+    kinds=('piece', 'bidder', 'price', 'normal_sale', 'buy_now', 'auction_sale', 'auction_complete',
+           'not_for_sale', 'no_bids'),
+    block_kinds=('piece',),
+    end_kinds=('normal_sale', 'buy_now', 'auction_sale', 'auction_complete', 'not_for_sale', 'no_bids'),
+    resync_kinds=('piece',),
+    transitions={
+        (ANY, 'piece'): bid_piece,
+        (State.read_piece, 'bidder'): bid_bidder,
+        (ANY, 'bidder'): error("line %d: found bidder scan not immediately after piece",
+                               next_state=State.error_skipping),
+        (State.read_bidder, 'price'): bid_price,
+        (ANY, 'price'): error("line %d: found price not immediately after bidder", next_state=State.error_skipping),
+        # Skipping extraneous Normal Sale, a common scanning error
+        (State.start, 'normal_sale'): ignore,
+        # An invalid normal sale leaves the block open, so that another sale code can be scanned.
+        (State.read_price, 'normal_sale'): sale(state_if_invalid=None),
+        (ANY, 'normal_sale'): error("Line %d: normal sale scan found not immediately after price",
+                                    next_state=State.error_skipping),
+        (State.read_price, 'buy_now'): sale(buy_now_bid=True),
+        (ANY, 'buy_now'): error("Line %d buy now scan found not immediately after price",
+                                next_state=State.error_skipping),
+        (State.read_price, 'auction_sale'): sale(won=False, voice_auction=True),
+        (ANY, 'auction_sale'): error("Line %d auction sale scan found not immediately after price",
+                                     next_state=State.error_skipping),
+        (State.read_price, 'auction_complete'): sale(voice_auction=True),
+        (ANY, 'auction_complete'): error("Line %d auction sale scan found not immediately after price",
+                                         next_state=State.error_skipping),
+        (State.read_piece, 'not_for_sale'): bid_not_for_sale,
+        (ANY, 'not_for_sale'): error("Line %d: not for sale scan found not immediately after piece",
+                                     next_state=State.error_skipping),
+        (State.read_piece, 'no_bids'): bid_no_bids,
+        (ANY, 'no_bids'): error("Line %d: no bids scan found not immediately after piece",
+                                next_state=State.error_skipping),
+        (ANY, None): error("Line %d: found unknown line %s", with_line=True, next_state=State.error_skipping),
+    })
+
+
+# Bidder ID allocation
+
+# noinspection PyUnusedLocal
+def bidderid_person(scan, state, line_no, line, mo):
+    try:
+        scan.person = scan.store.get_person(int(mo.group('personid')))
+    except Person.DoesNotExist:
+        scan.errors.append("line %d: person %s not found" % (line_no, mo.group('personid')))
+        return state
+    return StateCB.read_person
+
+
+# noinspection PyUnusedLocal
+def bidderid_bidder(scan, state, line_no, line, mo):
+    bidderid_str = mo.group('bidderid')
+    if scan.store.bidder_id_exists(bidderid_str):
+        scan.errors.append("line %d: bidder id already exists: %s" % (line_no, line))
+        return state
+    scan.store.create_bidder_id(scan.person, bidderid_str)
+    return StateCB.start
+
+
+bidderids_batch = BatchType(
+    kinds=('person', 'bidder'),
+    block_kinds=('person',),
+    end_kinds=('bidder',),
+    transitions={
+        (StateCB.start, 'person'): bidderid_person,
+        (ANY, 'person'): error("line %d: was expecting bidder ID, found %s", with_line=True),
+        (StateCB.read_person, 'bidder'): bidderid_bidder,
+        (ANY, 'bidder'): error("line %d: found bidder id, was not expecting it: %s", with_line=True),
+        # Anything else is ignored
+        (ANY, None): ignore,
+    })
+
+
+class ScanMetrics(object):
+    """What processing one scan did, and how long it took.
+
+    The time is split into phases: parsing the lines into tokens, looking up the pieces, bidder IDs and people
+    the scan refers to, applying the blocks, and writing the changes. A BulkStore does all its lookups and writes
+    in the lookup and write phases. A DirectStore does them as each line is applied, so they count as applying."""
+
+    PHASES = ('parse', 'lookup', 'apply', 'write')
+
+    def __init__(self):
+        self.lines = 0
+        self.blocks = 0
+        self.bids_created = 0
+        self.pieces_updated = 0
+        self.queries = 0
+        self.wall_time = 0.0
+        self.phase_times = dict((name, 0.0) for name in self.PHASES)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phase_times[name] += time.time() - start
+
+    @contextmanager
+    def measure(self):
+        """Count the wall time and SQL queries of everything done within."""
+        start = time.time()
+        with QueryCounter() as queries:
             try:
-                BidderId.objects.get(id=bidderid_str)
-                errors.append("line %d: bidder id already exists: %s" % (lines, l))
-                continue
-            except BidderId.DoesNotExist:
-                pass
-            bidder, created = Bidder.objects.get_or_create(person=current_person)
-            bidderid = BidderId(id=bidderid_str, bidder=bidder)
-            bidderid.save()
-            state = StateCB.start
-            continue
+                yield
+            finally:
+                self.queries += queries.count
+                self.wall_time += time.time() - start
+
+
+def process(batch_type, data, store_class=DirectStore, final_scan=False, progress=None, per_block=False,
+            notes=None, metrics=None):
+    """Process the scan, calling progress, if given, with the number of lines (not counting blank ones) and
+    blocks processed so far, and the total number of lines.
+
+    Normally, if there are any errors, nothing is changed and BatchProcessingError is raised. With per_block,
+    each block is applied or undone on its own, as if in a savepoint, and a list of (errors, lines) for each
+    block that failed is returned.
+
+    Blocks that repeat an earlier block, and bids that are already the top bid, are skipped. If notes is given,
+    a (line number, message) is added to it for each.
+
+    If metrics is given, it is a ScanMetrics that the counts and timings are added to. They are added even
+    if BatchProcessingError is raised, though then nothing was created or updated.
+
+    A BulkStore writes nothing until it is flushed, and the flush checks that the pieces haven't changed since
+    they were fetched, so only the flush needs to be in a transaction, and progress saved to the database can be
+    seen by others as it happens. A DirectStore locks each piece as it fetches it, so its scan is processed in
+    one transaction."""
+    if notes is None:
+        notes = []
+    if metrics is None:
+        metrics = ScanMetrics()
+    with metrics.measure():
+        with metrics.phase('parse'):
+            tokens, repeat_notes = batch_type.remove_repeated_blocks(batch_type.tokenizer.tokenize(data))
+        notes += repeat_notes
+        metrics.lines = len(tokens)
+        if progress:
+            progress(lines_total=len(tokens))
+        if store_class.defers_writes:
+            failed_blocks = _process_tokens(batch_type, tokens, store_class, final_scan, progress, per_block, notes,
+                                            metrics)
+        else:
+            with transaction.atomic():
+                failed_blocks = _process_tokens(batch_type, tokens, store_class, final_scan, progress, per_block,
+                                                notes, metrics)
+    notes.sort(key=lambda (line_no, message): line_no)
+    return failed_blocks
+
+
+class BlockFailed(Exception):
+    pass
 
-    if state != StateL.start:
-        errors.append("END: block incomplete")
 
-    if errors:
-        raise BatchProcessingError("found errors in processing", errors)
+def process_block(batch_type, store, tokens, final_scan=False):
+    """Apply the tokens of one block, or undo any changes they made if there are errors. Returns the Scan,
+    with its errors and notes."""
+    scan = Scan(store, final_scan=final_scan)
+    try:
+        with store.block():
+            batch_type.run(scan, tokens)
+            if scan.errors:
+                raise BlockFailed()
+    except BlockFailed:
+        pass
+    return scan
 
 
-def process_batchscan(id):
+def _process_tokens(batch_type, tokens, store_class, final_scan, progress, per_block, notes, metrics):
+    with metrics.phase('lookup'):
+        store = store_class(tokens)
+    failed_blocks = []
+    with metrics.phase('apply'):
+        if per_block:
+            lines_processed = blocks_processed = 0
+            for block in batch_type.blocks(tokens):
+                scan = process_block(batch_type, store, block, final_scan)
+                if scan.errors:
+                    failed_blocks.append((scan.errors, [line for line_no, line, kind, mo in block]))
+                else:
+                    notes += scan.notes
+                    blocks_processed += 1
+                if progress and (lines_processed + len(block)) // PROGRESS_INTERVAL > \
+                        lines_processed // PROGRESS_INTERVAL:
+                    progress(lines_processed=lines_processed + len(block), blocks_processed=blocks_processed)
+                lines_processed += len(block)
+            if progress:
+                progress(lines_processed=lines_processed, blocks_processed=blocks_processed)
+            metrics.blocks = blocks_processed
+        else:
+            scan = Scan(store, final_scan=final_scan, progress=progress)
+            batch_type.run(scan, tokens)
+            metrics.blocks = scan.blocks
+            if scan.errors:
+                raise BatchProcessingError("found errors in processing", scan.errors)
+            notes += scan.notes
+    with metrics.phase('write'):
+        with transaction.atomic():
+            store.flush()
+    metrics.bids_created, metrics.pieces_updated = store.counts()
+    return failed_blocks
+
+
+def process_locations(data, bulk=False, progress=None, per_block=False, notes=None, metrics=None):
+    return process(locations_batch, data, BulkStore if bulk else DirectStore, progress=progress,
+                   per_block=per_block, notes=notes, metrics=metrics)
+
+
+def process_bids(data, final_scan=False, bulk=False, progress=None, per_block=False, notes=None, metrics=None):
+    return process(bids_batch, data, BulkStore if bulk else DirectStore, final_scan=final_scan, progress=progress,
+                   per_block=per_block, notes=notes, metrics=metrics)
+
+
+def process_create_bidderids(data, bulk=False, progress=None, per_block=False, notes=None, metrics=None):
+    return process(bidderids_batch, data, BulkStore if bulk else DirectStore, progress=progress,
+                   per_block=per_block, notes=notes, metrics=metrics)
+
+
+BATCH_TYPES = {
+    1: locations_batch,
+    2: bids_batch,
+    3: bids_batch,
+    4: bidderids_batch,
+}
+
+
+class StreamProcessor(object):
+    """Processes a scan as it is read, line by line, applying each block as soon as its last line is read.
+
+    feed() and finish() return a list of (errors, lines) for each block they complete. The errors are
+    empty if the block was applied. A block is complete when a line that ends a block of its kind is read
+    (eg, a sale code), or when the next block begins, in which case it is incomplete and fails."""
+
+    def __init__(self, batchtype):
+        self.batchtype = batchtype
+        self.batch_type = BATCH_TYPES[batchtype]
+        self.final_scan = batchtype == 3
+        self.store = DirectStore()
+        self.lines = []
+        self.pending = []
+        self.failed_blocks = []
+        self.blocks_applied = 0
+
+    def feed(self, line):
+        line = line.strip()
+        if line == "":
+            return []
+        self.lines.append(line)
+        token = self.batch_type.tokenizer.tokenize_line(len(self.lines), line)
+        results = []
+        if self.pending and token[2] in self.batch_type.block_kinds:
+            results.append(self._process_pending())
+        self.pending.append(token)
+        if token[2] in self.batch_type.end_kinds:
+            results.append(self._process_pending())
+        return results
+
+    def finish(self):
+        """Process any incomplete block left at the end of the scan."""
+        return [self._process_pending()] if self.pending else []
+
+    def _process_pending(self):
+        errors = process_block(self.batch_type, self.store, self.pending, self.final_scan).errors
+        result = (errors, [line for line_no, line, kind, mo in self.pending])
+        if errors:
+            self.failed_blocks.append(result)
+        else:
+            self.blocks_applied += 1
+        self.pending = []
+        return result
+
+    def save(self, date_scanned, **fields):
+        """Record the scan as a processed BatchScan, with any failed blocks copied to a residual BatchScan for
+        correction. Other fields of the BatchScan, such as the device, can be given. Returns the BatchScan."""
+        now = datetime.datetime.now()
+        batchscan = BatchScan(batchtype=self.batchtype, data="".join(line + "\n" for line in self.lines),
+                              date_scanned=date_scanned, per_block=True, processed=True, status=BatchScan.StatusDone,
+                              lines_total=len(self.lines), lines_processed=len(self.lines),
+                              blocks_processed=self.blocks_applied, finished=timezone.now(), **fields)
+        batchscan.save()
+        batchscan.processing_log = _log_failed_blocks(batchscan, self.failed_blocks, now)
+        batchscan.save()
+        return batchscan
+
+
+class DryRunReport(object):
+    """What processing a scan would do, found without changing anything.
+
+    errors is a list of (line number, message), with a line number of None for an error at the end of the
+    scan. piece_changes is a list of (piece, [(field name, old value, new value), ...]), bids is a list of
+    unsaved Bids, and bidder_ids is a list of (person, bidder ID) to be created. Where there are errors,
+    these are what the rest of the scan would do once the errors were corrected.
+
+    notes is a list of (line number, message) for the repeated blocks and the bids already on top that would
+    be skipped. duplicate_of is set by dry_run_batchscan() to the earlier batch scan, if any, that this one
+    is a copy of."""
+
+    def __init__(self, scan, store, notes):
+        self.errors = zip(scan.error_lines, scan.errors)
+        self.notes = sorted(notes + scan.notes, key=lambda (line_no, message): line_no)
+        self.piece_changes = store.piece_changes()
+        self.bids = list(store.new_bids)
+        self.bidder_ids = list(store.new_bidder_ids)
+        self.duplicate_of = None
+
+    def as_text(self):
+        lines = []
+        if self.duplicate_of:
+            lines.append("Duplicate of %s, which has already been processed" % self.duplicate_of)
+        lines.append("%d errors, %d pieces changed, %d bids, %d bidder IDs" %
+                     (len(self.errors), len(self.piece_changes), len(self.bids), len(self.bidder_ids)))
+        lines += [message for line_no, message in self.errors]
+        lines += [message for line_no, message in self.notes]
+        for piece, fields in self.piece_changes:
+            lines.append("%s: %s" % (piece.code, ", ".join("%s %s -> %s" % field for field in fields)))
+        for bid in self.bids:
+            lines.append("%s: bid %s by bidder %s%s" % (bid.piece.code, bid.amount, bid.bidder_id,
+                                                        " (buy now)" if bid.buy_now_bid else ""))
+        for person, bidderid in self.bidder_ids:
+            lines.append("%s: bidder ID %s" % (person.name, bidderid))
+        return "\n".join(lines)
+
+
+def dry_run(batchtype, data):
+    """Check the scan against the pieces, bidders and people it refers to, fetched in bulk, and return a
+    DryRunReport of what processing it would do. Nothing is written."""
+    batch_type = BATCH_TYPES[batchtype]
+    tokens, notes = batch_type.remove_repeated_blocks(batch_type.tokenizer.tokenize(data))
+    store = BulkStore(tokens)
+    scan = Scan(store, final_scan=(batchtype == 3))
+    batch_type.run(scan, tokens)
+    return DryRunReport(scan, store, notes)
+
+
+def dry_run_batchscan(batchscan):
+    """Dry run the batch scan, and record the number of errors found, and the report, on it."""
+    report = dry_run(batchscan.batchtype, batchscan.data)
+    report.duplicate_of = find_duplicate(batchscan)
+    batchscan.dry_run_errors = len(report.errors)
+    batchscan.dry_run_report = report.as_text()
+    BatchScan.objects.filter(id=batchscan.id).update(dry_run_errors=batchscan.dry_run_errors,
+                                                     dry_run_report=batchscan.dry_run_report)
+    return report
+
+
+# The batch types whose batch scans are skipped if they are copies of earlier ones
+DUPLICATE_BATCHTYPES = (2, 3)
+
+
+def find_duplicate(batchscan):
+    """Return an earlier batch scan of bids with the same content that was processed without errors, or None.
+
+    Batch scans that had blocks fail are not counted, as the failed blocks may be scanned again unchanged. Only
+    bids are checked, as scanning the same locations again is how a piece that has been moved is moved back."""
+    if batchscan.batchtype not in DUPLICATE_BATCHTYPES:
+        return None
+    return BatchScan.objects.filter(content_hash=batchscan.content_hash, batchtype=batchscan.batchtype,
+                                    processed=True, residuals__isnull=True) \
+        .exclude(id=batchscan.id).order_by('id').first()
+
+
+def _log_failed_blocks(batchscan, failed_blocks, now, notes=()):
+    """Copy any failed blocks to a residual batch scan, and return the processing log for batchscan."""
+    notes = [message for line_no, message in notes]
+    if not failed_blocks:
+        return "\n".join(["%s\nProcessing Complete" % now] + notes)
+    errors = sum((block_errors for block_errors, lines in failed_blocks), [])
+    residual_data = "".join(line + "\n" for block_errors, lines in failed_blocks for line in lines)
+    residual = BatchScan.objects.create(
+        batchtype=batchscan.batchtype, data=residual_data, date_scanned=batchscan.date_scanned,
+        device=batchscan.device, per_block=True, residual_of=batchscan,
+        processing_log="\n".join([str(now), "blocks that failed in %s" % batchscan] + errors))
+    return "\n".join(["%s\nProcessing Complete, except for %d blocks, which are in %s" %
+                      (now, len(failed_blocks), residual)] + errors + notes)
+
+
+def process_batchscan(id, bulk=True):
+    """Process the batch scan. With bulk, locations and bids are checked against pieces and bidder IDs fetched
+    in a few queries, and written in bulk. Otherwise, each is fetched and saved as it is scanned.
+
+    If the batch scan is marked per_block, the blocks without errors are applied, and the ones with errors are
+    copied to a new batch scan to be corrected and processed again.
+
+    A batch scan that is a copy of one already processed is skipped.
+
+    Progress is recorded on the batch scan as it goes, and its status is set to Done or Failed at the end, along
+    with the metrics of the processing."""
     batchscan = BatchScan.objects.get(id=id)
+    duplicate = find_duplicate(batchscan)
     now = datetime.datetime.now()
     if batchscan.processed:
         log_str = "%s\nAlready Processed" % now
         batchscan.processing_log = log_str
-        batchscan.save()
+        batchscan.status = BatchScan.StatusDone
     elif batchscan.batchtype not in [1, 2, 3, 4]:
         log_str = "%s\nUnknown batchtype" % now
         batchscan.processing_log = log_str
-        batchscan.save()
+        batchscan.status = BatchScan.StatusFailed
+    elif duplicate:
+        log_str = "%s\nDuplicate of %s, which has already been processed. Skipped" % (now, duplicate)
+        batchscan.processing_log = log_str
+        batchscan.processed = True
+        batchscan.status = BatchScan.StatusDone
     else:
+        notes = []
+        metrics = ScanMetrics()
+        kwargs = {'progress': batchscan.report_progress, 'per_block': batchscan.per_block, 'notes': notes,
+                  'metrics': metrics}
         try:
             if batchscan.batchtype == 1:
-                process_locations(batchscan.data)
+                failed_blocks = process_locations(batchscan.data, bulk=bulk, **kwargs)
             elif batchscan.batchtype in [2, 3]:
-                process_bids(batchscan.data, final_scan=(batchscan.batchtype == 3))
-            elif batchscan.batchtype == 4:
-                process_create_bidderids(batchscan.data)
+                failed_blocks = process_bids(batchscan.data, final_scan=(batchscan.batchtype == 3), bulk=bulk,
+                                             **kwargs)
+            else:
+                failed_blocks = process_create_bidderids(batchscan.data, bulk=bulk, **kwargs)
         except BatchProcessingError, x:
             log_str = "\n".join([str(now), str(x)] + x.errorlist)
             batchscan.processing_log = log_str
-            batchscan.save()
+            batchscan.status = BatchScan.StatusFailed
         else:
-            log_str = "%s\nProcessing Complete" % now
+            log_str = _log_failed_blocks(batchscan, failed_blocks, now, notes)
             batchscan.processing_log = log_str
             batchscan.processed = True
-            batchscan.save()
+            batchscan.status = BatchScan.StatusDone
+        batchscan.record_metrics(metrics)
+    batchscan.finished = timezone.now()
+    batchscan.save()
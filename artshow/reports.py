@@ -16,8 +16,8 @@ def index(request):
 @permission_required('artshow.is_artshow_staff')
 def artists(request):
     query = request.GET.get('q', 'all')
-    artists = Artist.objects.annotate(requested=Sum("allocation__requested"),
-                                      allocated=Sum("allocation__allocated"))
+    artists = Artist.objects.select_related('person').annotate(requested=Sum("allocation__requested"),
+                                                               allocated=Sum("allocation__allocated"))
     artists = list(artists)
     artists.sort(key=lambda x: x.artistname().lower())
     return render(request, 'artshow/reports-artists.html', {'artists': artists, 'query': query})
@@ -25,7 +25,8 @@ def artists(request):
 
 @permission_required('artshow.is_artshow_staff')
 def winning_bidders(request):
-    bidders = Bidder.objects.all().annotate(first_bidderid=Min('bidderid')).order_by('first_bidderid')
+    bidders = Bidder.objects.with_winnings(
+        Bidder.objects.annotate(first_bidderid=Min('bidderid')).order_by('first_bidderid'))
     return render(request, 'artshow/reports-winning-bidders.html', {'bidders': bidders})
 
 
@@ -55,13 +56,23 @@ def panel_artist_report(request):
 @permission_required('artshow.is_artshow_staff')
 def artist_payment_report(request):
     non_zero = request.GET.get('nonzero', '0') == '1'
-    artists = Artist.objects.annotate(total=Sum('payment__amount')).order_by("artistid")
+    artists = Artist.objects.select_related('person', 'ledger').prefetch_related('payment_set').order_by("artistid")
     # TODO clean this up if/when we change the way "pending fees" are included in accounting.
     artists = list(artists)
+    # Ledgers missing after loading fixtures are calculated together, and not saved.
+    missing = []
+    for a in artists:
+        try:
+            a.ledger
+        except ArtistLedger.DoesNotExist:
+            missing.append(a)
+    if missing:
+        ledgers = ArtistLedger.objects.calculate_all([a.artistid for a in missing])
+        for a in missing:
+            a.ledger = ledgers[a.artistid]
     for a in artists:
-        a.total = a.total or 0
         a.total_requested_cost, a.deduction_to_date, a.deduction_remaining = a.deduction_remaining_with_details()
-        a.total -= a.deduction_remaining
+        a.total = a.balance() - a.deduction_remaining
     if non_zero:
         artists = [a for a in artists if a.total != 0]
     return render(request, 'artshow/artist-payment-report.html', {'artists': artists, 'non_zero': non_zero})
@@ -69,7 +80,7 @@ def artist_payment_report(request):
 
 def get_summary_statistics():
 
-    pieces = Piece.objects.all()
+    pieces = Piece.objects.only('adult', 'status', 'voice_auction', 'current_bid_amount')
 
     class Stats:
         pieces_entered = 0
@@ -94,26 +105,24 @@ def get_summary_statistics():
         if p.status not in [Piece.StatusNotInShow, Piece.StatusNotInShowLocked]:
             all_stats.pieces_showing += 1
             section_stats.pieces_showing += 1
-        try:
-            top_bid = p.top_bid()
+        top_bid_amount = p.current_bid_amount
+        if top_bid_amount is not None:
             all_stats.bids += 1
             section_stats.bids += 1
-            all_stats.bidamt += top_bid.amount
-            section_stats.bidamt += top_bid.amount
-            all_stats.highest_amt = max(all_stats.highest_amt, top_bid.amount)
-            section_stats.highest_amt = max(section_stats.highest_amt, top_bid.amount)
+            all_stats.bidamt += top_bid_amount
+            section_stats.bidamt += top_bid_amount
+            all_stats.highest_amt = max(all_stats.highest_amt, top_bid_amount)
+            section_stats.highest_amt = max(section_stats.highest_amt, top_bid_amount)
             if p.voice_auction:
                 all_stats.pieces_va += 1
                 section_stats.pieces_va += 1
-                all_stats.bidamt_va += top_bid.amount
-                section_stats.bidamt_va += top_bid.amount
-                all_stats.highest_amt_va = max(all_stats.highest_amt_va, top_bid.amount)
-                section_stats.highest_amt_va = max(section_stats.highest_amt_va, top_bid.amount)
+                all_stats.bidamt_va += top_bid_amount
+                section_stats.bidamt_va += top_bid_amount
+                all_stats.highest_amt_va = max(all_stats.highest_amt_va, top_bid_amount)
+                section_stats.highest_amt_va = max(section_stats.highest_amt_va, top_bid_amount)
             else:
-                all_stats.highest_amt_sa = max(all_stats.highest_amt_sa, top_bid.amount)
-                section_stats.highest_amt_sa = max(section_stats.highest_amt_sa, top_bid.amount)
-        except Bid.DoesNotExist:
-            pass
+                all_stats.highest_amt_sa = max(all_stats.highest_amt_sa, top_bid_amount)
+                section_stats.highest_amt_sa = max(section_stats.highest_amt_sa, top_bid_amount)
 
     artists = Artist.objects.all()
     num_artists = num_showing_artists = num_active_artists = 0
@@ -137,15 +146,17 @@ def get_summary_statistics():
         ip['payment_method_desc'] = payment_method_choice_dict[ip['payment_method']]
     total_invoice_payments = InvoicePayment.objects.aggregate(total=Sum('amount'))['total'] or Decimal(0)
 
-    spaces = Space.objects.annotate(requested=Sum('allocation__requested'), allocated2=Sum('allocation__allocated'))
+    spaces = Space.objects.with_totals()
     total_spaces = {'available': 0, 'requested': 0, 'allocated': 0, 'requested_perc': 0, 'allocated_perc': 0}
     for s in spaces:
         total_spaces['available'] += s.available or 0
-        total_spaces['requested'] += s.requested or 0
-        total_spaces['allocated'] += s.allocated2 or 0
+        total_spaces['requested'] += s.requested_total or 0
+        total_spaces['allocated'] += s.allocated_total or 0
         if s.available:
-            s.requested_perc = s.requested / s.available * 100 if s.requested is not None and s.available > 0 else 0
-            s.allocated_perc = s.allocated2 / s.available * 100 if s.allocated2 is not None and s.available > 0 else 0
+            s.requested_perc = s.requested_total / s.available * 100 \
+                if s.requested_total is not None and s.available > 0 else 0
+            s.allocated_perc = s.allocated_total / s.available * 100 \
+                if s.allocated_total is not None and s.available > 0 else 0
         else:
             s.requested_perc = 0
             s.allocated_perc = 0
@@ -207,15 +218,9 @@ def voice_auction(request):
 def sales_percentiles(request):
     groups = int(request.GET.get('groups', '20'))
 
-    amounts = []
     perc_amounts = []
-    pieces = Piece.objects.exclude(status=Piece.StatusNotInShow)
-    for p in pieces:
-        try:
-            tb = p.top_bid()
-            amounts.append(tb.amount)
-        except Bid.DoesNotExist:
-            pass
+    amounts = list(Piece.objects.exclude(status=Piece.StatusNotInShow).filter(current_bid_amount__isnull=False)
+                   .values_list('current_bid_amount', flat=True))
 
     if amounts:
         amounts.sort()
@@ -225,7 +230,7 @@ def sales_percentiles(request):
         for i in range(1, groups):
             j = float(i) * num_amounts / groups
             j_before = int(j)
-            j_after = j_before + 1
+            j_after = min(j_before + 1, num_amounts - 1)
             amount = float(amounts[j_before]) * (j_after - j) + float(amounts[j_after]) * (j - j_before)
             perc_amounts.append({'perc': float(i) / groups, 'amount': amount})
         perc_amounts.append({'perc': 1.0, 'amount': float(amounts[-1])})
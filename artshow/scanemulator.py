@@ -0,0 +1,314 @@
+# Artshow Jockey
+# Copyright (C) 2009-2014 Chris Cogdon
+# See file COPYING for licence details
+
+"""Emulated barcode scanners, for testing scannerreader and processbatchscan at show rates without the hardware.
+
+Each emulated scanner is a pseudo-terminal. scannerreader reads the slave end, eg, /dev/pts/5, and the
+emulator writes scan lines to the master end, at the pace given, with a quiet gap between batches so that
+scannerreader saves each as a batch scan. The database is polled for the batch scans saved, which are
+matched to the batches sent by their device and content_hash, to find the latency from the last line of each
+batch being scanned to the batch scan being committed, to within the poll interval, and, if they are
+processed, to their processing finishing.
+"""
+
+import calendar
+import os
+import pty
+import string
+import time
+import tty
+
+from django.utils import timezone
+from .models import BatchScan, BidderId, Piece
+
+
+# Synthetic scans. pieces is a list of (artistid, pieceid), and bidder_ids a list of bidder IDs, to choose from.
+# Without them, the codes are made up, and the pieces and bidders will mostly not exist.
+
+def _piece_code(rnd, pieces):
+    if pieces:
+        return "A%dP%d" % rnd.choice(pieces)
+    return "A%dP%d" % (rnd.randint(1, 300), rnd.randint(1, 20))
+
+
+def _bidder_code(rnd, bidder_ids):
+    return "B%s" % (rnd.choice(bidder_ids) if bidder_ids else rnd.randint(1, 2000))
+
+
+def locations_lines(rnd, num_lines, pieces=None):
+    lines = []
+    while len(lines) < num_lines:
+        lines.append("L%s%d" % (rnd.choice("ABCDEFGH"), rnd.randint(1, 40)))
+        for i in range(rnd.randint(1, 20)):
+            lines.append(_piece_code(rnd, pieces))
+        lines.append("LEND")
+    return lines
+
+
+def bids_lines(rnd, num_lines, pieces=None, bidder_ids=None):
+    lines = []
+    while len(lines) < num_lines:
+        lines.append(_piece_code(rnd, pieces))
+        choice = rnd.random()
+        if choice < 0.1:
+            lines.append("NB")
+        else:
+            lines += [_bidder_code(rnd, bidder_ids), "%d" % rnd.randint(10, 500)]
+            lines.append("NAS" if choice < 0.2 else "NS")
+    return lines
+
+
+def show_codes(limit=1000):
+    """Return the (artistid, pieceid) of up to limit pieces in the show, and up to limit bidder IDs, so that
+    synthetic scans refer to things that exist."""
+    pieces = list(Piece.objects.filter(status=Piece.StatusInShow).order_by('artist', 'pieceid')
+                  .values_list('artist', 'pieceid')[:limit])
+    bidder_ids = list(BidderId.objects.order_by('id').values_list('id', flat=True)[:limit])
+    return pieces, bidder_ids
+
+
+def synthetic_batches(rnd, batchtype, num_batches, num_lines, pieces=None, bidder_ids=None):
+    """Return a list of num_batches synthetic batches of the batch type, each a list of about num_lines lines."""
+    if batchtype == 1:
+        return [locations_lines(rnd, num_lines, pieces) for i in range(num_batches)]
+    return [bids_lines(rnd, num_lines, pieces, bidder_ids) for i in range(num_batches)]
+
+
+def recorded_batches(f):
+    """Read recorded batches from a file of scan lines, with the batches separated by blank lines."""
+    batches = [[]]
+    for line in f:
+        line = line.strip()
+        if line:
+            batches[-1].append(line)
+        elif batches[-1]:
+            batches.append([])
+    return [batch for batch in batches if batch]
+
+
+def malform(rnd, line):
+    """Return a line damaged as a misread or mis-scanned barcode might be."""
+    choice = rnd.randint(0, 3)
+    if choice == 0 and len(line) > 1:
+        # Cut short
+        return line[:rnd.randint(1, len(line) - 1)]
+    elif choice == 1:
+        # A character misread
+        pos = rnd.randint(0, len(line) - 1)
+        return line[:pos] + rnd.choice(string.ascii_uppercase + string.digits) + line[pos + 1:]
+    elif choice == 2:
+        # A barcode that isn't one of ours
+        return "".join(rnd.choice(string.digits) for i in range(13))
+    else:
+        return "".join(rnd.choice(string.printable[:94]) for i in range(rnd.randint(1, 20)))
+
+
+class EmulatedScanner(object):
+    """A pseudo-terminal for scannerreader to read, as if a scanner were connected to it."""
+
+    def __init__(self):
+        self.master, self.slave = pty.openpty()
+        # No echo, and no line editing, as for a serial scanner. The slave is kept open, so that the lines
+        # written are kept until scannerreader opens it.
+        tty.setraw(self.slave)
+        self.name = os.ttyname(self.slave)
+
+    def write(self, line):
+        os.write(self.master, line + "\n")
+
+    def close(self):
+        """Disconnect, so that scannerreader stops reading this scanner."""
+        os.close(self.master)
+        os.close(self.slave)
+
+
+class Pacing(object):
+    """How fast the lines of each batch are scanned.
+
+    Lines are scanned rate per second. With burst, they are scanned burst at a time, as fast as they can be
+    written, with burst_pause seconds between bursts. Each wait is varied randomly by up to jitter of itself.
+    There are gap seconds between batches, which must be longer than scannerreader's --timeout for each batch
+    to be saved separately."""
+
+    def __init__(self, rate=10.0, burst=0, burst_pause=1.0, gap=7.0, jitter=0.0):
+        self.rate = rate
+        self.burst = burst
+        self.burst_pause = burst_pause
+        self.gap = gap
+        self.jitter = jitter
+
+    def _vary(self, rnd, seconds):
+        return seconds * (1 + rnd.uniform(-self.jitter, self.jitter)) if self.jitter else seconds
+
+    def waits(self, rnd, num_lines):
+        """Return the seconds to wait before each of the lines of a batch."""
+        waits = []
+        for n in range(num_lines):
+            if n == 0:
+                waits.append(0.0)
+            elif self.burst:
+                waits.append(self._vary(rnd, self.burst_pause) if n % self.burst == 0 else 0.0)
+            else:
+                waits.append(self._vary(rnd, 1.0 / self.rate))
+        return waits
+
+    def gap_wait(self, rnd):
+        return self._vary(rnd, self.gap)
+
+
+class SentBatch(object):
+    def __init__(self, scanner, lines, batchtype=None, malformed=0):
+        self.scanner = scanner
+        self.lines = lines
+        self.batchtype = batchtype
+        self.malformed = malformed
+        self.content_hash = BatchScan.hash_data("\n".join(lines))
+        self.first_sent = None
+        self.last_sent = None
+        self.batchscan = None
+        # When the batch scan was first found in the database
+        self.found = None
+
+    def saved_latency(self):
+        if self.found is None:
+            return None
+        return self.found - self.last_sent
+
+    def processed_latency(self):
+        if self.batchscan is None or self.batchscan.finished is None or \
+                self.batchscan.status not in (BatchScan.StatusDone, BatchScan.StatusFailed):
+            return None
+        return _seconds(self.batchscan.finished) - self.last_sent
+
+
+def _seconds(dt):
+    """Seconds since the epoch of a datetime from the database, as for time.time()."""
+    if timezone.is_aware(dt):
+        return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+    return time.mktime(dt.timetuple()) + dt.microsecond / 1e6
+
+
+def schedule(rnd, scanners_batches, pacing, start, malformed=0.0, batchtype=None):
+    """Plan when each line is scanned. scanners_batches is a list of (scanner, [batch lines, ...]), and each
+    scanner scans its batches in turn, at the same time as the others. Each line is malformed with a
+    probability of malformed. batchtype, if given, is the type of all the batches.
+
+    Returns the SentBatches, and a sorted list of events of (time, sequence, sent batch, line)."""
+    sent_batches = []
+    events = []
+    for scanner, batches in scanners_batches:
+        at = start
+        for batch_lines in batches:
+            lines = [malform(rnd, line) if malformed and rnd.random() < malformed else line for line in batch_lines]
+            sent = SentBatch(scanner, lines, batchtype, sum(1 for a, b in zip(lines, batch_lines) if a != b))
+            sent_batches.append(sent)
+            for wait, line in zip(pacing.waits(rnd, len(lines)), lines):
+                at += wait
+                events.append((at, len(events), sent, line))
+            at += pacing.gap_wait(rnd)
+    events.sort()
+    return sent_batches, events
+
+
+def send(events, poll=None, poll_interval=0.1):
+    """Write each line at its time, calling poll, if given, at least every poll_interval seconds meanwhile."""
+    last_poll = time.time()
+    for at, sequence, sent, line in events:
+        while True:
+            now = time.time()
+            if poll and now - last_poll >= poll_interval:
+                poll()
+                last_poll = now = time.time()
+            if now >= at:
+                break
+            time.sleep(min(at - now, poll_interval) if poll else at - now)
+        sent.scanner.write(line)
+        sent.last_sent = time.time()
+        if sent.first_sent is None:
+            sent.first_sent = sent.last_sent
+
+
+class Collector(object):
+    """Finds the batch scans saved for the batches sent. With queue, each is given its batch type, if it was
+    saved without one, and queued for the processbatchscans workers as soon as it is found."""
+
+    def __init__(self, sent_batches, since, queue=False):
+        self.sent_batches = sent_batches
+        self.since = since
+        self.queue = queue
+        self.devices = sorted(set(sent.scanner.name for sent in sent_batches))
+
+    def poll(self):
+        found = dict((sent.batchscan.id, sent) for sent in self.sent_batches if sent.batchscan)
+        waiting = {}
+        for sent in self.sent_batches:
+            if sent.batchscan is None and sent.last_sent is not None:
+                waiting.setdefault((sent.scanner.name, sent.content_hash), []).append(sent)
+        if waiting:
+            for batchscan in BatchScan.objects.filter(device__in=self.devices, date_scanned__gte=self.since,
+                                                      residual_of__isnull=True).exclude(id__in=found).order_by('id'):
+                matches = waiting.get((batchscan.device, batchscan.content_hash))
+                if matches:
+                    sent = matches.pop(0)
+                    sent.batchscan = batchscan
+                    sent.found = time.time()
+                    if self.queue:
+                        self._queue(sent)
+        if self.queue:
+            # Fetch the status of the ones still being processed
+            unfinished = [id for id, sent in found.items() if sent.processed_latency() is None]
+            for batchscan in BatchScan.objects.filter(id__in=unfinished):
+                found[batchscan.id].batchscan = batchscan
+
+    def _queue(self, sent):
+        if sent.batchscan.batchtype == 0 and sent.batchtype:
+            BatchScan.objects.filter(id=sent.batchscan.id).update(batchtype=sent.batchtype)
+        BatchScan.objects.enqueue(BatchScan.objects.filter(id=sent.batchscan.id))
+
+    def done(self):
+        if self.queue:
+            return all(sent.processed_latency() is not None for sent in self.sent_batches)
+        return all(sent.batchscan is not None for sent in self.sent_batches)
+
+    def wait(self, seconds, poll_interval=0.1):
+        """Poll until every batch has been found, and processed if queued, or for at most seconds."""
+        deadline = time.time() + seconds
+        while True:
+            self.poll()
+            if self.done() or time.time() >= deadline:
+                return
+            time.sleep(poll_interval)
+
+
+def percentile(values, fraction):
+    """The value that the fraction of the sorted values are at or below."""
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def latency_summary(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return "none"
+    return "min %.3fs, median %.3fs, 95%% %.3fs, max %.3fs" % (
+        latencies[0], percentile(latencies, 0.5), percentile(latencies, 0.95), latencies[-1])
+
+
+def report(sent_batches):
+    """Return a summary of what was sent, and the latencies of the batches found, as a list of lines."""
+    num_lines = sum(len(sent.lines) for sent in sent_batches)
+    malformed_lines = sum(sent.malformed for sent in sent_batches)
+    sent_times = [sent.first_sent for sent in sent_batches] + [sent.last_sent for sent in sent_batches]
+    elapsed = max(sent_times) - min(sent_times) if sent_batches else 0
+    saved = [sent.saved_latency() for sent in sent_batches if sent.saved_latency() is not None]
+    processed = [sent.processed_latency() for sent in sent_batches if sent.processed_latency() is not None]
+    lines = ["sent %d batches, %d lines (%d malformed) in %.1fs, %.1f lines/s" % (
+        len(sent_batches), num_lines, malformed_lines, elapsed, num_lines / elapsed if elapsed else 0),
+        "saved:     %d of %d batches, latency %s" % (len(saved), len(sent_batches), latency_summary(saved))]
+    if any(sent.batchscan and sent.batchscan.status != BatchScan.StatusNew for sent in sent_batches):
+        lines.append("processed: %d of %d batches, latency %s" % (len(processed), len(sent_batches),
+                                                                  latency_summary(processed)))
+        failed = sum(1 for sent in sent_batches if sent.batchscan and sent.batchscan.status == BatchScan.StatusFailed)
+        if failed:
+            lines.append("           %d batches failed processing" % failed)
+    return lines
@@ -0,0 +1,152 @@
+# Artshow Jockey
+# Copyright (C) 2009-2014 Chris Cogdon
+# See file COPYING for licence details
+
+"""An append-only journal of everything read from the scanners, so that batches that were being read when
+scannerreader or the database died can be recovered without rescanning.
+
+Each record is one line: the time (seconds since the epoch), the device, the event, and its value,
+separated by tabs. The events are:
+
+    B   a batch begins. The value is the batch type being streamed, or empty.
+    L   a line was scanned. The value is the line.
+    S   the batch was saved. The value is the BatchScan's id.
+
+A batch is identified by the offset of its B record in the journal, which is recorded on the BatchScan
+as journal_offset.
+"""
+
+import datetime
+import mmap
+import os
+import time
+
+from django.conf import settings
+from django.utils import timezone
+from .models import BatchScan
+
+
+class ScanJournal(object):
+    """Writes records to the journal. Each is flushed to disk before the method returns.
+
+    Offsets are only correct if this is the only writer of the journal, so each scannerreader process
+    should have its own."""
+
+    def __init__(self, path):
+        self.f = open(path, "ab")
+
+    def _write(self, device, event, value):
+        offset = os.fstat(self.f.fileno()).st_size
+        self.f.write("%.6f\t%s\t%s\t%s\n" % (time.time(), device, event, value))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        return offset
+
+    def begin(self, device, batchtype=None):
+        """Record the start of a batch, returning its offset."""
+        return self._write(device, "B", "" if batchtype is None else batchtype)
+
+    def line(self, device, line):
+        self._write(device, "L", line)
+
+    def saved(self, device, batchscan):
+        self._write(device, "S", batchscan.id)
+
+    def close(self):
+        self.f.close()
+
+
+class JournalBatch(object):
+    def __init__(self, device, offset, begun, batchtype):
+        self.device = device
+        self.offset = offset
+        self.begun = begun
+        self.batchtype = batchtype
+        self.saved = False
+        self.end = None
+        self.lines = []
+        self.last_scanned = begun
+
+
+def _timestamp(value):
+    scanned = datetime.datetime.utcfromtimestamp(float(value)).replace(tzinfo=timezone.utc)
+    if not settings.USE_TZ:
+        scanned = timezone.make_naive(scanned, timezone.get_default_timezone())
+    return scanned
+
+
+def find_unsaved_batches(path):
+    """Return the batches in the journal that were never saved, with their lines.
+
+    The journal is memory-mapped, and only the B and S records are read on the first pass. The lines of
+    an unsaved batch are read on a second pass, that starts at the batch's offset."""
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    with open(path, "rb") as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return _find_unsaved_batches(m, size)
+        finally:
+            m.close()
+
+
+def _records(m, start, end):
+    """Yield the offsets of the start and end of each complete record from start to end, and of its device and
+    event fields."""
+    pos = start
+    while pos < end:
+        record_end = m.find("\n", pos, end)
+        if record_end == -1:
+            # A record cut short by a crash
+            return
+        device_start = m.find("\t", pos, record_end) + 1
+        event_start = m.find("\t", device_start, record_end) + 1
+        if device_start and event_start:
+            yield pos, record_end, device_start, event_start
+        pos = record_end + 1
+
+
+def _find_unsaved_batches(m, size):
+    open_batches = {}
+    batches = []
+    for pos, record_end, device_start, event_start in _records(m, 0, size):
+        event = m[event_start]
+        if event == "L":
+            continue
+        time_str, device, event, value = m[pos:record_end].split("\t", 3)
+        if event == "B":
+            if device in open_batches:
+                open_batches[device].end = pos
+            batch = open_batches[device] = JournalBatch(device, pos, _timestamp(time_str),
+                                                        int(value) if value else None)
+            batches.append(batch)
+        elif event == "S" and device in open_batches:
+            open_batches.pop(device).saved = True
+
+    unsaved = [b for b in batches if not b.saved and not BatchScan.objects.filter(
+        device=b.device, journal_offset=b.offset, date_scanned__gte=b.begun).exists()]
+    for batch in unsaved:
+        device_field = batch.device + "\t"
+        for pos, record_end, device_start, event_start in _records(m, batch.offset, batch.end or size):
+            if m[event_start] == "L" and m[device_start:event_start] == device_field:
+                time_str, device, event, value = m[pos:record_end].split("\t", 3)
+                batch.lines.append(value)
+                batch.last_scanned = _timestamp(time_str)
+    return unsaved
+
+
+def replay(path):
+    """Save a BatchScan for each batch in the journal that was never saved. Returns the new BatchScans."""
+    batchscans = []
+    for batch in find_unsaved_batches(path):
+        log = ["%s\nRecovered from scanner journal %s at offset %d" % (datetime.datetime.now(), path, batch.offset)]
+        streamed = batch.batchtype is not None
+        if streamed:
+            log.append("This batch was being streamed, so some of its blocks may already have been applied")
+        batchscan = BatchScan.objects.create(
+            batchtype=batch.batchtype or 0, data="".join(line + "\n" for line in batch.lines),
+            date_scanned=batch.last_scanned, device=batch.device, journal_offset=batch.offset,
+            per_block=streamed, processing_log="\n".join(log))
+        batchscans.append(batchscan)
+    return batchscans
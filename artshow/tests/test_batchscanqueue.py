@@ -0,0 +1,129 @@
+from StringIO import StringIO
+import datetime
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils.timezone import now
+from ..models import Artist, BatchScan, Bid, Bidder, BidderId, Person, Piece
+
+
+class BatchScanQueueTests (TestCase):
+    def setUp(self):
+        artist = Artist.objects.create(artistid=1, person=Person.objects.create(name="Artist"))
+        for pieceid in range(1, 4):
+            Piece.objects.create(artist=artist, pieceid=pieceid, name="Piece", min_bid=10)
+
+    def batchscan(self, data, batchtype=1):
+        return BatchScan.objects.create(batchtype=batchtype, data=data, date_scanned=now())
+
+    def test_enqueue_and_claim(self):
+        first = self.batchscan("LA1\nA1P1\nLEND\n")
+        second = self.batchscan("LA2\nA1P2\nLEND\n")
+        done = self.batchscan("LA3\nA1P3\nLEND\n")
+        BatchScan.objects.filter(id=done.id).update(processed=True)
+        self.assertEqual(BatchScan.objects.enqueue(), 2)
+        self.assertEqual(BatchScan.objects.enqueue(), 0)
+        self.assertEqual(BatchScan.objects.claim_next("worker1").id, first.id)
+        claimed = BatchScan.objects.claim_next("worker2")
+        self.assertEqual((claimed.id, claimed.status, claimed.worker), (second.id, BatchScan.StatusRunning, "worker2"))
+        self.assertIsNone(BatchScan.objects.claim_next("worker1"))
+
+    def test_requeue_stuck(self):
+        batchscan = self.batchscan("LA1\nA1P1\nLEND\n")
+        BatchScan.objects.enqueue()
+        BatchScan.objects.claim_next("worker1")
+        self.assertEqual(BatchScan.objects.enqueue(), 0)
+        # The worker stopped long ago
+        BatchScan.objects.filter(id=batchscan.id).update(started=now() - datetime.timedelta(hours=2))
+        self.assertEqual(BatchScan.objects.enqueue(), 1)
+        self.assertEqual(BatchScan.objects.claim_next("worker2").id, batchscan.id)
+
+    def test_worker(self):
+        good = self.batchscan("LA1\nA1P1\nA1P2\nLEND\nLB1\nA1P3\nLEND\n")
+        bad = self.batchscan("LA1\nA1P9\nLEND\n")
+        new = self.batchscan("LA1\nA1P1\nLEND\n")
+        BatchScan.objects.enqueue(BatchScan.objects.filter(id__in=[good.id, bad.id]))
+        call_command('processbatchscans', once=True, stdout=StringIO())
+
+        good = BatchScan.objects.get(id=good.id)
+        self.assertEqual(good.status, BatchScan.StatusDone)
+        self.assertTrue(good.processed)
+        self.assertEqual((good.lines_total, good.lines_processed, good.blocks_processed), (7, 7, 2))
+        self.assertIsNotNone(good.finished)
+        self.assertEqual(Piece.objects.get(pieceid=3).location, "B1")
+
+        bad = BatchScan.objects.get(id=bad.id)
+        self.assertEqual(bad.status, BatchScan.StatusFailed)
+        self.assertFalse(bad.processed)
+        self.assertIn("piece A1P9 does not exist", bad.processing_log)
+
+        self.assertEqual(BatchScan.objects.get(id=new.id).status, BatchScan.StatusNew)
+
+    def test_per_block(self):
+        batchscan = self.batchscan("LA1\nA1P1\nLEND\nLB1\nA1P9\nLEND\nLC1\nA1P3\nLEND\n")
+        BatchScan.objects.enqueue(per_block=True)
+        call_command('processbatchscans', once=True, stdout=StringIO())
+
+        batchscan = BatchScan.objects.get(id=batchscan.id)
+        self.assertEqual(batchscan.status, BatchScan.StatusDone)
+        self.assertEqual((batchscan.lines_processed, batchscan.blocks_processed), (9, 2))
+        self.assertEqual([p.location for p in Piece.objects.order_by('pieceid')], ["A1", "", "C1"])
+        residual = batchscan.residuals.get()
+        self.assertEqual((residual.batchtype, residual.data, residual.status),
+                         (1, "LB1\nA1P9\nLEND\n", BatchScan.StatusNew))
+        self.assertIn("line 5: piece A1P9 does not exist", residual.processing_log)
+        self.assertIn("which are in %s" % residual, batchscan.processing_log)
+
+    def test_duplicate(self):
+        bidder = Bidder.objects.create(person=Person.objects.create(name="Bidder"))
+        BidderId.objects.create(id="1001", bidder=bidder)
+        Piece.objects.update(status=Piece.StatusInShow)
+        first = self.batchscan("A1P1\nB1001\n15\nNS\n", batchtype=3)
+        BatchScan.objects.enqueue()
+        call_command('processbatchscans', once=True, stdout=StringIO())
+
+        again = self.batchscan("  A1P1\n\nB1001 \n15\nNS\n", batchtype=3)
+        self.assertEqual(again.content_hash, first.content_hash)
+        self.assertIn("Duplicate of %s" % first, BatchScan.objects.get(id=again.id).dry_run_report)
+        BatchScan.objects.enqueue()
+        call_command('processbatchscans', once=True, stdout=StringIO())
+        again = BatchScan.objects.get(id=again.id)
+        self.assertEqual((again.status, again.processed), (BatchScan.StatusDone, True))
+        self.assertIn("Duplicate of %s" % first, again.processing_log)
+        self.assertEqual(Bid.objects.count(), 1)
+
+    def test_locations_scanned_again(self):
+        self.batchscan("LA1\nA1P1\nLEND\n")
+        BatchScan.objects.enqueue()
+        call_command('processbatchscans', once=True, stdout=StringIO())
+        Piece.objects.filter(pieceid=1).update(location="B2")
+
+        # Moved back, so not a duplicate
+        again = self.batchscan("LA1\nA1P1\nLEND\n")
+        BatchScan.objects.enqueue()
+        call_command('processbatchscans', once=True, stdout=StringIO())
+        self.assertNotIn("Duplicate", BatchScan.objects.get(id=again.id).processing_log)
+        self.assertEqual(Piece.objects.get(pieceid=1).location, "A1")
+
+    def test_metrics(self):
+        good = self.batchscan("LA1\nA1P1\nA1P2\nLEND\nLB1\nA1P3\nLEND\n")
+        bad = self.batchscan("LA1\nA1P9\nLEND\n")
+        BatchScan.objects.enqueue()
+        call_command('processbatchscans', once=True, stdout=StringIO())
+
+        good = BatchScan.objects.get(id=good.id)
+        self.assertEqual((good.lines_processed, good.blocks_processed, good.bids_created, good.pieces_updated),
+                         (7, 2, 0, 3))
+        self.assertTrue(good.query_count > 0)
+        phases = good.parse_time + good.lookup_time + good.apply_time + good.write_time
+        self.assertTrue(0 < phases <= good.wall_time)
+        bad = BatchScan.objects.get(id=bad.id)
+        self.assertEqual((bad.status, bad.pieces_updated), (BatchScan.StatusFailed, 0))
+        self.assertIsNotNone(bad.wall_time)
+
+        by_type, by_hour = BatchScan.objects.throughput()
+        self.assertEqual([(row['label'], row['batches'], row['lines_processed'], row['pieces_updated'])
+                          for row in by_type], [(u"Locations", 2, 10, 3)])
+        self.assertEqual(sum(row['batches'] for row in by_hour), 2)
+
+        BatchScan.objects.enqueue(BatchScan.objects.filter(id=bad.id))
+        self.assertIsNone(BatchScan.objects.get(id=bad.id).wall_time)
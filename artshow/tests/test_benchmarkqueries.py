@@ -0,0 +1,14 @@
+from StringIO import StringIO
+from django.core.management import call_command
+from django.test import TestCase
+from ..models import Piece
+
+
+class BenchmarkQueriesTests (TestCase):
+    def test_runs_and_rolls_back(self):
+        out = StringIO()
+        call_command('benchmarkqueries', artists=3, pieces=5, bidders=4, bids=2, scanned=2, repeat=1, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith("Created 3 artists, 4 bidders, 15 pieces"))
+        self.assertTrue(any(line.startswith("processbatchscan.process_bids") for line in lines))
+        self.assertEqual(Piece.objects.count(), 0)
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import json
+from django.contrib.auth.models import Permission, User
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from ..models import Artist, Bid, Bidder, BidderId, BidderSearchToken, Person, Piece, search_tokens
+
+
+class BidderSearchTests (TestCase):
+    def setUp(self):
+        self.zoe = Bidder.objects.create(person=Person.objects.create(name=u"Zoë O'Brien-Smith", reg_id="R77"))
+        BidderId.objects.create(id="1001", bidder=self.zoe)
+        BidderId.objects.create(id="2004", bidder=self.zoe)
+        self.zack = Bidder.objects.create(person=Person.objects.create(name="Zack Smithers"))
+        BidderId.objects.create(id="1002", bidder=self.zack)
+
+        artist = Artist.objects.create(artistid=1, person=Person.objects.create(name="Artist"))
+        for pieceid, status in [(1, Piece.StatusWon), (2, Piece.StatusWon), (3, Piece.StatusSold)]:
+            piece = Piece.objects.create(artist=artist, pieceid=pieceid, name="Piece", min_bid=10,
+                                         status=Piece.StatusInShow)
+            Bid.objects.create(bidder=self.zoe, amount=20, piece=piece)
+            Piece.objects.filter(pk=piece.pk).update(status=status)
+
+    def names(self, text):
+        return [bidder.person.name for bidder in BidderSearchToken.objects.search(text)]
+
+    def test_search_tokens(self):
+        self.assertEqual(search_tokens(u"Zoë O'Brien-Smith"), [u"zoe", u"o", u"brien", u"smith"])
+
+    def test_search(self):
+        self.assertEqual(self.names("zo"), [u"Zoë O'Brien-Smith"])
+        self.assertEqual(self.names("SMITH"), [u"Zack Smithers", u"Zoë O'Brien-Smith"])
+        self.assertEqual(self.names("smith z"), [u"Zack Smithers", u"Zoë O'Brien-Smith"])
+        self.assertEqual(self.names("smithe"), [u"Zack Smithers"])
+        self.assertEqual(self.names("r77"), [u"Zoë O'Brien-Smith"])
+        self.assertEqual(self.names("100"), [u"Zack Smithers", u"Zoë O'Brien-Smith"])
+        self.assertEqual(self.names("zack 1001"), [])
+        self.assertEqual(self.names(" - "), [])
+
+    def test_search_results(self):
+        with self.assertNumQueries(3):
+            bidder, = BidderSearchToken.objects.search("2004")
+            self.assertEqual((bidder.bidder_ids(), bidder.num_won, bidder.num_sold), (["1001", "2004"], 2, 1))
+
+    def test_kept_up_to_date(self):
+        self.zack.person.name = "Jack Smithers"
+        self.zack.person.save()
+        self.assertEqual(self.names("zack"), [])
+        self.assertEqual(self.names("jack"), [u"Jack Smithers"])
+        BidderSearchToken.objects.all().delete()
+        self.assertEqual(BidderSearchToken.objects.rebuild(), 2)
+        self.assertEqual(self.names("jack"), [u"Jack Smithers"])
+        self.zack.delete()
+        self.assertEqual(self.names("jack"), [])
+
+    def test_cashier_search_view(self):
+        url = reverse('artshow.cashier.cashier_search')
+        user = User.objects.create_user("cashier", password="secret")
+        self.client.login(username="cashier", password="secret")
+        self.assertEqual(self.client.get(url, {'q': "zo"}).status_code, 302)
+        user.user_permissions.add(Permission.objects.get(codename='add_invoice'))
+
+        response = self.client.get(url, {'q': "2004"})
+        self.assertEqual(response['Content-Type'], "application/json")
+        self.assertEqual(json.loads(response.content), {"bidders": [
+            {"id": self.zoe.pk, "name": u"Zoë O'Brien-Smith", "bidder_ids": ["1001", "2004"], "won": 2, "sold": 1,
+             "url": reverse('artshow.cashier.cashier_bidder', kwargs={'bidder_id': self.zoe.pk})}]})
+        # Each bidder is listed once, however many of their words and bidder IDs match
+        BidderId.objects.create(id="1009", bidder=self.zoe)
+        bidders = json.loads(self.client.get(url, {'q': "100"}).content)["bidders"]
+        self.assertEqual([bidder["id"] for bidder in bidders], [self.zack.pk, self.zoe.pk])
+        self.assertEqual(json.loads(self.client.get(url).content), {"bidders": []})
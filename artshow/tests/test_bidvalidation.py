@@ -0,0 +1,43 @@
+from django.core.exceptions import ValidationError
+from django.test import TestCase
+from ..bidvalidation import BidValidator
+from ..models import Artist, Bid, Bidder, Person, Piece
+
+
+class BidValidatorTests (TestCase):
+    def setUp(self):
+        artist = Artist.objects.create(artistid=1, person=Person.objects.create(name="Artist"))
+        self.piece = Piece.objects.create(artist=artist, pieceid=1, name="Piece", min_bid=10, buy_now=50,
+                                          status=Piece.StatusInShow)
+        self.nfs_piece = Piece.objects.create(artist=artist, pieceid=2, name="NFS", not_for_sale=True,
+                                              status=Piece.StatusInShow)
+        self.bidder = Bidder.objects.create(person=Person.objects.create(name="Bidder"))
+
+    def bid(self, amount, piece=None, buy_now_bid=False):
+        return Bid(bidder=self.bidder, amount=amount, piece=piece or self.piece, buy_now_bid=buy_now_bid)
+
+    def test_matches_validate(self):
+        Bid.objects.create(bidder=self.bidder, amount=20, piece=self.piece)
+        for bid in [self.bid(5), self.bid(20), self.bid(25), self.bid(60, buy_now_bid=True),
+                    self.bid(10, piece=self.nfs_piece)]:
+            try:
+                bid.validate()
+            except ValidationError, x:
+                expected = x.messages
+            else:
+                expected = None
+            validator = BidValidator()
+            try:
+                validator.validate(bid)
+            except ValidationError, x:
+                self.assertEqual(x.messages, expected)
+            else:
+                self.assertIsNone(expected)
+
+    def test_validate_bids_in_sequence(self):
+        bids = [self.bid(10), self.bid(15), self.bid(15), self.bid(60, buy_now_bid=True), self.bid(5)]
+        validator = BidValidator()
+        with self.assertNumQueries(1):
+            errors = validator.validate_bids(bids)
+        self.assertEqual([e is None for e in errors], [True, True, False, False, False])
+        self.assertEqual(errors[2].messages, ["New bid must be higher than existing bids"])
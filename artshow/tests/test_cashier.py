@@ -0,0 +1,58 @@
+from decimal import Decimal
+from django.contrib.auth.models import User
+from django.test import TestCase
+from ..models import AlreadySoldError, Artist, Bid, Bidder, Invoice, InvoicePayment, Person, Piece, load_winnings
+
+
+class CashierTests (TestCase):
+    def setUp(self):
+        artist = Artist.objects.create(artistid=1, person=Person.objects.create(name="Artist"))
+        self.bidder = Bidder.objects.create(person=Person.objects.create(name="Bidder"))
+        for pieceid in range(1, 5):
+            piece = Piece.objects.create(artist=artist, pieceid=pieceid, name="Piece %d" % pieceid, min_bid=10,
+                                         status=Piece.StatusInShow)
+            Bid.objects.create(bidder=self.bidder, amount=10 + pieceid, piece=piece)
+        Piece.objects.update(status=Piece.StatusWon)
+        self.user = User.objects.create(username="cashier")
+
+    def winning_bids(self):
+        """The bidder's winning bids, as a cashier station loads them."""
+        return load_winnings([Bidder.objects.get(pk=self.bidder.pk)], unsold_only=True)[0].top_bids(unsold_only=True)
+
+    def sell(self, bids):
+        payments = [InvoicePayment(amount=sum([bid.amount for bid in bids], Decimal(0)), payment_method=1)]
+        return Invoice.objects.create_for_bids(self.bidder, bids, payments, Decimal(0), self.user)
+
+    def test_create_for_bids(self):
+        bids = self.winning_bids()
+        # The update, the invoice, its payments and its items, and the savepoint's create and release
+        with self.assertNumQueries(6):
+            invoice = self.sell(bids[:3])
+        invoice = Invoice.objects.get(pk=invoice.pk)
+        self.assertEqual((invoice.item_count, invoice.item_total(), invoice.total_paid()),
+                         (3, Decimal("36.00"), Decimal("36.00")))
+        self.assertEqual(list(Piece.objects.order_by('pieceid').values_list('status', flat=True)),
+                         [Piece.StatusSold] * 3 + [Piece.StatusWon])
+        with self.assertNumQueries(6):
+            self.sell(bids[3:])
+
+    def test_already_sold(self):
+        station1 = self.winning_bids()
+        station2 = self.winning_bids()
+        self.sell(station1[1:3])
+        with self.assertRaises(AlreadySoldError) as cm:
+            self.sell(station2[:2])
+        self.assertEqual([piece.pieceid for piece in cm.exception.pieces], [2])
+        # Nothing of the second sale was kept
+        self.assertEqual(Invoice.objects.count(), 1)
+        self.assertEqual(Piece.objects.get(pieceid=1).status, Piece.StatusWon)
+        self.sell(self.winning_bids())
+        self.assertEqual(Piece.objects.filter(status=Piece.StatusSold).count(), 4)
+
+    def test_top_bid_changed(self):
+        bids = self.winning_bids()
+        piece = Piece.objects.get(pieceid=1)
+        Bid.objects.create(bidder=Bidder.objects.create(person=Person.objects.create(name="Other")), amount=50,
+                           piece=piece, buy_now_bid=False)
+        with self.assertRaises(AlreadySoldError):
+            self.sell(bids[:1])
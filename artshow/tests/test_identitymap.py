@@ -0,0 +1,31 @@
+from django.test import TestCase
+from ..identitymap import IdentityMap
+from ..models import Artist, Bidder, BidderId, Person, Piece
+
+
+class IdentityMapTests (TestCase):
+    def setUp(self):
+        for artistid in (1, 2):
+            artist = Artist.objects.create(artistid=artistid, person=Person.objects.create(name="Artist %d" % artistid))
+            for pieceid in (1, 2, 3):
+                Piece.objects.create(artist=artist, pieceid=pieceid, name="Piece", min_bid=10)
+        self.bidder = Bidder.objects.create(person=Person.objects.create(name="Bidder"))
+        BidderId.objects.create(id="1021", bidder=self.bidder)
+        BidderId.objects.create(id="1001", bidder=self.bidder)
+
+    def test_artists_loaded_once(self):
+        identity_map = IdentityMap()
+        pieces = list(Piece.objects.order_by('artist', 'pieceid'))
+        with self.assertNumQueries(1):
+            pieces = identity_map.attach_artists(pieces)
+            self.assertEqual([p.artistname() for p in pieces], ["Artist 1"] * 3 + ["Artist 2"] * 3)
+        self.assertIs(pieces[0].artist, pieces[2].artist)
+        with self.assertNumQueries(0):
+            identity_map.attach_artists(pieces)
+            self.assertEqual(identity_map.person(pieces[0].artist.person_id).name, "Artist 1")
+
+    def test_bidder_ids(self):
+        bidder = Bidder.objects.get(pk=self.bidder.pk)
+        IdentityMap().attach_bidder_ids([bidder])
+        with self.assertNumQueries(0):
+            self.assertEqual(bidder.bidder_ids(), ["1001", "1021"])
@@ -0,0 +1,64 @@
+import threading
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from ..models import Artist, IdSequence, Person
+
+
+class ArtistIdAllocationTests (TestCase):
+    def setUp(self):
+        self.person = Person.objects.create(name="Artist")
+
+    def test_sequence_starts_after_existing_artists(self):
+        Artist.objects.create(artistid=7, person=self.person)
+        artist = Artist.objects.create(person=self.person)
+        self.assertEqual(artist.artistid, 8)
+        self.assertEqual(IdSequence.objects.get(name='artist').next_value, 9)
+
+    def test_block_allocation(self):
+        first = Artist.objects.allocate_artistids(10)
+        self.assertEqual(first, 1)
+        self.assertEqual(Artist.objects.create(person=self.person).artistid, 11)
+
+    def test_explicit_id_advances_sequence(self):
+        self.assertEqual(Artist.objects.create(person=self.person).artistid, 1)
+        Artist.objects.create(artistid=20, person=self.person)
+        self.assertEqual(Artist.objects.create(person=self.person).artistid, 21)
+        Artist.objects.create(artistid=5, person=self.person)
+        self.assertEqual(Artist.objects.create(person=self.person).artistid, 22)
+
+
+class ParallelAllocationTests (TransactionTestCase):
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.settings_dict['NAME'] == ':memory:':
+            self.skipTest("each thread would get its own in-memory database. Set TEST_NAME to run this")
+
+    def allocate_in_threads(self, name, num_threads, **kwargs):
+        """Allocate from the named sequence in num_threads threads at once. Returns the values allocated,
+        and any exceptions raised."""
+        start_event = threading.Event()
+        results = []
+        errors = []
+
+        def allocate():
+            try:
+                start_event.wait()
+                results.append(IdSequence.objects.allocate(name, **kwargs))
+            except Exception, x:
+                errors.append(x)
+            finally:
+                connection.close()
+        threads = [threading.Thread(target=allocate) for i in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        start_event.set()
+        for thread in threads:
+            thread.join()
+        return sorted(results), errors
+
+    def test_existing_sequence(self):
+        IdSequence.objects.create(name='race', next_value=100)
+        self.assertEqual(self.allocate_in_threads('race', 2, count=5), ([100, 105], []))
+        self.assertEqual(IdSequence.objects.get(name='race').next_value, 110)
+
+    def test_new_sequence(self):
+        self.assertEqual(self.allocate_in_threads('race', 2), ([1, 2], []))
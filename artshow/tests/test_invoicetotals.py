@@ -0,0 +1,50 @@
+from decimal import Decimal
+from django.contrib.auth.models import User
+from django.test import TestCase
+from ..models import Artist, Bidder, Invoice, InvoiceItem, InvoicePayment, Person, Piece
+
+
+class InvoiceTotalsTests (TestCase):
+    def setUp(self):
+        artist = Artist.objects.create(artistid=1, person=Person.objects.create(name="Artist"))
+        self.pieces = [Piece.objects.create(artist=artist, pieceid=i, name="Piece", min_bid=10) for i in (1, 2)]
+        bidder = Bidder.objects.create(person=Person.objects.create(name="Bidder"))
+        user = User.objects.create(username="cashier")
+        self.invoice = Invoice.objects.create(payer=bidder, tax_paid=Decimal("1.50"), created_by=user)
+
+    def reload(self):
+        return Invoice.objects.get(pk=self.invoice.pk)
+
+    def test_totals_follow_items_and_payments(self):
+        item = InvoiceItem.objects.create(invoice=self.invoice, piece=self.pieces[0], price=Decimal("10.00"))
+        InvoiceItem.objects.create(invoice=self.invoice, piece=self.pieces[1], price=Decimal("15.00"))
+        InvoicePayment.objects.create(invoice=self.invoice, amount=Decimal("26.50"), payment_method=1)
+        invoice = self.reload()
+        with self.assertNumQueries(0):
+            self.assertEqual(invoice.item_count, 2)
+            self.assertEqual(invoice.item_total(), Decimal("25.00"))
+            self.assertEqual(invoice.item_and_tax_total(), Decimal("26.50"))
+            self.assertEqual(invoice.total_paid(), Decimal("26.50"))
+        item.delete()
+        invoice = self.reload()
+        self.assertEqual(invoice.item_count, 1)
+        self.assertEqual(invoice.item_total(), Decimal("15.00"))
+
+    def test_stale_invoice_save(self):
+        stale_invoice = self.reload()
+        InvoiceItem.objects.create(invoice=self.invoice, piece=self.pieces[0], price=Decimal("10.00"))
+        stale_invoice.notes = "Collected"
+        stale_invoice.save()
+        self.assertEqual(self.reload().item_count, 1)
+
+    def test_create_with_pk(self):
+        invoice = Invoice(pk=100, payer=self.invoice.payer, tax_paid=Decimal("0"), created_by=self.invoice.created_by)
+        invoice.save()
+        self.assertEqual(Invoice.objects.get(pk=100).item_count, 0)
+
+    def test_rebuild_totals(self):
+        InvoiceItem.objects.create(invoice=self.invoice, piece=self.pieces[0], price=Decimal("10.00"))
+        Invoice.objects.update(item_total_amount=0, item_count=0)
+        self.assertEqual(Invoice.objects.rebuild_totals(), 1)
+        self.assertEqual(self.reload().item_total(), Decimal("10.00"))
+        self.assertEqual(Invoice.objects.rebuild_totals(), 0)
@@ -0,0 +1,95 @@
+import datetime
+from decimal import Decimal
+from django.contrib.auth.models import Permission, User
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from ..conf import settings
+from ..models import Allocation, Artist, ArtistLedger, ChequePayment, Payment, PaymentType, Person, Space
+
+
+class ArtistLedgerTests (TestCase):
+    def setUp(self):
+        self.space_fee = PaymentType.objects.create(pk=settings.ARTSHOW_SPACE_FEE_PK, name="Space Fee")
+        self.payment_received = PaymentType.objects.create(pk=settings.ARTSHOW_PAYMENT_RECEIVED_PK,
+                                                           name="Payment Received")
+        PaymentType.objects.create(pk=settings.ARTSHOW_PAYMENT_SENT_PK, name="Payment Sent")
+        self.space = Space.objects.create(name="Panel", shortname="P", available=10, price=Decimal("10.00"))
+        self.artist = Artist.objects.create(artistid=1, person=Person.objects.create(name="Artist"))
+
+    def ledger(self):
+        return Artist.objects.get(pk=self.artist.pk).get_ledger()
+
+    def pay(self, amount, payment_type):
+        return Payment.objects.create(artist=self.artist, amount=amount, payment_type=payment_type,
+                                      description="", date=datetime.date.today())
+
+    def test_ledger_follows_payments_and_allocations(self):
+        alloc = Allocation.objects.create(artist=self.artist, space=self.space, requested=2)
+        self.assertEqual(self.ledger().requested_cost, 20)
+        self.assertEqual(self.ledger().payment_remaining, 20)
+        payment = self.pay(15, self.payment_received)
+        self.pay(-10, self.space_fee)
+        artist = Artist.objects.get(pk=self.artist.pk)
+        self.assertEqual(artist.balance(), 5)
+        self.assertEqual(artist.payment_remaining_with_details(), (20, 10, 10, 5))
+        payment.delete()
+        alloc.requested = 1
+        alloc.save()
+        self.assertEqual(self.ledger().totals(), ArtistLedger.objects.calculate_all()[1].totals())
+        self.assertEqual(self.ledger().deduction_remaining, 0)
+        self.assertEqual(self.ledger().balance, -10)
+
+    def test_space_price_change(self):
+        Allocation.objects.create(artist=self.artist, space=self.space, requested=2)
+        self.space.price = Decimal("15.00")
+        self.space.save()
+        self.assertEqual(self.ledger().requested_cost, 30)
+
+    def test_cheque_payment(self):
+        self.pay(20, self.payment_received)
+        cheque = ChequePayment(artist=self.artist, amount=-20, date=datetime.date.today())
+        cheque.clean()
+        cheque.save()
+        self.assertEqual(self.ledger().balance, 0)
+
+    def test_verify_and_rebuild(self):
+        self.pay(20, self.payment_received)
+        self.assertEqual(ArtistLedger.objects.verify(), [])
+        ArtistLedger.objects.update(balance=0)
+        Artist.objects.create(artistid=2, person=Person.objects.create(name="Artist 2"))
+        # As when artists are loaded from fixtures
+        ArtistLedger.objects.filter(pk=2).delete()
+        self.assertEqual([m[0] for m in ArtistLedger.objects.verify()], [1, 2])
+        self.assertEqual(ArtistLedger.objects.rebuild(), 2)
+        self.assertEqual(ArtistLedger.objects.verify(), [])
+        self.assertEqual(self.ledger().balance, 20)
+
+    def test_moved_to_another_artist(self):
+        other = Artist.objects.create(artistid=2, person=Person.objects.create(name="Artist 2"))
+        payment = self.pay(20, self.payment_received)
+        alloc = Allocation.objects.create(artist=self.artist, space=self.space, requested=2)
+        cheque = ChequePayment(artist=self.artist, amount=-5, date=datetime.date.today())
+        cheque.clean()
+        cheque.save()
+        for source in (Payment.objects.get(pk=payment.pk), alloc, ChequePayment.objects.get(pk=cheque.pk)):
+            source.artist = other
+            source.save()
+        self.assertEqual(ArtistLedger.objects.verify(), [])
+        self.assertEqual((self.ledger().balance, self.ledger().requested_cost), (0, 0))
+        self.assertEqual(other.get_ledger().balance, 15)
+
+    def test_new_artist(self):
+        Artist.objects.create(artistid=2, person=Person.objects.create(name="Artist 2"))
+        self.assertEqual(ArtistLedger.objects.verify(), [])
+        self.assertEqual(ArtistLedger.objects.get(pk=2).balance, 0)
+
+    def test_missing_ledger_not_saved_when_read(self):
+        self.pay(20, self.payment_received)
+        ArtistLedger.objects.all().delete()
+        self.assertEqual(self.ledger().balance, 20)
+        user = User.objects.create_user("staff", password="secret")
+        user.user_permissions.add(Permission.objects.get(codename='is_artshow_staff'))
+        self.client.login(username="staff", password="secret")
+        response = self.client.get(reverse('artshow.reports.artist_payment_report'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(ArtistLedger.objects.count(), 0)
@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+from decimal import Decimal
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.test.utils import override_settings
+from ..conf import _DISABLED as SETTING_DISABLED
+from ..models import Artist, Bid, Bidder, BidderId, Invoice, InvoicePayment, Person, Piece, load_winnings
+from ..pdfreports import cached_pdf
+
+
+class PdfCacheTests (TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.overrides = override_settings(ARTSHOW_PDF_CACHE_DIR=self.cache_dir)
+        self.overrides.enable()
+
+        artist = Artist.objects.create(artistid=1, person=Person.objects.create(name="Artist"))
+        bidder = Bidder.objects.create(person=Person.objects.create(name="Bidder", reg_id="R1"))
+        BidderId.objects.create(id="1001", bidder=bidder)
+        for pieceid in range(1, 3):
+            piece = Piece.objects.create(artist=artist, pieceid=pieceid, name="Piece %d" % pieceid, min_bid=10,
+                                         location="A%d" % pieceid, status=Piece.StatusInShow)
+            Bid.objects.create(bidder=bidder, amount=20, piece=piece)
+        Piece.objects.update(status=Piece.StatusWon)
+        bids = load_winnings([bidder], unsold_only=True)[0].top_bids(unsold_only=True)
+        self.invoice = Invoice.objects.create_for_bids(bidder, bids, [InvoicePayment(amount=40, payment_method=1)],
+                                                       Decimal(0), User.objects.create(username="cashier"))
+
+    def tearDown(self):
+        self.overrides.disable()
+        shutil.rmtree(self.cache_dir)
+
+    def cached_files(self):
+        return sorted(os.listdir(os.path.join(self.cache_dir, str(self.invoice.id))))
+
+    def pdf(self, kind):
+        return cached_pdf(kind, Invoice.objects.get(pk=self.invoice.pk))
+
+    def test_cached(self):
+        self.assertTrue(self.pdf('invoice').startswith("%PDF"))
+        self.assertTrue(self.pdf('picklist').startswith("%PDF"))
+        invoice_file, picklist_file = self.cached_files()
+        self.assertTrue(invoice_file.startswith("invoice-") and picklist_file.startswith("picklist-"))
+        # Served from the cache, not rendered again
+        with open(os.path.join(self.cache_dir, str(self.invoice.id), invoice_file), "wb") as f:
+            f.write("cached")
+        self.assertEqual(self.pdf('invoice'), "cached")
+
+    def test_changed(self):
+        self.pdf('invoice')
+        first_file, = self.cached_files()
+        Piece.objects.filter(pieceid=1).update(name="Renamed")
+        self.assertTrue(self.pdf('invoice').startswith("%PDF"))
+        second_file, = self.cached_files()
+        self.assertNotEqual(first_file, second_file)
+        with self.settings(ARTSHOW_TAX_DESCRIPTION="Other Tax"):
+            self.pdf('invoice')
+            self.assertNotEqual(self.cached_files(), [second_file])
+
+    def test_disabled(self):
+        with self.settings(ARTSHOW_PDF_CACHE_DIR=SETTING_DISABLED):
+            self.assertTrue(self.pdf('invoice').startswith("%PDF"))
+        self.assertEqual(os.listdir(self.cache_dir), [])
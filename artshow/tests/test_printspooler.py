@@ -0,0 +1,102 @@
+import datetime
+import os
+import shutil
+import tempfile
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils.timezone import now
+from ..models import PrintJob
+from ..printspooler import PrintingError, print_job, printers, spool
+
+
+class PrintSpoolerTests (TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.printed = os.path.join(self.tmpdir, "printed")
+        self.overrides = override_settings(ARTSHOW_PRINT_COMMAND="cat >> %s" % self.printed,
+                                           ARTSHOW_PRINTERS={"jammed": "cat > /dev/null; echo jammed >&2"},
+                                           ARTSHOW_PRINT_ATTEMPTS=2, ARTSHOW_PRINT_RETRY_DELAY=0)
+        self.overrides.enable()
+
+    def tearDown(self):
+        self.overrides.disable()
+        shutil.rmtree(self.tmpdir)
+
+    def test_spool(self):
+        self.assertEqual(printers(), ["default", "jammed"])
+        job = spool("default", "first\n", "First")
+        self.assertEqual((job.status, job.attempts), (PrintJob.StatusQueued, 0))
+        self.assertRaises(PrintingError, spool, "missing", "first\n", "First")
+        self.assertRaises(PrintingError, spool, "default", "", "Nothing")
+
+    def test_print_in_order(self):
+        spool("default", "first\n", "First")
+        spool("default", "second\n", "Second")
+        job = PrintJob.objects.claim_next(["default"], "worker1")
+        # The second job waits until the first is printed
+        self.assertEqual(PrintJob.objects.claim_next(["default"], "worker2"), None)
+        self.assertTrue(print_job(job))
+        self.assertTrue(print_job(PrintJob.objects.claim_next(["default"], "worker2")))
+        self.assertEqual(PrintJob.objects.claim_next(["default"], "worker1"), None)
+        with open(self.printed) as f:
+            self.assertEqual(f.read(), "first\nsecond\n")
+        self.assertEqual(list(PrintJob.objects.values_list('status', 'attempts')), [(PrintJob.StatusPrinted, 1)] * 2)
+
+    def test_retries(self):
+        jammed = spool("jammed", "first\n", "First")
+        spool("jammed", "second\n", "Second")
+        printers = ["jammed", "default"]
+
+        job = PrintJob.objects.claim_next(printers, "worker")
+        self.assertEqual(job.pk, jammed.pk)
+        self.assertFalse(print_job(job))
+        job = PrintJob.objects.get(pk=jammed.pk)
+        self.assertEqual((job.status, job.attempts, job.error), (PrintJob.StatusQueued, 1, "jammed\n"))
+        # Retried before the printer's second job
+        job = PrintJob.objects.claim_next(printers, "worker")
+        self.assertEqual((job.pk, job.attempts), (jammed.pk, 2))
+        self.assertFalse(print_job(job))
+        self.assertEqual(PrintJob.objects.get(pk=jammed.pk).status, PrintJob.StatusFailed)
+
+        spool("default", "third\n", "Third")
+        with self.settings(ARTSHOW_PRINT_RETRY_DELAY=60):
+            job = PrintJob.objects.claim_next(printers, "worker")
+            self.assertEqual(job.description, "Second")
+            self.assertFalse(print_job(job))
+            self.assertEqual(PrintJob.objects.get(pk=job.pk).status, PrintJob.StatusQueued)
+            # The jammed printer waits out the delay, but the other printer's job isn't held up
+            self.assertEqual(PrintJob.objects.claim_next(printers, "worker").description, "Third")
+            self.assertEqual(PrintJob.objects.claim_next(printers, "worker"), None)
+        self.assertEqual(PrintJob.objects.requeue(PrintJob.objects.filter(pk=jammed.pk)), 1)
+        self.assertEqual(PrintJob.objects.claim_next(printers, "worker").pk, jammed.pk)
+
+    def test_timeout(self):
+        with self.settings(ARTSHOW_PRINTERS={"slow": "sleep 10"}):
+            spool("slow", "first\n", "First")
+            job = PrintJob.objects.claim_next(["slow"], "worker")
+            self.assertFalse(print_job(job, timeout=0.2))
+            self.assertEqual(job.error, "printing command took more than 0.2s")
+
+    def test_stale(self):
+        spool("default", "first\n", "First")
+        spool("default", "second\n", "Second")
+        job = PrintJob.objects.claim_next(["default"], "worker1")
+        self.assertEqual(PrintJob.objects.claim_next(["default"], "worker2", stale_after=60), None)
+        # worker1 stopped part way through printing
+        PrintJob.objects.filter(pk=job.pk).update(started=now() - datetime.timedelta(seconds=61))
+        reclaimed = PrintJob.objects.claim_next(["default"], "worker2", stale_after=60)
+        self.assertEqual((reclaimed.pk, reclaimed.worker, reclaimed.attempts), (job.pk, "worker2", 2))
+        self.assertEqual(reclaimed.error, "left printing by worker1 for more than 60s")
+        # worker1's late failure doesn't undo worker2's claim
+        job.record_failure("jammed")
+        self.assertEqual(PrintJob.objects.get(pk=job.pk).status, PrintJob.StatusPrinting)
+
+        # Out of attempts, so the printer moves on to its next job
+        PrintJob.objects.filter(pk=job.pk).update(started=now() - datetime.timedelta(seconds=61))
+        self.assertEqual(PrintJob.objects.claim_next(["default"], "worker3", stale_after=60).description, "Second")
+        self.assertEqual(PrintJob.objects.get(pk=job.pk).status, PrintJob.StatusFailed)
+
+    def test_cancel(self):
+        spool("default", "first\n", "First")
+        self.assertEqual(PrintJob.objects.cancel(PrintJob.objects.all()), 1)
+        self.assertEqual(PrintJob.objects.claim_next(["default"], "worker"), None)
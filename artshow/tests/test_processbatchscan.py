@@ -0,0 +1,235 @@
+from StringIO import StringIO
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
+from ..models import Artist, BatchScan, Bid, Bidder, BidderId, Person, Piece
+from ..processbatchscan import BatchProcessingError, BulkStore, Scan, ScanMetrics, StreamProcessor, Tokenizer, \
+    bids_batch, dry_run, process_bids, process_create_bidderids, process_locations
+
+
+class Rollback(Exception):
+    pass
+
+
+class BulkProcessingTests (TestCase):
+    def setUp(self):
+        artist = Artist.objects.create(artistid=1, person=Person.objects.create(name="Artist"))
+        for pieceid in range(1, 6):
+            Piece.objects.create(artist=artist, pieceid=pieceid, name="Piece", min_bid=10, status=Piece.StatusInShow)
+        Piece.objects.create(artist=artist, pieceid=6, name="NFS", not_for_sale=True, status=Piece.StatusInShow)
+        Piece.objects.create(artist=artist, pieceid=7, name="Not hung", min_bid=10)
+        self.bidder = Bidder.objects.create(person=Person.objects.create(name="Bidder"))
+        BidderId.objects.create(id="1001", bidder=self.bidder)
+        Bid.objects.create(bidder=self.bidder, amount=20, piece=Piece.objects.get(pieceid=2))
+
+    def state(self):
+        pieces = list(Piece.objects.order_by('pieceid').values_list(
+            'pieceid', 'status', 'location', 'bidsheet_scanned', 'voice_auction', 'current_bid_amount', 'bid_count'))
+        bids = list(Bid.objects.order_by('piece__pieceid', 'amount').values_list('piece__pieceid', 'amount',
+                                                                                 'bidder', 'buy_now_bid'))
+        return pieces, bids
+
+    def run_both(self, func, data, **kwargs):
+        """Run func in each mode, returning the errors and resulting state of each, then roll back."""
+        results = []
+        for bulk in (False, True):
+            try:
+                with transaction.atomic():
+                    try:
+                        # With per_block, the failed blocks are returned instead
+                        errors = func(data, bulk=bulk, **kwargs) or None
+                    except BatchProcessingError, x:
+                        errors = x.errorlist
+                    results.append((errors, self.state()))
+                    raise Rollback()
+            except Rollback:
+                pass
+        return results
+
+    def test_valid_bids(self):
+        data = "A1P1\nB1001\n15\nNS\nA1P2\nB1001\n25\nNAS\nA1P3\nNB\nA1P6\nNFS\nA1P1\nB1001\n30\nNAC\n"
+        direct, bulk = self.run_both(process_bids, data, final_scan=False)
+        self.assertIsNone(direct[0])
+        self.assertEqual(direct, bulk)
+        self.assertEqual(len(bulk[1][1]), 4)
+
+    def test_bid_errors(self):
+        data = "\n".join(["A1P1", "B1001", "15", "NS", "A1P1", "B1001", "25", "NS",  # second is after Won
+                          "A1P2", "B1001", "15", "NS",  # too low
+                          "A1P2", "NB",  # has bids
+                          "A1P9", "B1001",  # no such piece
+                          "A1P3", "B9999", "20", "NS",  # no such bidder
+                          "A1P4", "B1001", "20", "NBN",  # buy now not available
+                          "A1P5", "NFS", "A1P7", "B1001", "20", "NS", "XYZ", "A1P5", "B1001"])
+        direct, bulk = self.run_both(process_bids, data, final_scan=True)
+        self.assertTrue(len(direct[0]) > 5)
+        self.assertEqual(direct, bulk)
+
+    def test_locations(self):
+        data = "LA1\nA1P1\nA1P7\nLEND\nLB2\nA1P9\nA1P2\nLEND\nA1P3\n"
+        direct, bulk = self.run_both(process_locations, data)
+        self.assertEqual(direct, bulk)
+        direct, bulk = self.run_both(process_locations, "LA1\nA1P1\nA1P7\nLEND\nPB2\nA1P2\nA1P1\nPEND\n")
+        self.assertIsNone(direct[0])
+        self.assertEqual(direct, bulk)
+        self.assertEqual(bulk[1][0][6][1:3], (Piece.StatusInShow, "A1"))
+        self.assertEqual(bulk[1][0][0][2], "B2")
+
+    def test_changed_while_processing(self):
+        tokens = bids_batch.tokenizer.tokenize("A1P1\nB1001\n15\nNS\nA1P2\nB1001\n20\nNS\n")
+        store = BulkStore(tokens)
+        scan = Scan(store, final_scan=True)
+        bids_batch.run(scan, tokens)
+        self.assertEqual(scan.errors, [])
+        # Sold at the cashier after the scan fetched it
+        Piece.objects.filter(pieceid=2).update(status=Piece.StatusSold)
+        with self.assertRaises(BatchProcessingError) as cm:
+            with transaction.atomic():
+                store.flush()
+        self.assertEqual(cm.exception.errorlist, ["1-2 was changed"])
+        pieces, bids = self.state()
+        self.assertEqual([piece[1] for piece in pieces[:2]], [Piece.StatusInShow, Piece.StatusSold])
+        self.assertEqual(len(bids), 1)
+
+    def test_bids_per_block(self):
+        data = "\n".join(["A1P1", "B1001", "15", "NS",
+                          "A1P3", "B1001", "20", "NS", "XYZ",  # undone because of the unknown line
+                          "A1P3", "B1001", "20", "NS",  # so this is still valid
+                          "A1P2", "NB",  # has bids
+                          "A1P4"])  # incomplete
+        direct, bulk = self.run_both(process_bids, data, final_scan=True, per_block=True)
+        self.assertEqual(direct, bulk)
+        errors, (pieces, bids) = bulk
+        self.assertEqual([lines for block_errors, lines in errors],
+                         [["A1P3", "B1001", "20", "NS", "XYZ"], ["A1P2", "NB"], ["A1P4"]])
+        self.assertEqual(errors[2][0], ["END: block incomplete"])
+        self.assertEqual([bid[:2] for bid in bids], [(1, 15), (2, 20), (3, 20)])
+        self.assertEqual(pieces[2][1:4], (Piece.StatusWon, "", True))
+
+    def test_locations_per_block(self):
+        direct, bulk = self.run_both(process_locations, "LA1\nA1P1\nA1P9\nLEND\nLB2\nA1P2\nLEND\n", per_block=True)
+        self.assertEqual(direct, bulk)
+        errors, (pieces, bids) = bulk
+        self.assertEqual(errors, [(["line 3: piece A1P9 does not exist", "END: block incomplete"],
+                                   ["LA1", "A1P1", "A1P9", "LEND"])])
+        self.assertEqual([piece[2] for piece in pieces[:2]], ["", "B2"])
+
+    def test_stream(self):
+        processor = StreamProcessor(3)
+        results = [processor.feed(line) for line in ["A1P1", "B1001", "", "15"]]
+        self.assertEqual(results, [[], [], [], []])
+        self.assertEqual(processor.feed("NS"), [([], ["A1P1", "B1001", "15", "NS"])])
+        self.assertEqual(Piece.objects.get(pieceid=1).status, Piece.StatusWon)
+        self.assertEqual(processor.feed("A1P3"), [])
+        self.assertEqual(processor.feed("A1P4"), [(["END: block incomplete"], ["A1P3"])])
+        self.assertEqual(processor.feed("NB"), [([], ["A1P4", "NB"])])
+        self.assertEqual(processor.feed("A1P2"), [])
+        self.assertEqual(processor.finish(), [(["END: block incomplete"], ["A1P2"])])
+
+        batchscan = processor.save(date_scanned=now())
+        self.assertEqual((batchscan.batchtype, batchscan.processed, batchscan.blocks_processed), (3, True, 2))
+        self.assertEqual(batchscan.data, "A1P1\nB1001\n15\nNS\nA1P3\nA1P4\nNB\nA1P2\n")
+        self.assertEqual(batchscan.residuals.get().data, "A1P3\nA1P2\n")
+        self.assertEqual(BatchScan.objects.count(), 2)
+
+    def test_bidderids(self):
+        person = Person.objects.create(name="New Bidder")
+        data = "P%d\nB2001\nP%d\nB1001\nP99999\nB2002\nP%d\nB2003\n" % (person.pk, person.pk, self.bidder.person.pk)
+        direct, bulk = self.run_both(process_create_bidderids, data)
+        self.assertEqual(direct, bulk)
+        self.assertEqual(len(direct[0]), 2)
+        process_create_bidderids("P%d\nB2001\nP%d\nB2002\n" % (person.pk, person.pk), bulk=True)
+        self.assertEqual(sorted(BidderId.objects.filter(bidder__person=person).values_list('id', flat=True)),
+                         ["2001", "2002"])
+
+    def test_metrics(self):
+        data = "A1P1\nB1001\n15\nNS\nA1P3\nNB\nA1P4\nB1001\n20\nXYZ\n"
+        counts = []
+        kept_queries = len(connection.queries)
+        for bulk in (False, True):
+            metrics = ScanMetrics()
+            with transaction.atomic():
+                process_bids(data, final_scan=True, bulk=bulk, per_block=True, metrics=metrics)
+                transaction.set_rollback(True)
+            counts.append((metrics.lines, metrics.blocks, metrics.bids_created, metrics.pieces_updated))
+            self.assertTrue(metrics.queries > 0)
+            # Counted without keeping the statements
+            self.assertEqual(len(connection.queries), kept_queries)
+            self.assertEqual(sorted(metrics.phase_times), sorted(ScanMetrics.PHASES))
+        self.assertEqual(counts, [(10, 2, 1, 2), (10, 2, 1, 2)])
+
+        metrics = ScanMetrics()
+        with CaptureQueriesContext(connection) as queries:
+            process_bids(data, final_scan=True, bulk=True, per_block=True, metrics=metrics)
+        self.assertEqual(metrics.queries, len(queries))
+
+    def test_repeated_blocks(self):
+        data = "A1P1\nB1001\n15\nNS\nA1P3\nNB\nA1P1\nB1001\n15\nNS\nA1P2\nB1001\n20\nNS\n"
+        direct, bulk = self.run_both(process_bids, data, final_scan=True)
+        self.assertIsNone(direct[0])
+        self.assertEqual(direct, bulk)
+        notes = []
+        process_bids(data, final_scan=True, bulk=True, notes=notes)
+        self.assertEqual(notes, [(7, "line 7: repeat of the block at line 1, skipped"),
+                                 (14, "line 14: bid of 20 on A1P2 is already the top bid, not placed again")])
+        self.assertEqual(Bid.objects.filter(piece__pieceid=1).count(), 1)
+        self.assertEqual(Bid.objects.filter(piece__pieceid=2).count(), 1)
+        self.assertEqual(Piece.objects.get(pieceid=2).status, Piece.StatusWon)
+
+    def test_outbid_scanned_again(self):
+        other = Bidder.objects.create(person=Person.objects.create(name="Other"))
+        BidderId.objects.create(id="1002", bidder=other)
+        Bid.objects.create(bidder=other, amount=25, piece=Piece.objects.get(pieceid=2))
+        # The bid of 20 is recorded, but no longer on top, so the final scan of it is an error
+        direct, bulk = self.run_both(process_bids, "A1P2\nB1001\n20\nNS\n", final_scan=True)
+        self.assertEqual(direct, bulk)
+        errors, (pieces, bids) = bulk
+        self.assertTrue(errors[0].startswith("line 4: invalid bid"))
+        self.assertEqual(pieces[1][1:4], (Piece.StatusInShow, "", False))
+
+    def test_dry_run(self):
+        data = "\n".join(["A1P1", "B1001", "15", "NS", "A1P2", "B1001", "15", "NS", "A1P3", "NB", "A1P4"])
+        report = dry_run(3, data)
+        self.assertEqual(report.errors, [(8, "line 8: invalid bid: [u'New bid must be higher than existing bids']"),
+                                         (9, "line 9: previous block incomplete"),
+                                         (None, "END: block incomplete")])
+        self.assertEqual([(piece.pieceid, fields) for piece, fields in report.piece_changes],
+                         [(1, [('status', Piece.StatusInShow, Piece.StatusWon), ('bidsheet_scanned', False, True)]),
+                          (3, [('bidsheet_scanned', False, True)])])
+        self.assertEqual([(bid.piece.pieceid, bid.amount) for bid in report.bids], [(1, 15)])
+        self.assertTrue(report.as_text().startswith("3 errors, 2 pieces changed, 1 bids, 0 bidder IDs\n"))
+        self.assertEqual(Bid.objects.count(), 1)
+        self.assertFalse(Piece.objects.filter(bidsheet_scanned=True).exists())
+
+        person = Person.objects.create(name="New Bidder")
+        report = dry_run(4, "P%d\nB2001\n" % person.pk)
+        self.assertEqual((report.errors, report.bidder_ids), ([], [(person, "2001")]))
+        self.assertFalse(BidderId.objects.filter(id="2001").exists())
+
+    def test_checked_when_saved(self):
+        batchscan = BatchScan.objects.create(batchtype=1, data="LA1\nA1P1\nA1P9\nLEND\n", date_scanned=now())
+        self.assertEqual(BatchScan.objects.get(id=batchscan.id).dry_run_errors, 2)
+        batchscan.data = "LA1\nA1P1\nLEND\n"
+        batchscan.save()
+        batchscan = BatchScan.objects.get(id=batchscan.id)
+        self.assertEqual(batchscan.dry_run_errors, 0)
+        self.assertIn("location  -> A1", batchscan.dry_run_report)
+        self.assertEqual(Piece.objects.get(pieceid=1).location, "")
+
+
+class TokenizerTests (TestCase):
+    def test_tokenize(self):
+        tokenizer = Tokenizer(['piece', 'bidder', 'price', 'normal_sale', 'buy_now', 'no_bids'])
+        tokens = tokenizer.tokenize("A12P3\n\n B1001 \n25\nNB\nNBN\nNBX\n")
+        self.assertEqual([(line_no, line, kind) for line_no, line, kind, mo in tokens],
+                         [(1, "A12P3", 'piece'), (3, "B1001", 'bidder'), (4, "25", 'price'), (5, "NB", 'no_bids'),
+                          (6, "NBN", 'buy_now'), (7, "NBX", None)])
+        self.assertEqual(tokens[0][3].group('artistid', 'pieceid'), ("12", "3"))
+        self.assertEqual(tokens[1][3].group('bidderid'), "1001")
+
+    def test_benchmark_runs(self):
+        out = StringIO()
+        call_command('benchmarkscanparser', lines=200, repeat=1, stdout=out)
+        self.assertEqual(len(out.getvalue().splitlines()), 2)
@@ -0,0 +1,49 @@
+import os
+import shutil
+import tempfile
+from django.test import TestCase
+from django.utils.timezone import now
+from ..models import BatchScan
+from ..scanjournal import ScanJournal, find_unsaved_batches, replay
+
+
+class ScanJournalTests (TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, "scanner.journal")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_replay(self):
+        journal = ScanJournal(self.path)
+        saved_offset = journal.begin("scanner1")
+        lost_offset = journal.begin("scanner2", 2)
+        journal.line("scanner1", "LA1")
+        journal.line("scanner2", "A1P1")
+        journal.line("scanner1", "A1P1")
+        journal.line("scanner2", "B1001")
+        journal.line("scanner1", "LEND")
+        batchscan = BatchScan.objects.create(data="LA1\nA1P1\nLEND\n", date_scanned=now(), device="scanner1",
+                                             journal_offset=saved_offset)
+        journal.saved("scanner1", batchscan)
+        # Saved, but not journalled as saved
+        crashed_offset = journal.begin("scanner1")
+        journal.line("scanner1", "LB2")
+        BatchScan.objects.create(data="LB2\n", date_scanned=now(), device="scanner1", journal_offset=crashed_offset)
+        journal.close()
+        # A record cut short
+        with open(self.path, "ab") as f:
+            f.write("1400000000.0\tscanner2\tL\t1")
+
+        batches = find_unsaved_batches(self.path)
+        self.assertEqual([(b.device, b.offset, b.batchtype, b.lines) for b in batches],
+                         [("scanner2", lost_offset, 2, ["A1P1", "B1001"])])
+        recovered, = replay(self.path)
+        self.assertEqual((recovered.device, recovered.batchtype, recovered.data, recovered.per_block),
+                         ("scanner2", 2, "A1P1\nB1001\n", True))
+        self.assertEqual(replay(self.path), [])
+
+    def test_empty(self):
+        open(self.path, "w").close()
+        self.assertEqual(replay(self.path), [])
@@ -0,0 +1,116 @@
+import os
+import shutil
+import sys
+import random
+import tempfile
+import threading
+import time
+from StringIO import StringIO
+from django.core.management import call_command
+from django.test import TransactionTestCase
+from django.utils.timezone import now
+from ..management.commands.scannerreader import ScannerDevice
+from ..models import BatchScan
+from ..scanemulator import Collector, EmulatedScanner, Pacing, recorded_batches, report, schedule, send
+from ..scanjournal import find_unsaved_batches
+
+
+class ScannerReaderTests (TransactionTestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.tempdir)
+
+    def scanner(self, name, lines, pause=0):
+        """Make a FIFO to stand in for a scanner, which will send the lines then disconnect. Lines are sent
+        as given, so can hold several lines or only part of one. Each is sent pause seconds after the last."""
+        path = os.path.join(self.tempdir, name)
+        os.mkfifo(path)
+
+        def send():
+            with open(path, "w") as f:
+                for line in lines:
+                    time.sleep(pause)
+                    f.write(line)
+                    f.flush()
+        thread = threading.Thread(target=send)
+        thread.start()
+        return path, thread
+
+    def test_several_devices(self):
+        scanners = [self.scanner("scanner1", ["A1P1\n", "B1001\n", "10\n", "NS\n"]),
+                    self.scanner("scanner2", ["LA1\n", "A1P2\n", "LEND\n"])]
+        call_command('scannerreader', device=[path for path, thread in scanners], timeout=5)
+        for path, thread in scanners:
+            thread.join()
+        batchscans = dict(BatchScan.objects.values_list('device', 'data'))
+        self.assertEqual(batchscans, {scanners[0][0]: "A1P1\nB1001\n10\nNS\n", scanners[1][0]: "LA1\nA1P2\nLEND\n"})
+
+    def test_partial_lines(self):
+        slow = self.scanner("scanner1", ["A1P", "1\nB10", "01\n10\nNS"], pause=0.5)
+        fast = self.scanner("scanner2", ["LA1\nA1P2\n", "LEND\n"])
+        call_command('scannerreader', device=[slow[0], fast[0]], timeout=5)
+        for path, thread in (slow, fast):
+            thread.join()
+        batchscans = dict(BatchScan.objects.values_list('device', 'data'))
+        self.assertEqual(batchscans, {slow[0]: "A1P1\nB1001\n10\nNS\n", fast[0]: "LA1\nA1P2\nLEND\n"})
+
+    def test_read_lines(self):
+        path = os.path.join(self.tempdir, "scanner1")
+        os.mkfifo(path)
+        # Opened for writing without waiting for a reader
+        fd = os.open(path, os.O_RDWR)
+        device = ScannerDevice(path)
+        os.write(fd, "A1P")
+        self.assertEqual(device.read_lines(), [])
+        os.write(fd, "1\nB10")
+        self.assertEqual(device.read_lines(), ["A1P1"])
+        os.write(fd, "01\n10\nNS")
+        os.close(fd)
+        self.assertEqual(device.read_lines(), ["B1001", "10"])
+        self.assertEqual(device.read_lines(), None)
+        self.assertEqual(device.remaining_lines(), ["NS"])
+        device.f.close()
+
+    def test_journal(self):
+        path, thread = self.scanner("scanner1", ["A1P1\n", "B1001\n", "10\n", "NS\n"])
+        journal = os.path.join(self.tempdir, "scanner.journal")
+        call_command('scannerreader', device=[path], timeout=5, journal=journal)
+        thread.join()
+        batchscan = BatchScan.objects.get()
+        self.assertEqual(batchscan.journal_offset, 0)
+        self.assertEqual(len(open(journal).read().splitlines()), 6)
+        self.assertEqual(find_unsaved_batches(journal), [])
+
+    def test_emulated_scanners(self):
+        rnd = random.Random(0)
+        batches = recorded_batches(StringIO("A1P1\nB1001\n10\nNS\n\n\nLA1\nA1P2\nLEND\n\nA1P3\nNB\n"))
+        self.assertEqual(batches, [["A1P1", "B1001", "10", "NS"], ["LA1", "A1P2", "LEND"], ["A1P3", "NB"]])
+        scanners = [EmulatedScanner(), EmulatedScanner()]
+        sent_batches, events = schedule(rnd, [(scanners[0], batches[:2]), (scanners[1], batches[2:])],
+                                        Pacing(rate=100, gap=1.0), time.time(), malformed=0.5)
+        self.assertEqual([len(sent.lines) for sent in sent_batches], [4, 3, 2])
+        self.assertTrue(any(sent.malformed for sent in sent_batches))
+
+        def scan():
+            send(events)
+            # Give scannerreader time to save the last batches before disconnecting
+            time.sleep(1.0)
+            for scanner in scanners:
+                scanner.close()
+        since = now()
+        thread = threading.Thread(target=scan)
+        thread.start()
+        call_command('scannerreader', device=[scanner.name for scanner in scanners], timeout=0.3)
+        thread.join()
+
+        collector = Collector(sent_batches, since)
+        collector.poll()
+        self.assertTrue(collector.done())
+        self.assertEqual([sent.batchscan.device for sent in sent_batches],
+                         [scanners[0].name, scanners[0].name, scanners[1].name])
+        self.assertTrue(report(sent_batches)[1].startswith("saved:     3 of 3 batches"))
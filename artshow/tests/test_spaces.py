@@ -0,0 +1,30 @@
+from decimal import Decimal
+from django.test import TestCase
+from ..models import Allocation, Artist, Person, Space
+
+
+class SpaceTotalsTests (TestCase):
+    def setUp(self):
+        self.panel = Space.objects.create(name="Panel", shortname="P", available=10, price=Decimal("10.00"))
+        self.table = Space.objects.create(name="Table", shortname="T", available=4, price=Decimal("5.00"))
+        for artistid, requested, allocated in [(1, 3, 2), (2, 4, 4)]:
+            artist = Artist.objects.create(artistid=artistid, person=Person.objects.create(name="Artist"))
+            Allocation.objects.create(artist=artist, space=self.panel, requested=requested, allocated=allocated)
+
+    def test_with_totals(self):
+        with self.assertNumQueries(1):
+            spaces = dict((s.pk, s) for s in Space.objects.with_totals())
+            panel = spaces[self.panel.pk]
+            self.assertEqual(panel.allocated(), 6)
+            self.assertEqual(panel.remaining(), 4)
+            self.assertEqual(panel.waiting(), 1)
+            table = spaces[self.table.pk]
+            self.assertEqual(table.allocated(), 0)
+            self.assertEqual(table.remaining(), 4)
+            self.assertEqual(table.waiting(), 0)
+
+    def test_matches_unannotated(self):
+        for space in Space.objects.with_totals():
+            plain = Space.objects.get(pk=space.pk)
+            self.assertEqual((space.allocated(), space.remaining(), space.waiting()),
+                             (plain.allocated(), plain.remaining(), plain.waiting()))
@@ -0,0 +1,107 @@
+from django.test import TestCase
+from ..models import Artist, Bid, Bidder, BidderId, Person, Piece
+
+
+class TopBidTests (TestCase):
+    def setUp(self):
+        artist = Artist.objects.create(artistid=1, person=Person.objects.create(name="Artist"))
+        self.piece = Piece.objects.create(artist=artist, pieceid=1, name="Piece", min_bid=10,
+                                          status=Piece.StatusInShow)
+        self.piece2 = Piece.objects.create(artist=artist, pieceid=2, name="Piece 2", min_bid=10,
+                                           status=Piece.StatusInShow)
+        self.bidder1 = Bidder.objects.create(person=Person.objects.create(name="Bidder 1"))
+        BidderId.objects.create(id="1001", bidder=self.bidder1)
+        self.bidder2 = Bidder.objects.create(person=Person.objects.create(name="Bidder 2"))
+        BidderId.objects.create(id="1021", bidder=self.bidder2)
+
+    def reload(self, piece):
+        return Piece.objects.get(pk=piece.pk)
+
+    def test_no_bids(self):
+        piece = self.reload(self.piece)
+        self.assertIsNone(piece.current_bid_amount)
+        self.assertEqual(piece.bid_count, 0)
+        self.assertRaises(Bid.DoesNotExist, piece.top_bid)
+
+    def test_bids_saved(self):
+        Bid.objects.create(bidder=self.bidder1, amount=10, piece=self.piece)
+        bid2 = Bid.objects.create(bidder=self.bidder2, amount=15, piece=self.piece)
+        piece = self.reload(self.piece)
+        self.assertEqual(piece.top_bid(), bid2)
+        self.assertEqual(piece.current_bid_amount, 15)
+        self.assertEqual(piece.current_bidder, self.bidder2)
+        self.assertEqual(piece.bid_count, 2)
+        self.assertTrue(Bid.objects.get(pk=bid2.pk).is_top_bid)
+
+    def test_bid_invalidated_and_deleted(self):
+        bid1 = Bid.objects.create(bidder=self.bidder1, amount=10, piece=self.piece)
+        bid2 = Bid.objects.create(bidder=self.bidder2, amount=15, piece=self.piece)
+        bid2.invalid = True
+        bid2.save()
+        piece = self.reload(self.piece)
+        self.assertEqual(piece.top_bid(), bid1)
+        self.assertEqual(piece.bid_count, 1)
+        bid1.delete()
+        piece = self.reload(self.piece)
+        self.assertIsNone(piece.current_bid)
+        self.assertEqual(piece.bid_count, 0)
+
+    def test_bid_moved(self):
+        bid = Bid.objects.create(bidder=self.bidder1, amount=10, piece=self.piece)
+        bid.piece = self.piece2
+        bid.save()
+        self.assertEqual(self.reload(self.piece).bid_count, 0)
+        self.assertEqual(self.reload(self.piece2).top_bid(), bid)
+
+    def test_stale_piece_save(self):
+        stale_piece = self.reload(self.piece)
+        Bid.objects.create(bidder=self.bidder1, amount=10, piece=self.piece)
+        stale_piece.location = "A1"
+        stale_piece.save()
+        self.assertEqual(self.reload(self.piece).current_bid_amount, 10)
+
+    def test_create_with_pk(self):
+        piece = Piece(pk=100, artist=self.piece.artist, pieceid=3, name="Piece 3", min_bid=10)
+        piece.save()
+        self.assertEqual(self.reload(piece).code, "1-3")
+
+    def test_rebuild(self):
+        bid = Bid.objects.create(bidder=self.bidder1, amount=10, piece=self.piece)
+        Piece.objects.update(current_bid=None, current_bid_amount=None, current_bidder=None, bid_count=0)
+        self.assertEqual(Piece.objects.rebuild_top_bids(), 1)
+        self.assertEqual(self.reload(self.piece).top_bid(), bid)
+        self.assertEqual(Piece.objects.rebuild_top_bids(), 0)
+
+    def test_with_top_bid(self):
+        Bid.objects.create(bidder=self.bidder1, amount=10, piece=self.piece)
+        Bid.objects.create(bidder=self.bidder2, amount=20, buy_now_bid=True, piece=self.piece)
+        with self.assertNumQueries(2):
+            pieces = list(Piece.objects.with_top_bid().order_by('pieceid'))
+            self.assertEqual(pieces[0].current_bid.amount, 20)
+            self.assertTrue(pieces[0].current_bid.buy_now_bid)
+            self.assertEqual(pieces[0].current_bidder.name(), "Bidder 2")
+            self.assertEqual(pieces[0].current_bidder.bidder_ids(), ["1021"])
+            self.assertEqual(pieces[0].artistname(), "Artist")
+            self.assertIsNone(pieces[1].current_bid)
+
+    def test_with_winnings(self):
+        Bid.objects.create(bidder=self.bidder1, amount=10, piece=self.piece)
+        Bid.objects.create(bidder=self.bidder2, amount=15, piece=self.piece)
+        bid = Bid.objects.create(bidder=self.bidder1, amount=10, piece=self.piece2)
+        with self.assertNumQueries(3):
+            bidders = Bidder.objects.with_winnings(Bidder.objects.order_by('id'))
+            self.assertEqual([b.top_bids()[0].piece.artistname() for b in bidders], ["Artist", "Artist"])
+            self.assertEqual(bidders[0].top_bids(), [bid])
+            self.assertEqual(bidders[0].bidder_ids(), ["1001"])
+            self.assertEqual(bidders[1].top_bids()[0].amount, 15)
+        self.piece2.status = Piece.StatusSold
+        self.piece2.save()
+        self.assertEqual(Bidder.objects.get(pk=self.bidder1.pk).top_bids(unsold_only=True), [])
+
+    def test_top_bids_not_kept(self):
+        bidder = Bidder.objects.get(pk=self.bidder1.pk)
+        self.assertEqual(bidder.top_bids(), [])
+        bid = Bid.objects.create(bidder=self.bidder1, amount=10, piece=self.piece)
+        self.assertEqual(bidder.top_bids(), [bid])
+        Bid.objects.create(bidder=self.bidder2, amount=15, piece=self.piece)
+        self.assertEqual(bidder.top_bids(), [])
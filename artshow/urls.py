@@ -29,6 +29,7 @@ urlpatterns = patterns('artshow',
                        (r'^reports/sales-percentiles/$', 'reports.sales_percentiles'),
                        (r'^reports/allocations-waiting/$', 'reports.allocations_waiting'),
                        (r'^cashier/$', 'cashier.cashier'),
+                       (r'^cashier/search/$', 'cashier.cashier_search'),
                        (r'^cashier/bidder/(?P<bidder_id>\d+)/$', 'cashier.cashier_bidder'),
                        (r'^cashier/invoice/(?P<invoice_id>\d+)/$', 'cashier.cashier_invoice'),
                        (r'^cashier/invoice/(?P<invoice_id>\d+)/print/$', 'cashier.print_invoice'),
@@ -11,6 +11,7 @@ from .conf import settings
 from django.template import Context
 from django.template.loader import get_template
 from django.core.mail import send_mail
+from django.db import DEFAULT_DB_ALIAS, connections
 
 User = get_user_model()
 
@@ -122,3 +123,48 @@ _quantization_value = Decimal(10) ** -settings.ARTSHOW_MONEY_PRECISION
 
 def format_money(value):
     return unicode(value.quantize(_quantization_value))
+
+
+class _CountingCursor(object):
+    """Wraps a database cursor, counting the statements executed through it."""
+
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def execute(self, sql, params=None):
+        self.counter.count += 1
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.counter.count += 1
+        return self.cursor.executemany(sql, param_list)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+class QueryCounter(object):
+    """Counts the SQL statements run on a database connection while in use as a context manager.
+
+    Unlike django.test.utils.CaptureQueriesContext, this neither turns on the debug cursor nor keeps the
+    statements in connection.queries, so it can be used in long-running processes."""
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.connection = connections[using]
+        self.count = 0
+
+    def __enter__(self):
+        self.had_cursor = 'cursor' in self.connection.__dict__
+        self.original_cursor = self.connection.cursor
+        self.connection.cursor = lambda: _CountingCursor(self.original_cursor(), self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.had_cursor:
+            self.connection.cursor = self.original_cursor
+        else:
+            del self.connection.cursor
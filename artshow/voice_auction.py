@@ -8,6 +8,7 @@ from django.contrib import messages
 from django.core.exceptions import ValidationError
 
 from .models import Piece, Bid, BidderId
+from .bidvalidation import BidValidator
 
 
 logger = getLogger(__name__)
@@ -92,6 +93,9 @@ def auction_bids(request, adult):
     if request.method == "POST":
         formset = AuctionBidFormSet(request.POST, initial=initial_data)
         if formset.is_valid():
+            validator = BidValidator()
+            validator.load_pieces([form.cleaned_data['piece'].pk for form in formset
+                                   if form.cleaned_data['action'] == 2])
             for form in formset:
                 piece = form.cleaned_data['piece']
                 action = form.cleaned_data['action']
@@ -112,7 +116,7 @@ def auction_bids(request, adult):
                 elif action == 2:
                     b = Bid(bidder=bidder.bidder, amount=amount, piece=piece)
                     try:
-                        b.validate()
+                        validator.validate(b)
                     except ValidationError, x:
                         messages.error(request, "Bid on %s not saved: %s" % (piece, x))
                     else:
@@ -13,7 +13,7 @@ class Person (models.Model):
     country = models.CharField(max_length=40, blank=True)
     phone = models.CharField(max_length=40, blank=True)
     email = models.CharField(max_length=100, blank=True)
-    reg_id = models.CharField(max_length=40, blank=True, verbose_name="Reg ID")
+    reg_id = models.CharField(max_length=40, blank=True, verbose_name="Reg ID", db_index=True)
     comment = models.CharField(max_length=100, blank=True)
 
     def __unicode__(self):